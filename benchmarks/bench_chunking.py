@@ -0,0 +1,167 @@
+"""
+Compares the splitting of the documents by font size (CHUNKING_MODE = 'font') with the token-targeted chunks ('tokens')
+on a labeled set of questions, with the retrieval and the prompt composition of the questions (find_relevant_info and
+compose_input_with_relevant_info):
+
+    python benchmarks/bench_chunking.py dataset.json --chunk-tokens 200 400 800 --overlap 50
+
+The dataset has the format of eval_retrieval.py. The "pdf" documents are extracted once and split with each mode; the
+"sections" documents are taken as the sections of the font mode, split in lines for the tokens mode. For each mode it
+reports the sections and their size in tokens (p50/p95/max), the recall of the relevant sections in the prompt, the
+tokens of the prompts of sections sent to the model and the calls to the model of each question (one per prompt of
+sections, as answer_question sends them, plus the answer).
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import MAX_TOKENS, PAGE_LIMIT, BM25_threshold, LSA_COMPONENTS, prefix_info_phrase  # noqa: E402
+from env import CHUNK_TOKENS, CHUNK_OVERLAP  # noqa: E402
+from boilerplate_filter import count_tokens  # noqa: E402
+from chatgpt_responses import compose_input_with_relevant_info  # noqa: E402
+from eval_retrieval import relevant_sections  # noqa: E402
+from infomation_retrival_for_questions import tokenize_text  # noqa: E402
+from nlp_resources import get_tokenizer  # noqa: E402
+from pdf_listener import find_relevant_info, extract_text_with_font_info  # noqa: E402
+from sparse_retrieval import SparseBM25Index  # noqa: E402
+from typograph_text_spliter import segment_text, chunk_sections  # noqa: E402
+
+
+def split_document(name, source, records, mode, chunk_tokens, overlap, work_dir):
+    # Writes the sections of the document as compose_input_with_relevant_info reads them: <work_dir>/<name>/<name>_i.txt
+    folder = os.path.join(work_dir, name)
+    os.makedirs(folder, exist_ok=True)
+    file_path = os.path.join(folder, name)
+
+    if records is not None:
+        subfiles = []
+        segment_text(None, 0, save_to_file=True, file_path=file_path, records=records, subfiles=subfiles,
+                     mode=mode.split(':')[0], chunk_tokens=chunk_tokens, chunk_overlap=overlap)
+        return {os.path.basename(subfile): tokens for subfile, tokens in subfiles}
+
+    if mode == 'font':
+        texts = list(source['sections'])
+    else:
+        chunks = chunk_sections([section.split('\n') for section in source['sections']], chunk_tokens, overlap)
+        texts = [' '.join(chunk) for chunk, _ in chunks]
+    section_tokens = {}
+    for i, text in enumerate(texts):
+        with open(f'{file_path}_{i}.txt', 'w', encoding='utf-8') as file:
+            file.write(text)
+        section_tokens[f'{name}_{i}.txt'] = count_tokens(text)
+    return section_tokens
+
+
+def read_sections(folder):
+    filenames = sorted(filename for filename in os.listdir(folder) if filename.endswith('.txt'))
+    texts = []
+    for filename in filenames:
+        with open(os.path.join(folder, filename), 'r', encoding='utf-8') as file:
+            texts.append(file.read())
+    return filenames, texts
+
+
+def model_calls(msgs, not_found_info, total_tokens, tokenizer):
+    # Prompts of sections that answer_question sends to the model, and their tokens
+    if not_found_info:
+        return 0, 0
+    if total_tokens < MAX_TOKENS:
+        return len(msgs), sum(len(tokenizer.encode(msg)) for msg in msgs)
+    calls, sent_tokens = 0, 0
+    for msg in msgs:
+        tokens = len(tokenizer.encode(msg))
+        if sent_tokens + tokens < MAX_TOKENS:
+            calls += 1
+            sent_tokens += tokens
+    return calls, sent_tokens
+
+
+def evaluate_mode(dataset, records, mode, chunk_tokens, overlap, work_dir):
+    tokenizer = get_tokenizer()
+    sizes, recalls, prompt_tokens, calls = [], [], [], []
+    for name, source in dataset['documents'].items():
+        section_tokens = split_document(name, source, records.get(name), mode, chunk_tokens, overlap, work_dir)
+        sizes += [tokens for tokens in section_tokens.values() if tokens is not None]
+
+        filenames, texts = read_sections(os.path.join(work_dir, name))
+        questions = [question for question in dataset['questions'] if question['document'] == name]
+        if not questions or not filenames:
+            continue
+        corpus_tokenized = [tokenize_text(text) for text in texts]
+        index = SparseBM25Index(corpus_tokenized, filenames, lsa_components=LSA_COMPONENTS)
+        relevant_infos = find_relevant_info([question['question'] for question in questions], index,
+                                            corpus_tokenized, filenames, index.total_tokens)
+
+        for question, relevant_info in zip(questions, relevant_infos):
+            relevant = relevant_sections(question, filenames, texts)
+            prompt = [filename for filename, score in sorted(relevant_info, key=lambda x: x[1], reverse=True)
+                      [:PAGE_LIMIT] if score >= BM25_threshold]
+            if relevant:
+                recalls.append(len(relevant & set(prompt)) / len(relevant))
+
+            msgs, not_found_info, total_tokens = compose_input_with_relevant_info(work_dir, relevant_info,
+                                                                                  prefix_info_phrase)
+            question_calls, sent_tokens = model_calls(msgs, not_found_info, total_tokens, tokenizer)
+            calls.append(question_calls + 1)
+            prompt_tokens.append(sent_tokens)
+
+    return {
+        'sections': len(sizes),
+        'tokens_p50': float(np.percentile(sizes, 50)) if sizes else 0,
+        'tokens_p95': float(np.percentile(sizes, 95)) if sizes else 0,
+        'tokens_max': max(sizes, default=0),
+        'prompt_recall': float(np.mean(recalls)) if recalls else 0,
+        'tokens_per_question': float(np.mean(prompt_tokens)) if prompt_tokens else 0,
+        'calls_per_question': float(np.mean(calls)) if calls else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset')
+    parser.add_argument('--chunk-tokens', nargs='+', type=int, default=[200, 400, 800],
+                        help='sizes of the tokens mode to compare')
+    parser.add_argument('--overlap', type=int, default=CHUNK_OVERLAP)
+    parser.add_argument('--save', help='JSON file where the results are written')
+    args = parser.parse_args()
+
+    with open(args.dataset, 'r', encoding='utf-8') as file:
+        dataset = json.load(file)
+    base_dir = os.path.dirname(os.path.abspath(args.dataset))
+
+    # The PDFs are extracted once for all the modes
+    records = {}
+    for name, source in list(dataset['documents'].items()):
+        if 'pdf' in source:
+            records[name] = extract_text_with_font_info(os.path.join(base_dir, source['pdf']))
+        elif 'sections' not in source:
+            print(f'Skipping {name}: only the "pdf" and "sections" documents can be split again')
+            del dataset['documents'][name]
+
+    modes = [('font', CHUNK_TOKENS)] + [(f'tokens:{size}', size) for size in args.chunk_tokens]
+    results = {}
+    for mode, chunk_tokens in modes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results[mode] = evaluate_mode(dataset, records, mode, chunk_tokens, args.overlap, work_dir)
+
+    print(f'{"mode":<14}{"sections":>10}{"tok p50":>9}{"tok p95":>9}{"tok max":>9}{"prompt R":>10}{"tokens/q":>10}'
+          f'{"calls/q":>9}')
+    for mode, metrics in results.items():
+        print(f'{mode:<14}{metrics["sections"]:>10}{metrics["tokens_p50"]:>9.0f}{metrics["tokens_p95"]:>9.0f}'
+              f'{metrics["tokens_max"]:>9}{metrics["prompt_recall"]:>10.3f}{metrics["tokens_per_question"]:>10.0f}'
+              f'{metrics["calls_per_question"]:>9.2f}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
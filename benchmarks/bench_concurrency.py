@@ -0,0 +1,143 @@
+"""
+Latency of the cheap requests of a gevent worker while heavy questions are running.
+
+Local mode runs in this process, monkey patched as a gevent worker of gunicorn. Some greenlets prepare the context of
+a question of a processed document (retrieval, preprocess and prompt composition, see pdf_listener.prepare_context) in
+a loop, while a probe greenlet measures how late the event loop wakes it up, which is the delay that any other request
+of the worker would suffer. The heavy work is run inline (as before), in a native thread (run_blocking) and in the
+CPU worker processes (run_cpu):
+
+    python benchmarks/bench_concurrency.py local --user-id 7 --document manual --question "¿Qué es la evaluación?"
+
+HTTP mode measures GET /users/<user_id>/documents on a running server, alone and with --heavy question requests in
+flight at the same time:
+
+    python benchmarks/bench_concurrency.py http --url http://localhost:5000 --api-key KEY --user-id 7 --pdf-id 3 \
+        --chat-id 1 --question "¿Qué es la evaluación?" --heavy 8
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import argparse  # noqa: E402
+
+import gevent  # noqa: E402
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import path_to_listen  # noqa: E402
+from execution import run_blocking, run_cpu, get_cpu_pool  # noqa: E402
+from pdf_listener import prepare_context  # noqa: E402
+
+
+def percentiles(values):
+    values = np.array(values) * 1000
+    return np.percentile(values, 50), np.percentile(values, 99), values.max()
+
+
+def probe(lags, interval, until):
+    # Delay of the event loop: how late a greenlet that sleeps interval seconds is woken up
+    while time.perf_counter() < until:
+        start = time.perf_counter()
+        gevent.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def run_local(args):
+    main_path = os.path.join(path_to_listen, str(args.user_id))
+    task = (prepare_context, args.document, str(args.user_id), main_path, [args.question])
+    modes = {
+        'inline': lambda: task[0](*task[1:]),
+        'thread': lambda: run_blocking(*task),
+        'process': lambda: run_cpu(*task),
+    }
+
+    # Warm up: index cached, NLP resources loaded and CPU workers started
+    task[0](*task[1:])
+    gevent.joinall([gevent.spawn(run_cpu, *task) for _ in range(args.heavy)])
+
+    print(f'{"mode":<10}{"heavy/s":>10}{"lag p50 ms":>12}{"lag p99 ms":>12}{"lag max ms":>12}')
+    for name, heavy in [('idle', None)] + list(modes.items()):
+        until = time.perf_counter() + args.duration
+        completed = []
+
+        def worker():
+            while time.perf_counter() < until:
+                heavy()
+                completed.append(1)
+
+        lags = []
+        greenlets = [gevent.spawn(probe, lags, args.interval, until)]
+        if heavy is not None:
+            greenlets += [gevent.spawn(worker) for _ in range(args.heavy)]
+        gevent.joinall(greenlets)
+        p50, p99, worst = percentiles(lags)
+        print(f'{name:<10}{len(completed) / args.duration:>10.1f}{p50:>12.2f}{p99:>12.2f}{worst:>12.2f}')
+
+    get_cpu_pool().close()
+
+
+def run_http(args):
+    import requests
+
+    headers = {'X-Api-Key': args.api_key}
+    documents_url = f'{args.url}/users/{args.user_id}/documents'
+    question_url = f'{args.url}/users/{args.user_id}/documents/{args.pdf_id}/chats/{args.chat_id}/question'
+
+    def cheap(latencies, until):
+        with requests.Session() as session:
+            while time.perf_counter() < until:
+                start = time.perf_counter()
+                session.get(documents_url, headers=headers).raise_for_status()
+                latencies.append(time.perf_counter() - start)
+                gevent.sleep(args.interval)
+
+    def heavy(completed, until):
+        with requests.Session() as session:
+            while time.perf_counter() < until:
+                session.post(question_url, headers=headers, json={'question': args.question},
+                             timeout=600).raise_for_status()
+                completed.append(1)
+
+    print(f'{"load":<10}{"questions":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, heavy_count in (('idle', 0), ('questions', args.heavy)):
+        until = time.perf_counter() + args.duration
+        latencies, completed = [], []
+        greenlets = [gevent.spawn(cheap, latencies, until)]
+        greenlets += [gevent.spawn(heavy, completed, until) for _ in range(heavy_count)]
+        gevent.joinall(greenlets, raise_error=True)
+        p50, p99, worst = percentiles(latencies)
+        print(f'{name:<10}{len(completed):>10}{p50:>10.2f}{p99:>10.2f}{worst:>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['local', 'http'])
+    parser.add_argument('--user-id', required=True)
+    parser.add_argument('--question', required=True)
+    parser.add_argument('--document', help='folder of the processed document (local mode)')
+    parser.add_argument('--url', help='base url of the server (http mode)')
+    parser.add_argument('--api-key', help='http mode')
+    parser.add_argument('--pdf-id', help='http mode')
+    parser.add_argument('--chat-id', default='1', help='http mode')
+    parser.add_argument('--heavy', type=int, default=4, help='questions running at the same time')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of each run')
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between cheap requests or probes')
+    args = parser.parse_args()
+
+    if args.mode == 'local':
+        if not args.document:
+            parser.error('--document is required in local mode')
+        run_local(args)
+    else:
+        if not (args.url and args.pdf_id):
+            parser.error('--url and --pdf-id are required in http mode')
+        run_http(args)
+
+
+if __name__ == '__main__':
+    main()
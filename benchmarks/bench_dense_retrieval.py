@@ -0,0 +1,88 @@
+"""
+Cost of the embeddings of RETRIEVAL_ENGINE 'hybrid': the embedding throughput of the ingestion for each batch size and
+the latency of a question with the sparse index, the embeddings and both fused:
+
+    python benchmarks/bench_dense_retrieval.py --model ../models/bert-base-spanish-onnx
+    python benchmarks/bench_dense_retrieval.py --model ../models/test-embeddings --sections 2000 --batch-sizes 1 8 32
+
+The sections and questions are the ones of a dataset of eval_retrieval.py (the sample dataset by default), repeated up
+to --sections. The model is a folder of DENSE_MODEL_PATH, build_test_embedding_model.py builds a small one.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import DENSE_MODEL_PATH, EMBEDDING_THREADS, EMBEDDING_MAX_LENGTH, RETRIEVAL_TOP_K  # noqa: E402
+from env import LSA_COMPONENTS, LSA_WEIGHT, LSA_CANDIDATES  # noqa: E402
+from dense_retrieval import EmbeddingModel, DenseIndex, HybridIndex  # noqa: E402
+from infomation_retrival_for_questions import tokenize_text  # noqa: E402
+from sparse_retrieval import SparseBM25Index  # noqa: E402
+
+DEFAULT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retrieval_eval', 'sample_questions.json')
+
+
+def percentiles(times):
+    return np.percentile(times, 50) * 1000, np.percentile(times, 95) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=DENSE_MODEL_PATH, help='folder of the ONNX model')
+    parser.add_argument('--dataset', default=DEFAULT_DATASET)
+    parser.add_argument('--sections', type=int, default=500)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 16, 32])
+    parser.add_argument('--threads', type=int, default=EMBEDDING_THREADS)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each question')
+    args = parser.parse_args()
+
+    with open(args.dataset, 'r', encoding='utf-8') as file:
+        dataset = json.load(file)
+    texts = [section for source in dataset['documents'].values() for section in source.get('sections', [])]
+    texts = (texts * (args.sections // len(texts) + 1))[:args.sections]
+    filenames = [f'doc_{i}.txt' for i in range(len(texts))]
+    questions = [question['question'] for question in dataset['questions']]
+
+    model = EmbeddingModel(args.model, max_length=EMBEDDING_MAX_LENGTH, threads=args.threads)
+    print(f'{model.name}: {len(texts)} sections, {len(questions)} questions, {args.threads or "all"} threads')
+
+    print(f'{"batch":>6}{"sections/s":>12}{"total s":>9}')
+    embeddings = None
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        embeddings = model.encode(texts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f'{batch_size:>6}{len(texts) / elapsed:>12.1f}{elapsed:>9.2f}')
+
+    sparse = SparseBM25Index([tokenize_text(text) for text in texts], filenames, lsa_components=LSA_COMPONENTS)
+    dense = DenseIndex(embeddings, filenames, model.name)
+    hybrid = HybridIndex(sparse, dense)
+    engines = {
+        'sparse': lambda question: sparse.top_k_many([tokenize_text(question)], k=RETRIEVAL_TOP_K,
+                                                     lsa_weight=LSA_WEIGHT, lsa_candidates=LSA_CANDIDATES),
+        'dense': lambda question: dense.top_k_many(model.encode([question]), k=RETRIEVAL_TOP_K),
+        'hybrid': lambda question: hybrid.top_k_many([tokenize_text(question)], model.encode([question]),
+                                                     k=RETRIEVAL_TOP_K, lsa_weight=LSA_WEIGHT,
+                                                     lsa_candidates=LSA_CANDIDATES),
+    }
+
+    print(f'{"engine":<8}{"p50 ms":>9}{"p95 ms":>9}')
+    for name, retrieve in engines.items():
+        times = []
+        for question in questions:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                retrieve(question)
+                times.append(time.perf_counter() - start)
+        p50, p95 = percentiles(times)
+        print(f'{name:<8}{p50:>9.2f}{p95:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
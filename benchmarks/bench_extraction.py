@@ -0,0 +1,105 @@
+"""
+Benchmark of the extraction engines: pages per second of 'full', 'fast' and 'auto', the agreement of the sections
+obtained with 'fast'/'auto' and the ones obtained with the full layout analysis, and the biggest difference between the
+size a line gets from each engine and the one it gets from the full layout (the lines with the same text in the same
+page), which must be 0 for the sections and the headings of a document extracted with 'auto' to be the same.
+
+    python benchmarks/bench_extraction.py document_1.pdf document_2.pdf
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from pdfminer.pdfpage import PDFPage  # noqa: E402
+from boilerplate_filter import find_repeated_lines  # noqa: E402
+from pdf_listener import extract_text_with_font_info  # noqa: E402
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def split_sections(lines):
+    # Same boundary rule as segment_text: the repeated headers and footers are removed and a new section starts when
+    # the font size grows more than 15%
+    removed_lines = find_repeated_lines([(line['text'], line['page'], line['y']) for line in lines])
+    lines = [line for i, line in enumerate(lines) if i not in removed_lines]
+
+    sections = []
+    current_section = []
+    temp_size = 0.000000001
+    for line in lines:
+        if current_section and 0.0 < temp_size / float(line['size']) < 0.85:
+            sections.append(current_section)
+            current_section = []
+        current_section.append(line['text'])
+        temp_size = float(line['size'])
+    if current_section:
+        sections.append(current_section)
+    return [set(WORD_PATTERN.findall(' '.join(section).lower())) for section in sections]
+
+
+def section_agreement(reference, candidate, min_jaccard=0.9):
+    """
+    Ratio of the reference sections that have a section with the same words (Jaccard >= min_jaccard) in the candidate
+    """
+    if not reference:
+        return 1.0
+
+    matched = 0
+    for words in reference:
+        for other in candidate:
+            union = len(words | other)
+            if not union or len(words & other) / union >= min_jaccard:
+                matched += 1
+                break
+    return matched / len(reference)
+
+
+def size_difference(reference, lines):
+    """
+    Biggest difference between the size of a line and the size of the line with the same text in the same page of the
+    reference, and number of lines compared
+    """
+    sizes = {(line['page'], line['text'].strip()): float(line['size']) for line in reference}
+    difference, compared = 0.0, 0
+    for line in lines:
+        size = sizes.get((line['page'], line['text'].strip()))
+        if size is not None:
+            difference = max(difference, abs(float(line['size']) - size))
+            compared += 1
+    return difference, compared
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pdfs', nargs='+')
+    args = parser.parse_args()
+
+    print(f'{"document":<40}{"engine":<8}{"pages/s":>10}{"sections":>10}{"agreement":>11}{"size diff":>11}'
+          f'{"lines":>8}')
+    for pdf_path in args.pdfs:
+        with open(pdf_path, 'rb') as fp:
+            pages = sum(1 for _ in PDFPage.get_pages(fp))
+
+        reference, reference_lines = None, None
+        for engine in ('full', 'fast', 'auto'):
+            start = time.perf_counter()
+            lines = extract_text_with_font_info(pdf_path, engine=engine)
+            elapsed = time.perf_counter() - start
+
+            sections = split_sections(lines)
+            if reference is None:
+                reference, reference_lines = sections, lines
+            agreement = section_agreement(reference, sections)
+            difference, compared = size_difference(reference_lines, lines)
+
+            print(f'{os.path.basename(pdf_path)[:39]:<40}{engine:<8}{pages / elapsed:>10.1f}{len(sections):>10}'
+                  f'{agreement:>11.1%}{difference:>11.2f}{compared:>8}')
+
+
+if __name__ == '__main__':
+    main()
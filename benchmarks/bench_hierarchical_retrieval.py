@@ -0,0 +1,86 @@
+"""
+Latency of the retrieval of a question over the whole sparse index and from the chapters to the sections
+(HierarchicalIndex), as the documents grow:
+
+    python benchmarks/bench_hierarchical_retrieval.py --sections 1000 10000 50000 --sections-per-chapter 50
+
+The documents are synthetic: each chapter has its own topic words mixed with words shared by the whole document, and
+the questions ask for the topic words of a chapter. Besides the latency (p50/p95) it reports the agreement between
+both: the fraction of the top RETRIEVAL_TOP_K sections of the whole index that the hierarchical retrieval also returns.
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import RETRIEVAL_TOP_K, HIERARCHY_TOP_CHAPTERS  # noqa: E402
+from section_tree import HierarchicalIndex, build_chapter_index  # noqa: E402
+from sparse_retrieval import SparseBM25Index  # noqa: E402
+
+
+def synthetic_document(sections, sections_per_chapter, section_tokens, rng):
+    # Tokens are integers: 0-999 are shared by all the chapters, each chapter has 20 words of its own
+    chapters = max(sections // sections_per_chapter, 1)
+    corpus_tokenized, filenames, tree = [], [], {'source': 'synthetic', 'sections': {}, 'chapters': []}
+    for chapter in range(chapters):
+        topic = 1000 + chapter * 20 + np.arange(20)
+        tree['chapters'].append({'path': [f'Chapter {chapter}'], 'sections': []})
+        for _ in range(sections_per_chapter):
+            filename = f'doc_{len(filenames)}.txt'
+            tokens = np.where(rng.random(section_tokens) < 0.2, rng.choice(topic, section_tokens),
+                              rng.integers(0, 1000, section_tokens))
+            corpus_tokenized.append(tokens.tolist())
+            filenames.append(filename)
+            tree['sections'][filename] = [f'Chapter {chapter}']
+            tree['chapters'][-1]['sections'].append(filename)
+    return corpus_tokenized, filenames, tree, chapters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', nargs='+', type=int, default=[1000, 10000, 50000])
+    parser.add_argument('--sections-per-chapter', type=int, default=50)
+    parser.add_argument('--section-tokens', type=int, default=300)
+    parser.add_argument('--top-chapters', type=int, default=HIERARCHY_TOP_CHAPTERS)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{"sections":>9}{"chapters":>9}{"flat p50":>10}{"flat p95":>10}{"tree p50":>10}{"tree p95":>10}'
+          f'{"agreement":>11}')
+    for sections in args.sections:
+        rng = np.random.default_rng(args.seed)
+        corpus_tokenized, filenames, tree, chapters = synthetic_document(sections, args.sections_per_chapter,
+                                                                         args.section_tokens, rng)
+        sparse = SparseBM25Index(corpus_tokenized, filenames)
+        hierarchical = HierarchicalIndex(sparse, build_chapter_index(corpus_tokenized, filenames, tree), tree)
+
+        flat_times, tree_times, agreement = [], [], []
+        for _ in range(args.queries):
+            chapter = rng.integers(chapters)
+            query = (rng.choice(1000 + chapter * 20 + np.arange(20), 3).tolist()
+                     + rng.integers(0, 1000, 3).tolist())
+
+            start = time.perf_counter()
+            flat = sparse.top_k_many([query], k=RETRIEVAL_TOP_K)[0]
+            flat_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            found = hierarchical.top_k_many([query], k=RETRIEVAL_TOP_K, top_chapters=args.top_chapters)[0]
+            tree_times.append(time.perf_counter() - start)
+
+            agreement.append(len({f for f, _ in flat} & {f for f, _ in found}) / max(len(flat), 1))
+
+        flat_p50, flat_p95 = np.percentile(flat_times, [50, 95]) * 1000
+        tree_p50, tree_p95 = np.percentile(tree_times, [50, 95]) * 1000
+        print(f'{sections:>9}{chapters:>9}{flat_p50:>10.2f}{flat_p95:>10.2f}{tree_p50:>10.2f}{tree_p95:>10.2f}'
+              f'{np.mean(agreement):>11.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Throughput and latency of the calls to the model through src/llm_client.py, against benchmarks/llm_stub_server.py or
+any OpenAI compatible server. --concurrency threads make --calls calls in total; the report includes the retries and
+errors of the client and, with the stub, the TCP connections it opened, which stay at most --concurrency when the
+connections are reused:
+
+    python benchmarks/llm_stub_server.py --port 8089 --latency 0.2 --rate-limit 0.05 &
+    python benchmarks/bench_llm_client.py --api-base http://localhost:8089/v1 --calls 200 --concurrency 20
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from llm_client import LLMClient, CircuitOpen  # noqa: E402
+
+
+def stub_stats(api_base):
+    import requests
+
+    try:
+        response = requests.get(api_base.rsplit('/v1', 1)[0] + '/stats', timeout=5)
+        return response.json() if response.ok else None
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--api-base', required=True, help='e.g. http://localhost:8089/v1')
+    parser.add_argument('--calls', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    args = parser.parse_args()
+
+    # The model of the calls is the one given, not the one of the routing
+    client = LLMClient(api_base=args.api_base, pool_size=args.concurrency, routing=False)
+    before = stub_stats(args.api_base)
+    messages = [{'role': 'system', 'content': 'Eres un asistente.'},
+                {'role': 'user', 'content': '¿Qué es la evaluación continua?'}]
+
+    def call(_):
+        start = time.perf_counter()
+        try:
+            client.create(model=args.model, messages=messages, max_tokens=50)
+        except CircuitOpen:
+            return None
+        except Exception as e:
+            print(f'Call failed: {type(e).__name__}: {e}')
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = [latency for latency in executor.map(call, range(args.calls)) if latency is not None]
+    elapsed = time.perf_counter() - start
+
+    stats = client.stats()
+    print(f'calls: {args.calls}, completed: {len(latencies)}, errors: {stats["errors"]}, retries: {stats["retries"]}')
+    if latencies:
+        latencies = np.array(latencies) * 1000
+        print(f'latency p50: {np.percentile(latencies, 50):.1f} ms, p95: {np.percentile(latencies, 95):.1f} ms, '
+              f'throughput: {len(latencies) / elapsed:.1f} calls/s')
+    print(f'tokens: {stats["prompt_tokens"]} prompt, {stats["completion_tokens"]} completion')
+
+    after = stub_stats(args.api_base)
+    if before is not None and after is not None:
+        print(f'connections opened: {after["connections"] - before["connections"]} '
+              f'for {after["requests"] - before["requests"]} requests')
+
+
+if __name__ == '__main__':
+    main()
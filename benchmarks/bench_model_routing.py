@@ -0,0 +1,82 @@
+"""
+Latency of the calls of a question with and without the routing of the models (src/model_router.py), against the stub
+with a latency for each tier:
+
+    python benchmarks/llm_stub_server.py --port 8089 --model-latency gpt-3.5-turbo=0.3 gpt-3.5-turbo-16k=1.2 &
+    python benchmarks/bench_model_routing.py --api-base http://localhost:8089/v1 --questions 20
+
+Each question makes the calls of the question route: the entity extraction of the memory, the summaries of the prompts
+of sections and the answer, and a fraction of them (--no-context) are follow-up questions without retrieved sections,
+that only make the entity extraction and the answer. The report has the models used and the latency of each type of
+call, and the total time of the questions.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from collections import Counter, defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import MODEL  # noqa: E402
+from llm_client import LLMClient  # noqa: E402
+
+WORDS = ('el la de que en los las por con para una sobre este entre cuando capítulo sección documento evaluación '
+         'alumno curso nota examen práctica teoría tema lectura').split()
+
+
+def text(words, rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def question_calls(rng, section_prompts, no_context):
+    # (call type, messages) of a question
+    calls = [('entities', [{'role': 'user', 'content': text(250, rng)}])]
+    if rng.random() >= no_context:
+        for _ in range(section_prompts):
+            calls.append(('summarize', [{'role': 'user', 'content': text(rng.randint(1500, 3500), rng)}]))
+        calls.append(('answer', [{'role': 'user', 'content': text(rng.randint(1000, 3000), rng)}]))
+    else:
+        calls.append(('answer', [{'role': 'user', 'content': text(40, rng)}]))
+    return calls
+
+
+def run(client, questions, rng, section_prompts, no_context):
+    models, latencies = defaultdict(Counter), defaultdict(list)
+    start = time.perf_counter()
+    for _ in range(questions):
+        for call_type, messages in question_calls(rng, section_prompts, no_context):
+            call_start = time.perf_counter()
+            response = client.create(model=MODEL, messages=messages, call_type=call_type)
+            latencies[call_type].append(time.perf_counter() - call_start)
+            models[call_type][response.get('model')] += 1
+    return models, latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--api-base', required=True, help='e.g. http://localhost:8089/v1')
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--section-prompts', type=int, default=1, help='prompts of sections of each question')
+    parser.add_argument('--no-context', type=float, default=0.3, help='fraction of questions without sections')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for routing in (False, True):
+        client = LLMClient(api_base=args.api_base, routing=routing)
+        models, latencies, elapsed = run(client, args.questions, random.Random(args.seed), args.section_prompts,
+                                         args.no_context)
+        print(f'routing: {routing}, total: {elapsed:.2f} s, {elapsed / args.questions * 1000:.0f} ms per question')
+        for call_type in ('entities', 'summarize', 'answer'):
+            if latencies[call_type]:
+                used = ', '.join(f'{model} x{calls}' for model, calls in models[call_type].most_common())
+                print(f'  {call_type:<10} p50 {np.percentile(latencies[call_type], 50) * 1000:7.0f} ms  '
+                      f'p95 {np.percentile(latencies[call_type], 95) * 1000:7.0f} ms  {used}')
+
+
+if __name__ == '__main__':
+    main()
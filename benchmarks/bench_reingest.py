@@ -0,0 +1,75 @@
+"""
+Time of the ingestion of a new edition of a document from scratch (extract_and_convert_to_xml) and incrementally, from
+the previous edition (reingest_document):
+
+    python benchmarks/bench_reingest.py old_edition.pdf new_edition.pdf --repeat 3
+
+Both run on copies of the PDFs in a temporary user folder of path_to_listen, without database. Besides the times it
+reports the pages extracted by the incremental ingestion and the sections added, updated and removed, and checks that
+both produce the same sections.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import path_to_listen  # noqa: E402
+from pdf_listener import extract_and_convert_to_xml, reingest_document, document_paths  # noqa: E402
+
+
+def read_sections(file_path):
+    complete_dir = document_paths(file_path)[2]
+    sections = {}
+    for filename in os.listdir(complete_dir):
+        if filename.endswith('.txt'):
+            with open(os.path.join(complete_dir, filename), 'r', encoding='utf-8') as file:
+                sections[filename] = file.read()
+    return sections
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old_edition')
+    parser.add_argument('new_edition')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    full_times, incremental_times = [], []
+    for _ in range(args.repeat):
+        # The indexes are read from the folders of the users
+        os.makedirs(path_to_listen, exist_ok=True)
+        folder = tempfile.mkdtemp(dir=path_to_listen)
+        try:
+            file_path = os.path.join(folder, 'document.pdf')
+
+            shutil.copy(args.new_edition, file_path)
+            start = time.perf_counter()
+            extract_and_convert_to_xml(None, None, file_path, None, subfiles=[])
+            full_times.append(time.perf_counter() - start)
+            full_sections = read_sections(file_path)
+
+            shutil.rmtree(document_paths(file_path)[2])
+            shutil.copy(args.old_edition, file_path)
+            extract_and_convert_to_xml(None, None, file_path, None, subfiles=[])
+            shutil.copy(args.new_edition, file_path)
+            start = time.perf_counter()
+            stats, changes = reingest_document(file_path)
+            incremental_times.append(time.perf_counter() - start)
+            same_sections = read_sections(file_path) == full_sections
+        finally:
+            shutil.rmtree(folder)
+
+    print(f"pages: {stats['pages']}, extracted: {stats['pages_extracted']}")
+    print(f"sections: {stats['sections']}, added: {len(changes['added'])}, updated: {len(changes['updated'])}, "
+          f"removed: {len(changes['removed'])}, same as from scratch: {same_sections}")
+    print(f'from scratch: {min(full_times):.3f} s, incremental: {min(incremental_times):.3f} s '
+          f'({min(full_times) / max(min(incremental_times), 1e-9):.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
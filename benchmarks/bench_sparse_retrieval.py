@@ -0,0 +1,75 @@
+"""
+Throughput benchmark of the sparse BM25 index against rank_bm25.BM25Okapi.
+It uses a synthetic corpus of token ids with a Zipf distribution, so it does not need any PDF, tiktoken or nltk data.
+
+    python benchmarks/bench_sparse_retrieval.py --sections 5000 --queries 200
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from sparse_retrieval import SparseBM25Index  # noqa: E402
+
+
+def synthetic_corpus(n_sections, mean_len, vocab_size, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.poisson(mean_len, n_sections) + 1
+    corpus = [list(rng.zipf(1.3, length) % vocab_size) for length in lengths]
+    filenames = [f'doc_{i}.txt' for i in range(n_sections)]
+    return corpus, filenames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', type=int, default=2000)
+    parser.add_argument('--section-tokens', type=int, default=300)
+    parser.add_argument('--vocab', type=int, default=30000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--query-tokens', type=int, default=8)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--lsa', type=int, default=0, help='LSA components of the re-ranking stage (0 disables it)')
+    args = parser.parse_args()
+
+    corpus, filenames = synthetic_corpus(args.sections, args.section_tokens, args.vocab)
+    rng = np.random.default_rng(1)
+    queries = [list(rng.zipf(1.3, args.query_tokens) % args.vocab) for _ in range(args.queries)]
+
+    start = time.perf_counter()
+    bm25 = BM25Okapi(corpus)
+    build_bm25 = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = SparseBM25Index(corpus, filenames, lsa_components=args.lsa)
+    build_sparse = time.perf_counter() - start
+
+    max_diff = 0.0
+    for query in queries[:10]:
+        max_diff = max(max_diff, float(np.abs(bm25.get_scores(query) - index.get_scores(query)).max()))
+
+    start = time.perf_counter()
+    for query in queries:
+        scores = bm25.get_scores(query)
+        np.argsort(scores)[::-1][:args.k]
+    query_bm25 = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for query in queries:
+        index.top_k(query, k=args.k)
+    query_sparse = time.perf_counter() - start
+
+    print(f'sections: {args.sections}, queries: {args.queries}, k: {args.k}, lsa: {args.lsa}')
+    print(f'max abs score difference: {max_diff:.3e}')
+    print(f'{"engine":<12}{"build (s)":>12}{"queries/s":>14}')
+    print(f'{"BM25Okapi":<12}{build_bm25:>12.3f}{args.queries / query_bm25:>14.1f}')
+    print(f'{"sparse":<12}{build_sparse:>12.3f}{args.queries / query_sparse:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
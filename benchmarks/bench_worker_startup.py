@@ -0,0 +1,108 @@
+"""
+Startup time and memory of the workers, with and without the NLP resources preloaded in the parent process.
+It forks --workers children as gunicorn does. Each child gets ready to answer (tokenizer, lemmatizer, tagger and
+langchain loaded, one question preprocessed) and reports its time to ready, then the parent reads its memory: RSS
+counts the shared pages in every process, PSS splits them between the processes that share them, so the sum of PSS is
+the memory really used. Each child also starts --cpu-workers CPU workers (execution.py) as the gunicorn workers do,
+fresh interpreters that load the resources of their tasks, and their memory is counted apart and in the total.
+
+    python benchmarks/bench_worker_startup.py --workers 12            # every worker loads its own copy
+    python benchmarks/bench_worker_startup.py --workers 12 --preload  # loaded once in the parent (gunicorn --preload)
+    python benchmarks/bench_worker_startup.py --workers 12 --preload --cpu-workers 0  # without CPU workers
+
+It needs the NLTK data (wordnet, averaged_perceptron_tagger) and the tiktoken encoding, and Linux (/proc).
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), '..', 'src'), os.path.join(os.path.dirname(__file__), '..')]
+
+from env import CPU_WORKERS  # noqa: E402
+
+QUESTION = '¿Cuáles son las principales conclusiones del capítulo sobre la evaluación de los aprendizajes?'
+
+
+def memory_kb(pid):
+    # Returns (rss, pss) in kB of the process
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+        for line in file:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:'):
+                values[parts[0][:-1]] = int(parts[1])
+    return values['Rss'], values['Pss']
+
+
+def get_ready():
+    # What a worker loads before it can answer its first question
+    from nlp_resources import preload, get_tokenizer
+    from preprocess_text import preprocess
+    preload()
+    get_tokenizer().encode(preprocess(QUESTION))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=12)
+    parser.add_argument('--preload', action='store_true', help='load the NLP resources in the parent before forking')
+    parser.add_argument('--cpu-workers', type=int, default=CPU_WORKERS, help='CPU workers of each worker')
+    args = parser.parse_args()
+
+    if args.preload:
+        start = time.perf_counter()
+        get_ready()
+        print(f'preload in the parent: {time.perf_counter() - start:.2f}s')
+
+    children = []
+    for _ in range(args.workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            start = time.perf_counter()
+            get_ready()
+            ready_time = time.perf_counter() - start
+            # The CPU workers load their resources in the background, a first task waits for them
+            from execution import CpuWorker
+            cpu_workers = [CpuWorker() for _ in range(args.cpu_workers)]
+            for cpu_worker in cpu_workers:
+                cpu_worker.call(os.getpid, (), {})
+            cpu_pids = ','.join(str(cpu_worker.process.pid) for cpu_worker in cpu_workers)
+            os.write(write_fd, f'{ready_time:.6f} {cpu_pids}'.encode())
+            os.close(write_fd)
+            signal.pause()
+            os._exit(0)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+
+    ready_times, rss, pss, cpu_pss, cpu_pids = [], [], [], [], []
+    for pid, read_fd in children:
+        ready_time, _, pids = os.read(read_fd, 4096).decode().partition(' ')
+        ready_times.append(float(ready_time))
+        cpu_pids.extend(int(cpu_pid) for cpu_pid in pids.split(',') if cpu_pid)
+        os.close(read_fd)
+    # The CPU workers stop when the socket with their worker is closed
+    for cpu_pid in cpu_pids:
+        cpu_pss.append(memory_kb(cpu_pid)[1])
+    for pid, _ in children:
+        child_rss, child_pss = memory_kb(pid)
+        rss.append(child_rss)
+        pss.append(child_pss)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    parent_rss, parent_pss = memory_kb(os.getpid())
+    print(f'{"workers":<10}{"ready (s)":>12}{"RSS (MB)":>12}{"PSS (MB)":>12}')
+    print(f'{args.workers:<10}{sum(ready_times) / len(ready_times):>12.3f}{sum(rss) / len(rss) / 1024:>12.1f}'
+          f'{sum(pss) / len(pss) / 1024:>12.1f}')
+    if cpu_pss:
+        print(f'{len(cpu_pss)} CPU workers, PSS {sum(cpu_pss) / len(cpu_pss) / 1024:.1f} MB each, '
+              f'{sum(cpu_pss) / 1024:.1f} MB in total')
+    print(f'Total PSS of parent, workers and CPU workers: {(sum(pss) + sum(cpu_pss) + parent_pss) / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
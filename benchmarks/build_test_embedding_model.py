@@ -0,0 +1,87 @@
+"""
+Builds a tiny embedding model in the format of DENSE_MODEL_PATH (model.onnx and tokenizer.json), to run the dense and
+hybrid retrievers and their benchmarks without downloading or exporting a transformer:
+
+    python benchmarks/build_test_embedding_model.py ../models/test-embeddings
+    python benchmarks/build_test_embedding_model.py ../models/test-embeddings --corpus dataset.json --dimensions 128
+
+The tokenizer is a WordPiece vocabulary trained on the sections of the dataset (the sample dataset by default) and the
+model is a random embedding table followed by a dense layer (input_ids, attention_mask -> last_hidden_state), so its
+embeddings only measure the overlap of words: use it for the plumbing and the latency, not for the quality. Needs the
+onnx and tokenizers packages.
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retrieval_eval', 'sample_questions.json')
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]']
+
+
+def corpus_texts(dataset_path):
+    # Texts of the "sections" documents and of the questions of a dataset of eval_retrieval.py
+    with open(dataset_path, 'r', encoding='utf-8') as file:
+        dataset = json.load(file)
+    texts = [section for source in dataset['documents'].values() for section in source.get('sections', [])]
+    return texts + [question['question'] for question in dataset.get('questions', [])]
+
+
+def build_tokenizer(texts, vocab_size):
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors, trainers
+
+    tokenizer = Tokenizer(models.WordPiece(unk_token='[UNK]'))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=True, strip_accents=True)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.train_from_iterator(texts, trainers.WordPieceTrainer(vocab_size=vocab_size,
+                                                                   special_tokens=SPECIAL_TOKENS))
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single='[CLS] $A [SEP]', special_tokens=[(token, tokenizer.token_to_id(token)) for token in ('[CLS]', '[SEP]')])
+    return tokenizer
+
+
+def build_model(vocab_size, dimensions, seed):
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(vocab_size, dimensions)).astype(np.float32)
+    weights = (rng.normal(size=(dimensions, dimensions)) / np.sqrt(dimensions)).astype(np.float32)
+
+    graph = helper.make_graph(
+        [helper.make_node('Gather', ['embeddings', 'input_ids'], ['token_embeddings']),
+         helper.make_node('MatMul', ['token_embeddings', 'weights'], ['projected']),
+         helper.make_node('Tanh', ['projected'], ['last_hidden_state'])],
+        'test_embeddings',
+        [helper.make_tensor_value_info('input_ids', TensorProto.INT64, ['batch', 'sequence']),
+         helper.make_tensor_value_info('attention_mask', TensorProto.INT64, ['batch', 'sequence'])],
+        [helper.make_tensor_value_info('last_hidden_state', TensorProto.FLOAT, ['batch', 'sequence', dimensions])],
+        [numpy_helper.from_array(embeddings, 'embeddings'), numpy_helper.from_array(weights, 'weights')])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help='folder of the model')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='dataset of eval_retrieval.py to train the tokenizer')
+    parser.add_argument('--vocab-size', type=int, default=8000)
+    parser.add_argument('--dimensions', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import onnx
+
+    os.makedirs(args.output, exist_ok=True)
+    tokenizer = build_tokenizer(corpus_texts(args.corpus), args.vocab_size)
+    tokenizer.save(os.path.join(args.output, 'tokenizer.json'))
+    model = build_model(tokenizer.get_vocab_size(), args.dimensions, args.seed)
+    onnx.save(model, os.path.join(args.output, 'model.onnx'))
+    print(f'{args.output}: vocabulary of {tokenizer.get_vocab_size()} tokens, {args.dimensions} dimensions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Checks that the hot queries of the application use index seeks and not table/index scans.
+It must be run against a test database migrated to head (alembic upgrade head), never against production: with
+--populate the MESSAGES table is filled with synthetic rows until it has --messages rows.
+
+    python benchmarks/check_query_plans.py --populate --messages 10000000
+
+The exit code is 1 if any hot query has a scan operator over its table.
+"""
+import os
+import sys
+import argparse
+import xml.etree.ElementTree as ET
+
+import pyodbc
+from dotenv import load_dotenv
+
+SHOWPLAN_NS = {'p': 'http://schemas.microsoft.com/sqlserver/2004/07/showplan'}
+SCAN_OPERATORS = {'Table Scan', 'Clustered Index Scan', 'Index Scan'}
+# A scan is expected (and cheap) on tables smaller than this, so it's reported but does not fail the check
+MIN_ROWS_TO_CHECK = 10000
+
+# (name, table that must not be scanned, query with literal values so the plan can be estimated with SHOWPLAN_XML)
+HOT_QUERIES = [
+    ('chat summary', 'MESSAGES', """
+    SELECT TOP 1 DATE, MESSAGE, MESSAGE_BLOB
+    FROM MESSAGES
+    WHERE CHAT_ID = 17 AND USER_ID = N'user_17' AND PDF_ID = 17 AND TYPE_OF_MESSAGE = 'S'
+    ORDER BY DATE DESC
+    """),
+    ('chat turns', 'MESSAGES', """
+    SELECT TOP (8) DATE, TYPE_OF_MESSAGE, MESSAGE, MESSAGE_BLOB
+    FROM MESSAGES
+    WHERE CHAT_ID = 17 AND USER_ID = N'user_17' AND PDF_ID = 17 AND TYPE_OF_MESSAGE IN ('P', 'L')
+    AND DATE > '1900-01-01'
+    ORDER BY DATE DESC
+    """),
+    ('user documents', 'PDFFiles', """
+    SELECT PDF_ID, FILE_NAME, IS_PROCESSED
+    FROM PDFFiles
+    WHERE USER_ID = N'user_17' AND IS_DELETED = 0
+    """),
+    ('duplicate upload', 'PDFFiles', """
+    SELECT PDF_ID
+    FROM PDFFiles
+    WHERE FILE_NAME = N'document_17.pdf' AND USER_ID = N'user_17' AND IS_DELETED = 0
+    """),
+    ('processed hash', 'PDFFiles', """
+    SELECT USER_ID, FILE_NAME, IS_PROCESSED, CONTENT_HASH
+    FROM PDFFiles
+    WHERE IS_DELETED = 0 AND USER_ID IN (N'user_17', N'user_18')
+    """),
+    ('delete sections', 'PDFSubFiles', """
+    UPDATE PDFSubFiles
+    SET IS_DELETED = 1, DELETED_DATE = GETDATE()
+    WHERE PDF_ID = 17
+    """),
+    ('archive chat', 'MESSAGES', """
+    DELETE FROM MESSAGES
+    OUTPUT DELETED.MESSAGE_ID, DELETED.USER_ID, DELETED.DATE, DELETED.TYPE_OF_MESSAGE, DELETED.MESSAGE,
+           DELETED.MESSAGE_BLOB, DELETED.PDF_ID, DELETED.NUMBER_OF_TOKENS, DELETED.CHAT_ID, DELETED.ANSWER_MODE
+    INTO MESSAGES_ARCHIVE (MESSAGE_ID, USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, MESSAGE_BLOB, PDF_ID,
+                           NUMBER_OF_TOKENS, CHAT_ID, ANSWER_MODE)
+    WHERE CHAT_ID = 17 AND USER_ID = N'user_17' AND PDF_ID = 17
+    """),
+    ('new chat id', 'CHATS', """
+    SELECT TOP 1 CHAT_ID
+    FROM CHATS
+    WHERE USER_ID = N'user_17' AND PDF_ID = 17 AND IS_CHAT_CLOSED = 0
+    ORDER BY CHAT_ID DESC
+    """),
+]
+
+
+def populate_messages(cnxn, cursor, target_rows, chats=100000):
+    """
+    Inserts synthetic messages spread over chats, users and documents until MESSAGES has target_rows rows
+    """
+    cursor.execute("SELECT COUNT_BIG(*) FROM MESSAGES")
+    missing = target_rows - cursor.fetchone()[0]
+    batch = 1000000
+    while missing > 0:
+        rows = min(batch, missing)
+        cursor.execute("""
+        INSERT INTO MESSAGES (USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID, NUMBER_OF_TOKENS, CHAT_ID)
+        SELECT TOP (?)
+            CONCAT(N'user_', n % ?),
+            DATEADD(SECOND, -n, GETDATE()),
+            CASE n % 3 WHEN 0 THEN 'F' WHEN 1 THEN 'P' ELSE 'L' END,
+            N'synthetic message',
+            n % ?,
+            10,
+            n % ?
+        FROM (SELECT ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) AS n
+              FROM sys.all_columns a CROSS JOIN sys.all_columns b CROSS JOIN sys.all_columns c) AS numbers
+        """, rows, chats, chats, chats)
+        cnxn.commit()
+        missing -= rows
+        print(f'Inserted {rows} messages, {max(missing, 0)} left')
+
+    cursor.execute("UPDATE STATISTICS MESSAGES")
+    cnxn.commit()
+
+
+def scanned_tables(plan_xml):
+    # Returns the (operator, table) pairs of the scan operators of an XML showplan
+    scans = []
+    for relop in ET.fromstring(plan_xml).iter(f'{{{SHOWPLAN_NS["p"]}}}RelOp'):
+        if relop.get('PhysicalOp') not in SCAN_OPERATORS:
+            continue
+        for obj in relop.iterfind('.//p:Object', SHOWPLAN_NS):
+            scans.append((relop.get('PhysicalOp'), obj.get('Table', '').strip('[]')))
+            break
+    return scans
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--populate', action='store_true', help='fill MESSAGES with synthetic rows first')
+    parser.add_argument('--messages', type=int, default=10000000)
+    args = parser.parse_args()
+
+    load_dotenv()
+    cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+    cursor = cnxn.cursor()
+
+    if args.populate:
+        populate_messages(cnxn, cursor, args.messages)
+
+    table_rows = {}
+    for table in {table for _, table, _ in HOT_QUERIES}:
+        cursor.execute(f"SELECT COUNT_BIG(*) FROM {table}")
+        table_rows[table] = cursor.fetchone()[0]
+
+    failed = []
+    cursor.execute("SET SHOWPLAN_XML ON")
+    try:
+        for name, table, query in HOT_QUERIES:
+            cursor.execute(query)
+            plan = cursor.fetchone()[0]
+            scans = [(operator, scanned) for operator, scanned in scanned_tables(plan) if scanned == table]
+            if not scans:
+                status = 'ok'
+            elif table_rows[table] < MIN_ROWS_TO_CHECK:
+                status = 'small'
+            else:
+                status = 'SCAN'
+                failed.append(name)
+            print(f'{name:<20}{table:<14}{table_rows[table]:>12} {status:<6}'
+                  f'{", ".join(operator for operator, _ in scans)}')
+    finally:
+        cursor.execute("SET SHOWPLAN_XML OFF")
+        cursor.close()
+        cnxn.close()
+
+    if failed:
+        print(f'Hot queries with scans: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
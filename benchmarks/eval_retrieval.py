@@ -0,0 +1,310 @@
+"""
+Offline evaluation of the retrieval of sections for the questions: quality, prompt tokens and latency of each retriever.
+
+    python benchmarks/eval_retrieval.py benchmarks/retrieval_eval/sample_questions.json
+    python benchmarks/eval_retrieval.py dataset.json --retrievers bm25 sparse --save baseline.json
+    python benchmarks/eval_retrieval.py dataset.json --baseline baseline.json --page-limit 3
+    python benchmarks/eval_retrieval.py dataset.json --retrievers sparse dense hybrid --embedding-model ../models/onnx
+
+The dataset is a JSON file with the documents and the labeled questions:
+
+    {"documents": {"manual": {"sections": ["text of the section", ...]},   sections given in the file
+                   "libro": {"pdf": "libro.pdf"},                          extracted and split with the current pipeline
+                   "otro": {"folder": "../pdf_storage/user/otro"}},        sections already processed (*.txt)
+     "questions": [{"document": "manual", "question": "...", "evidence": ["phrase of a relevant section"]},
+                   {"document": "otro", "question": "...", "sections": ["otro_3.txt"]}]}
+
+A section is relevant if its file is listed in "sections" or it contains one of the "evidence" phrases (compared in
+lower case with collapsed spaces), so the labels of the evidence still hold if the document is split differently.
+
+For each retriever it reports, over the ranking: recall@k and MRR; over the sections that reach the prompt (ratio to the
+best score > retrival_threshold, the best PAGE_LIMIT and score >= BM25_threshold, as compose_input_with_relevant_info
+does, and for the hybrid retriever the best PAGE_LIMIT with HYBRID_MIN_RATIO of the best fused score): the recall, the
+tokens per question and the questions without any section; and the latency of the retrieval of a question (p50/p95).
+With --baseline the exit code is 1 if recall@k, MRR or prompt recall drop more than --tolerance.
+Documents with less than MAX_TOKENS tokens are sent whole to the model by the questions, they are evaluated anyway but
+they are listed, the small sample dataset is one of them.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+from functools import partial
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from env import retrival_threshold, PAGE_LIMIT, BM25_threshold, MAX_TOKENS, HYBRID_MIN_RATIO  # noqa: E402
+from env import LSA_COMPONENTS, LSA_WEIGHT, LSA_CANDIDATES, DENSE_MODEL_PATH  # noqa: E402
+from dense_retrieval import EmbeddingModel, DenseIndex, HybridIndex  # noqa: E402
+from infomation_retrival_for_questions import tokenize_text, compute_bm25_similarity  # noqa: E402
+from nlp_resources import get_tokenizer  # noqa: E402
+from preprocess_text import preprocess  # noqa: E402
+from sparse_retrieval import SparseBM25Index  # noqa: E402
+
+RECALL_AT = (1, 3, 5, 10)
+SPACES_PATTERN = re.compile(r'\s+')
+QUALITY_METRICS = [f'recall@{k}' for k in RECALL_AT] + ['mrr', 'prompt_recall']
+
+
+def bm25_retriever(corpus_tokenized, filenames, texts):
+    # rank_bm25 path of get_most_relevant_docs: the BM25Okapi model is built for each question
+    def retrieve(question):
+        scores = compute_bm25_similarity(question, corpus_tokenized)
+        return [(filenames[i], float(scores[i])) for i in np.argsort(scores)[::-1]]
+    return retrieve
+
+
+def sparse_retriever(corpus_tokenized, filenames, texts, lsa_components=0):
+    # Sparse index of get_most_relevant_docs_sparse, built once per document as load_sparse_index does
+    index = SparseBM25Index(corpus_tokenized, filenames, lsa_components=lsa_components)
+
+    def retrieve(question):
+        return index.top_k(tokenize_text(question), k=len(filenames), lsa_weight=LSA_WEIGHT,
+                           lsa_candidates=LSA_CANDIDATES)
+    return retrieve
+
+
+# Embedding model of the dense and hybrid retrievers, loaded once (--embedding-model)
+_embedding_model = {'path': DENSE_MODEL_PATH, 'model': None}
+
+
+def get_embedding_model():
+    if _embedding_model['model'] is None:
+        _embedding_model['model'] = EmbeddingModel(_embedding_model['path'])
+    return _embedding_model['model']
+
+
+def dense_retriever(corpus_tokenized, filenames, texts):
+    # Embeddings of the sections only, computed once per document as load_dense_index does
+    model = get_embedding_model()
+    index = DenseIndex(model.encode(texts), filenames, model.name)
+
+    def retrieve(question):
+        return index.top_k_many(model.encode([question]), k=len(filenames))[0]
+    return retrieve
+
+
+def hybrid_retriever(corpus_tokenized, filenames, texts):
+    # RETRIEVAL_ENGINE 'hybrid': the sparse index and the embeddings fused by rank
+    model = get_embedding_model()
+    index = HybridIndex(SparseBM25Index(corpus_tokenized, filenames, lsa_components=LSA_COMPONENTS),
+                        DenseIndex(model.encode(texts), filenames, model.name))
+
+    def retrieve(question):
+        return index.top_k_many([tokenize_text(question)], model.encode([question]), k=len(filenames),
+                                lsa_weight=LSA_WEIGHT, lsa_candidates=LSA_CANDIDATES)[0]
+    return retrieve
+
+
+# Retrievers by name: each one gets the tokenized sections of a document, their names and texts, and returns a function
+# that ranks them for a question as a list of (filename, score) sorted by score
+RETRIEVERS = {
+    'bm25': bm25_retriever,
+    'sparse': sparse_retriever,
+    'sparse_lsa': partial(sparse_retriever, lsa_components=LSA_COMPONENTS or 100),
+    'dense': dense_retriever,
+    'hybrid': hybrid_retriever,
+}
+
+
+def normalize(text):
+    return SPACES_PATTERN.sub(' ', text).strip().lower()
+
+
+def split_pdf(pdf_path, work_dir):
+    # Extracts and splits the PDF with the current pipeline, without the database, and returns the folder of sections
+    from pdf_listener import extract_text_with_font_info
+    from typograph_text_spliter import segment_text
+
+    name = re.sub(r'\W+', '_', os.path.splitext(os.path.basename(pdf_path))[0])
+    folder = os.path.join(work_dir, name)
+    os.makedirs(folder, exist_ok=True)
+    segment_text(None, 0, save_to_file=True, file_path=os.path.join(folder, name),
+                 records=extract_text_with_font_info(pdf_path), subfiles=[])
+    return folder
+
+
+def load_documents(dataset, base_dir, work_dir):
+    # Returns {name: (filenames, texts)} of the documents of the dataset
+    documents = {}
+    for name, source in dataset['documents'].items():
+        if 'sections' in source:
+            filenames = [f'{name}_{i}.txt' for i in range(len(source['sections']))]
+            documents[name] = (filenames, list(source['sections']))
+            continue
+
+        if 'pdf' in source:
+            folder = split_pdf(os.path.join(base_dir, source['pdf']), work_dir)
+        else:
+            folder = os.path.join(base_dir, source['folder'])
+        filenames = sorted(filename for filename in os.listdir(folder) if filename.endswith('.txt'))
+        texts = []
+        for filename in filenames:
+            with open(os.path.join(folder, filename), 'r', encoding='utf-8') as file:
+                texts.append(file.read())
+        documents[name] = (filenames, texts)
+    return documents
+
+
+def relevant_sections(question, filenames, texts):
+    relevant = set(question.get('sections', []))
+    evidence = [normalize(phrase) for phrase in question.get('evidence', [])]
+    for filename, text in zip(filenames, texts):
+        text = normalize(text)
+        if any(phrase in text for phrase in evidence):
+            relevant.add(filename)
+    return relevant
+
+
+def select_for_prompt(ranked, threshold, page_limit, bm25_threshold, fused_ratio=None):
+    # Sections that reach the prompt: get_most_relevant_docs and then compose_input_with_relevant_info, or
+    # HybridIndex.most_relevant_many for the fused scores of the hybrid retriever
+    if fused_ratio is not None:
+        return HybridIndex.above_ratio(ranked[:page_limit], fused_ratio)
+    if not ranked or ranked[0][1] <= 0:
+        return []
+    best_score = ranked[0][1]
+    selected = [(filename, score) for filename, score in ranked if score / best_score > threshold]
+    return [(filename, score) for filename, score in selected[:page_limit] if score >= bm25_threshold]
+
+
+def evaluate(retrieve, questions, documents, section_tokens, args, fused_ratio=None):
+    hits = {k: 0 for k in RECALL_AT}
+    reciprocal_ranks, prompt_recalls, prompt_tokens, latencies = [], [], [], []
+    empty_prompts = 0
+
+    for question in questions:
+        filenames, _ = documents[question['document']]
+        relevant = question['relevant']
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            ranked = retrieve[question['document']](question['question'])
+            timings.append(time.perf_counter() - start)
+        latencies.append(float(np.median(timings)))
+
+        ranking = [filename for filename, _ in ranked]
+        first_hit = next((rank for rank, filename in enumerate(ranking, 1) if filename in relevant), None)
+        reciprocal_ranks.append(1 / first_hit if first_hit else 0.0)
+        for k in RECALL_AT:
+            hits[k] += len(relevant & set(ranking[:k])) / len(relevant)
+
+        selected = [filename for filename, _ in select_for_prompt(ranked, args.retrieval_threshold, args.page_limit,
+                                                                   args.bm25_threshold, fused_ratio)]
+        prompt_recalls.append(len(relevant & set(selected)) / len(relevant))
+        prompt_tokens.append(sum(section_tokens[question['document']][filename] for filename in selected))
+        empty_prompts += not selected
+
+    count = len(questions)
+    results = {f'recall@{k}': hits[k] / count for k in RECALL_AT}
+    results.update({
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'prompt_recall': float(np.mean(prompt_recalls)),
+        'tokens_per_question': float(np.mean(prompt_tokens)),
+        'empty_prompts': empty_prompts,
+        'latency_p50_ms': float(np.percentile(latencies, 50)) * 1000,
+        'latency_p95_ms': float(np.percentile(latencies, 95)) * 1000,
+    })
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Returns the (retriever, metric, baseline, current) quality drops greater than tolerance
+    drops = []
+    for name, metrics in results.items():
+        for metric in QUALITY_METRICS:
+            if name in baseline and metric in baseline[name] and metrics[metric] < baseline[name][metric] - tolerance:
+                drops.append((name, metric, baseline[name][metric], metrics[metric]))
+    return drops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset')
+    parser.add_argument('--retrievers', nargs='+', default=['bm25', 'sparse'], choices=sorted(RETRIEVERS))
+    parser.add_argument('--retrieval-threshold', type=float, default=retrival_threshold)
+    parser.add_argument('--page-limit', type=int, default=PAGE_LIMIT)
+    parser.add_argument('--bm25-threshold', type=float, default=BM25_threshold)
+    parser.add_argument('--hybrid-ratio', type=float, default=HYBRID_MIN_RATIO,
+                        help='fraction of the best fused score of the hybrid retriever')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each question, the median latency is used')
+    parser.add_argument('--save', help='JSON file where the results are written')
+    parser.add_argument('--baseline', help='JSON file with the results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='allowed drop of the quality metrics')
+    parser.add_argument('--embedding-model', default=DENSE_MODEL_PATH,
+                        help='folder of the ONNX model of the dense and hybrid retrievers')
+    args = parser.parse_args()
+    _embedding_model['path'] = args.embedding_model
+
+    with open(args.dataset, 'r', encoding='utf-8') as file:
+        dataset = json.load(file)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        documents = load_documents(dataset, os.path.dirname(os.path.abspath(args.dataset)), work_dir)
+
+    questions = []
+    for question in dataset['questions']:
+        filenames, texts = documents[question['document']]
+        question['relevant'] = relevant_sections(question, filenames, texts)
+        if not question['relevant']:
+            print(f"Skipping question without relevant sections: {question['question']}")
+            continue
+        questions.append(question)
+
+    # Tokens of each section in the prompt, as compose_input_with_relevant_info counts them
+    tokenizer = get_tokenizer()
+    section_tokens = {name: {filename: len(tokenizer.encode(preprocess(text) + "\n"))
+                             for filename, text in zip(filenames, texts)}
+                      for name, (filenames, texts) in documents.items()}
+    corpus_tokenized = {name: [tokenize_text(text) for text in texts] for name, (_, texts) in documents.items()}
+    print(f'{len(documents)} documents, {sum(len(f) for f, _ in documents.values())} sections, '
+          f'{len(questions)} questions')
+    small = [name for name, tokens in corpus_tokenized.items() if sum(map(len, tokens)) < MAX_TOKENS]
+    if small:
+        print(f'Sent whole without retrieval (less than {MAX_TOKENS} tokens): {", ".join(small)}')
+
+    results = {}
+    for name in args.retrievers:
+        start = time.perf_counter()
+        retrieve = {document: RETRIEVERS[name](corpus_tokenized[document], filenames, texts)
+                    for document, (filenames, texts) in documents.items()}
+        build_time = time.perf_counter() - start
+        results[name] = evaluate(retrieve, questions, documents, section_tokens, args,
+                                 args.hybrid_ratio if name == 'hybrid' else None)
+        results[name]['build_s'] = build_time
+
+    header = ''.join(f'{metric:>10}' for metric in [f'R@{k}' for k in RECALL_AT] + ['MRR', 'prompt R'])
+    print(f'{"retriever":<12}{header}{"tokens/q":>10}{"empty":>7}{"p50 ms":>9}{"p95 ms":>9}{"build s":>9}')
+    for name, metrics in results.items():
+        quality = ''.join(f'{metrics[metric]:>10.3f}' for metric in QUALITY_METRICS)
+        print(f'{name:<12}{quality}{metrics["tokens_per_question"]:>10.0f}{metrics["empty_prompts"]:>7}'
+              f'{metrics["latency_p50_ms"]:>9.2f}{metrics["latency_p95_ms"]:>9.2f}{metrics["build_s"]:>9.2f}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        for name, metrics in results.items():
+            if name in baseline:
+                print(f'{name}: tokens/q {baseline[name]["tokens_per_question"]:.0f} -> '
+                      f'{metrics["tokens_per_question"]:.0f}, p50 {baseline[name]["latency_p50_ms"]:.2f} -> '
+                      f'{metrics["latency_p50_ms"]:.2f} ms')
+        drops = compare_with_baseline(results, baseline, args.tolerance)
+        for name, metric, before, after in drops:
+            print(f'Quality drop in {name} {metric}: {before:.3f} -> {after:.3f}')
+        if drops:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
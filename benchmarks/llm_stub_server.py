@@ -0,0 +1,114 @@
+"""
+OpenAI compatible stub of POST /v1/chat/completions, to test and benchmark the LLM client without calling the API.
+It answers after --latency seconds, a fraction of the requests can be rate limited (429 with retry-after) or fail
+(500), each model can have its own latency to simulate the tiers of the routing, and GET /stats returns the number of
+requests and of TCP connections it received, so the reuse of the connections can be checked:
+
+    python benchmarks/llm_stub_server.py --port 8089 --latency 0.2 --rate-limit 0.1
+
+    python benchmarks/llm_stub_server.py --port 8089 --model-latency gpt-3.5-turbo=0.3 gpt-3.5-turbo-16k=1.2
+
+Point the application to it with LLM_API_BASE=http://localhost:8089/v1
+"""
+import json
+import time
+import random
+import argparse
+from threading import Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+stats = {'requests': 0, 'connections': 0, 'rate_limited': 0, 'errors': 0}
+stats_lock = Lock()
+
+
+def count(name):
+    with stats_lock:
+        stats[name] += 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as the OpenAI API
+    protocol_version = 'HTTP/1.1'
+    args = None
+
+    def setup(self):
+        super().setup()
+        count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            return self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+        with stats_lock:
+            self._send_json(200, dict(stats))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+        count('requests')
+        request = json.loads(body or b'{}')
+        time.sleep(self.args.model_latency.get(request.get('model'), self.args.latency))
+
+        draw = random.random()
+        if draw < self.args.rate_limit:
+            count('rate_limited')
+            return self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                                   headers={'retry-after': str(self.args.retry_after)})
+        if draw < self.args.rate_limit + self.args.errors:
+            count('errors')
+            return self._send_json(500, {'error': {'message': 'The server had an error', 'type': 'server_error'}})
+
+        messages = request.get('messages') or [{'content': ''}]
+        prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in messages)
+        content = f"Stub answer to: {str(messages[-1].get('content', ''))[:80]}"
+        completion_tokens = len(content.split())
+        self._send_json(200, {
+            'id': f'chatcmpl-stub-{stats["requests"]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds of each answer')
+    parser.add_argument('--rate-limit', type=float, default=0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='retry-after of the 429 answers')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of requests answered with 500')
+    parser.add_argument('--model-latency', nargs='*', default=[], metavar='MODEL=SECONDS',
+                        help='seconds of the answers of each model, the other models answer in --latency')
+    args = parser.parse_args()
+    args.model_latency = {model: float(seconds) for model, seconds in
+                          (model_latency.split('=', 1) for model_latency in args.model_latency)}
+
+    StubHandler.args = args
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f'LLM stub listening on http://{args.host}:{args.port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
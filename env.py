@@ -12,13 +12,123 @@ TOKENS_LIMIT = 16384  # Este es el límite de tokens del modelo
 MODEL = "gpt-3.5-turbo-16k"  # Establece el modelo a utilizar
 SIMILARITY_MODEL = 'dccuchile/bert-base-spanish-wwm-uncased'
 PAGE_LIMIT = 5  # Establece el límite de páginas del documento relacionadas con la pregunta
+RETRIEVAL_ENGINE = 'sparse'  # 'sparse' usa la matriz CSR de pesos BM25 precalculados, 'bm25' usa rank_bm25.BM25Okapi
+# y 'hybrid' combina 'sparse' con los embeddings de DENSE_MODEL_PATH
+RETRIEVAL_TOP_K = 10  # Número máximo de secciones que devuelve el motor 'sparse' (debe ser >= PAGE_LIMIT)
+LSA_COMPONENTS = 0  # Número de componentes LSA (TruncatedSVD) para reordenar las secciones, 0 lo desactiva
+LSA_WEIGHT = 0.3  # Peso de la similitud LSA en la puntuación final, mientras más alto, más sinónimos se recuperan
+LSA_CANDIDATES = 50  # Número de secciones mejor puntuadas por BM25 que se reordenan con LSA
+INDEX_CACHE_SIZE = 50  # Documentos cuyos índices se guardan en memoria en cada proceso, se descartan los menos usados
+# Carpeta local con el modelo de embeddings del motor 'hybrid': SIMILARITY_MODEL exportado a ONNX (model.onnx o
+# model_quantized.onnx) y su tokenizer.json
+DENSE_MODEL_PATH = r"../models/bert-base-spanish-onnx"
+EMBEDDING_BATCH_SIZE = 16  # Secciones por lote al calcular los embeddings en la ingesta
+EMBEDDING_MAX_LENGTH = 256  # Tokens máximos de cada sección o pregunta que se usan para su embedding
+EMBEDDING_THREADS = 1  # Hilos de onnxruntime por proceso, 0 usa todos los núcleos
+HYBRID_CANDIDATES = 50  # Secciones mejor puntuadas por BM25 y por embeddings que se combinan en el motor 'hybrid'
+RRF_K = 60  # Constante de la fusión por rango recíproco, mientras más alta, más pesan las secciones peor clasificadas
+HYBRID_MIN_RATIO = 0.5  # Fracción de la puntuación combinada de la mejor sección que necesita una sección del motor 'hybrid' para ir al prompt
+HIERARCHICAL_MIN_SECTIONS = 1000  # Secciones mínimas de un documento con capítulos (índice del PDF o títulos por tamaño
+# de letra) para puntuar primero los capítulos y buscar solo en las secciones de los mejores
+HIERARCHY_TOP_CHAPTERS = 3  # Número de capítulos mejor puntuados en los que se buscan las secciones
+HIERARCHY_MIN_CHAPTERS = 4  # Capítulos mínimos del primer nivel de títulos que se usa para agrupar las secciones
+HEADING_LEVELS = 3  # Niveles de títulos que se detectan por el tamaño de letra en los documentos sin índice
 encabezado = "Basandote en el documento proporcionado responde al siguiente mensaje. Si no puedes basar la respuesta en el texto proporcionado, proporciona una respuesta completa en Español basada en tu conocimiento. "
 encabezado_sin_info = "Responde al siguiente mensaje en Español: "
 prefix_info_phrase = 'Resume detalladamente el siguiente texto: "'
+respuesta_extractiva_sin_info = "No he encontrado en el documento información para responder a la pregunta."
+resumen_conversacion = ("Resume de forma progresiva las líneas de la conversación, añadiéndolas al resumen actual y "
+                        "devolviendo un nuevo resumen en Español de como máximo {max_tokens} tokens.\n\n"
+                        "Resumen actual:\n{summary}\n\n"
+                        "Nuevas líneas de la conversación:\n{new_lines}\n\n"
+                        "Nuevo resumen:")
+
+# Historial de la conversación
+HISTORY_SUMMARY_MAX_TOKENS = 500  # Tokens máximos del resumen acumulado de la conversación
+HISTORY_TURN_MAX_TOKENS = 400  # Tokens máximos de cada pregunta y respuesta que se incluye sin resumir en el historial
+
+# Segmentación
+EXTRACTION_ENGINE = 'auto'  # 'full' analiza la maquetación de todas las páginas, 'fast' lee el texto directamente del
+# contenido de la página y 'auto' usa 'fast' en las páginas con una maquetación sencilla (una columna, orden de lectura)
+REMOVE_BOILERPLATE = True  # Elimina cabeceras, pies de página, números de página y secciones casi duplicadas
+BOILERPLATE_MIN_PAGE_RATIO = 0.5  # Proporción de páginas en las que debe repetirse una línea para eliminarla
+BOILERPLATE_MIN_PAGES = 3  # Número mínimo de páginas en las que debe repetirse una línea para eliminarla
+NEAR_DUPLICATE_THRESHOLD = 0.9  # Similitud de Jaccard (MinHash) a partir de la cual una sección se considera duplicada
+CHUNKING_MODE = 'font'  # 'font' corta las secciones en cada cambio del tamaño de letra, 'tokens' usa esos cortes pero
+# junta las secciones pequeñas y divide las grandes para que cada sección tenga unos CHUNK_TOKENS tokens
+CHUNK_TOKENS = 400  # Tokens objetivo de cada sección en el modo 'tokens'
+CHUNK_OVERLAP = 50  # Tokens que se repiten entre las partes consecutivas de una sección dividida en el modo 'tokens'
+CHUNK_MIN_TOKENS = 50  # Tokens mínimos de una sección en el modo 'tokens', una más pequeña (un título) se junta con la siguiente
 
 # Base de datos
 MAX_RETRIES = 3  # Establece el número máximo de intentos para conectarse a la base de datos
 SLEEP_TIME = 3  # Establece el tiempo de espera entre intentos de conexión a la base de datos
+MESSAGES_WRITE_BEHIND = False  # Guarda los mensajes en segundo plano, la respuesta no espera al commit de la base de datos
+MESSAGES_HISTORY_WAIT = 5  # Segundos máximos que se espera a que se escriban los mensajes de un chat antes de leer su historial
+MESSAGES_MAX_ATTEMPTS = 3  # Intentos de escribir un lote de mensajes rechazado por la base de datos, después se mueve a
+# la carpeta failed de MESSAGES_SPOOL_DIR
+MESSAGES_SPOOL_DIR = r"../messages_spool"  # Carpeta donde se guardan los mensajes pendientes de escribir en la base de datos
+MESSAGES_BATCH_SIZE = 100  # Número máximo de lotes de mensajes que se escriben en la misma transacción
+MESSAGE_COMPRESS_TYPES = ('F',)  # Tipos de mensaje que se guardan comprimidos (gzip) en MESSAGE_BLOB si son largos
+MESSAGE_COMPRESS_CHARS = 1024  # Caracteres a partir de los que un mensaje se comprime, al guardarlo y al archivarlo
+ARCHIVE_BATCH_CHATS = 100  # Chats cerrados cuyos mensajes se mueven a MESSAGES_ARCHIVE en la misma transacción
+ARCHIVE_INTERVAL = 600  # Segundos entre las pasadas del archivador de mensajes (src/message_archive.py)
+DOCUMENT_CACHE_TTL = 300  # Segundos que se guardan en memoria los documentos de cada usuario (se invalidan al subir o borrar)
+BULK_INGEST_BATCH_SIZE = 100  # Número de documentos cuyas filas se insertan en la misma transacción en la ingesta masiva
+BULK_INGEST_TASKS_PER_WORKER = 50  # Documentos que procesa cada proceso de la ingesta masiva antes de reiniciarse (libera memoria)
+SERVER_PDF_ID_START = 1000000000  # Primer PDF_ID de la secuencia PDF_ID_SEQ (ingesta masiva y vigilante de carpetas), la
+# API rechaza los ids a partir de este valor para que no coincidan con los del servidor
+INGESTING_DIR = path_to_listen + r"/.ingesting"  # Carpeta con las marcas de los PDFs copiados que aún no están en PDFFiles
+WATCH_DEBOUNCE_SECONDS = 2  # Segundos sin cambios que espera el vigilante de carpetas antes de procesar un PDF depositado
+WATCH_WORKERS = 2  # Número de PDFs depositados en las carpetas que se procesan a la vez
+WATCH_REJECTED_DIR = path_to_listen + r"/.rejected"  # Carpeta donde el vigilante mueve los PDFs que no se han podido procesar
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024  # Tamaño máximo de un PDF subido, se rechaza en cuanto se supera
+MAX_UPLOAD_PAGES = 3000  # Número máximo de páginas de un PDF subido
+UPLOAD_TMP_DIR = path_to_listen + r"/.uploads"  # Carpeta de las subidas en curso, en el mismo disco que las carpetas de usuario
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes que se leen de la petición en cada paso al guardar una subida
+INGESTION_CANCEL_DIR = path_to_listen + r"/.cancel"  # Carpeta con las marcas de cancelación de los documentos en proceso
+TRASH_DIR = path_to_listen + r"/.trash"  # Carpeta donde se mueven los documentos borrados hasta que se eliminan en segundo plano
+RECLAIM_INTERVAL = 60  # Segundos entre las revisiones de la papelera de documentos borrados
+PRELOAD_NLP_RESOURCES = True  # Carga los tokenizadores, NLTK y langchain en el proceso maestro de gunicorn para compartirlos entre los workers
+BATCH_MAX_QUESTIONS = 50  # Número máximo de preguntas de una petición por lotes
+BATCH_QUESTION_WORKERS = 4  # Número de preguntas de un lote que se responden a la vez (llamadas simultáneas al modelo)
+DB_THREADS = 10  # Hilos nativos por worker de gunicorn para las llamadas bloqueantes a la base de datos
+CPU_WORKERS = 2  # Procesos por worker de gunicorn para la recuperación y el preprocesado de las preguntas, 0 usa hilos nativos
+CPU_TASK_TIMEOUT = 120  # Segundos máximos de una tarea en los procesos de CPU, después se reinicia el proceso
+LLM_API_BASE = None  # URL de una API compatible con OpenAI (p. ej. benchmarks/llm_stub_server.py), None usa la de OpenAI
+LLM_TIMEOUT = 120  # Segundos máximos de cada llamada al modelo
+LLM_MAX_RETRIES = 4  # Reintentos de una llamada al modelo por límite de uso, timeout o error del servidor
+LLM_BACKOFF_BASE = 1  # Segundos de espera antes del primer reintento, se duplica en cada uno (con jitter)
+LLM_BACKOFF_MAX = 30  # Segundos máximos de espera entre reintentos
+LLM_BREAKER_FAILURES = 5  # Llamadas fallidas seguidas que abren el circuito, las siguientes fallan sin llamar a la API
+LLM_BREAKER_RESET = 30  # Segundos que el circuito permanece abierto antes de probar otra llamada
+QUESTION_DEADLINE = 60  # Segundos máximos de respuesta del modelo a una pregunta, después se responde con las frases más
+# relevantes del documento (modo 'fallback'). Cada petición puede indicar el suyo, None lo desactiva
+EXTRACTIVE_SENTENCES = 3  # Número de frases de la respuesta extractiva
+EXTRACTIVE_MIN_WORDS = 4  # Palabras mínimas de una frase para que forme parte de la respuesta extractiva
+LLM_POOL_SIZE = 20  # Conexiones HTTP reutilizables con la API del modelo por proceso
+MODEL_ROUTING = True  # Elige el modelo y max_tokens de cada llamada por su tipo y los tokens del prompt, False usa MODEL
+# Modelos disponibles del más rápido y barato al más capaz, con su contexto en tokens. Cada llamada va al primero en el
+# que caben el prompt y los tokens de respuesta de su tipo
+MODEL_TIERS = [
+    {'model': 'gpt-3.5-turbo', 'context': 4096},
+    {'model': 'gpt-3.5-turbo-16k', 'context': 16384},
+]
+# Tokens máximos de respuesta por tipo de llamada: extracción de entidades de la memoria, resumen de las secciones o del
+# historial y respuesta final a la pregunta. Las respuestas no se cortan, su valor solo elige el modelo
+ROUTING_MAX_TOKENS = {'entities': 256, 'summarize': 800, 'answer': 1500}
+ROUTING_MIN_TIER = {}  # Primer modelo de MODEL_TIERS que puede usar cada tipo de llamada (p. ej. {'answer': 1}), 0 por
+# defecto
+
+# Perfiles (cProfile, formato pstats) de las peticiones con la cabecera X-Profile igual a PROFILE_KEY del .env y de una
+# muestra al azar de las peticiones y las ingestas. Solo se perfila una a la vez por proceso
+PROFILE_DIR = r"../profiles"  # Carpeta de los perfiles
+PROFILE_SAMPLE_RATE = 0  # Fracción de las peticiones que se perfilan al azar, 0 lo desactiva
+PROFILE_INGEST_SAMPLE_RATE = 0  # Fracción de las ingestas de documentos que se perfilan al azar, 0 lo desactiva
+PROFILE_MIN_SECONDS = 1  # Los perfiles al azar de menos segundos se descartan, los de X-Profile se guardan siempre
+PROFILE_MAX_FILES = 200  # Perfiles máximos en PROFILE_DIR, se borran los más antiguos
+PROFILE_MAX_MB = 200  # Megabytes máximos de los perfiles en PROFILE_DIR, se borran los más antiguos
+PROFILE_PARTS_MAX_AGE = 3600  # Segundos tras los que se borran las partes de perfiles de los procesos de CPU que no se han juntado
 
 # Spanish Stopwords
 stopwords_spanish = ['de', 'la', 'que', 'el', 'en', 'y', 'a', 'los', 'del', 'se', 'las', 'por', 'un', 'para', 'con', 'no',
@@ -0,0 +1,40 @@
+import os
+from urllib.parse import quote_plus
+
+from alembic import context
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, pool
+
+# Load environment variables
+load_dotenv()
+
+config = context.config
+
+
+def get_url():
+    # The same ODBC connection string used by the application
+    return "mssql+pyodbc:///?odbc_connect=" + quote_plus(os.getenv('cnxn_str'))
+
+
+def run_migrations_offline():
+    # Writes the SQL of the migrations instead of running them (alembic upgrade head --sql)
+    context.configure(url=get_url(), literal_binds=True, dialect_opts={"paramstyle": "named"})
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connectable = create_engine(get_url(), poolclass=pool.NullPool)
+
+    with connectable.connect() as connection:
+        context.configure(connection=connection)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
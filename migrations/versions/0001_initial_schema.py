@@ -0,0 +1,72 @@
+"""Initial schema of the BookReader database
+
+Revision ID: 0001_initial_schema
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001_initial_schema'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'USERS',
+        sa.Column('ID', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('DATE', sa.DateTime, nullable=False),
+        sa.Column('USER_ID_FROM_UI', sa.Unicode(255), nullable=False),
+        sa.UniqueConstraint('USER_ID_FROM_UI', name='UQ_USERS_USER_ID_FROM_UI'),
+    )
+
+    op.create_table(
+        'PDFFiles',
+        sa.Column('PDF_ID', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('FILE_NAME', sa.Unicode(255), nullable=False),
+        sa.Column('UPLOAD_DATE', sa.DateTime, nullable=False),
+        sa.Column('USER_ID', sa.Unicode(255), nullable=False),
+        sa.Column('IS_DELETED', sa.Boolean, nullable=False, server_default=sa.text('0')),
+        sa.Column('IS_PROCESSED', sa.Boolean, nullable=False, server_default=sa.text('0')),
+        sa.Column('DELETED_DATE', sa.DateTime, nullable=True),
+    )
+
+    op.create_table(
+        'PDFSubFiles',
+        sa.Column('ID', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('PDF_ID', sa.Integer, nullable=False),
+        sa.Column('SUBFILE_NAME', sa.Unicode(1024), nullable=False),
+        sa.Column('IS_DELETED', sa.Boolean, nullable=False, server_default=sa.text('0')),
+        sa.Column('DELETED_DATE', sa.DateTime, nullable=True),
+    )
+
+    op.create_table(
+        'CHATS',
+        sa.Column('ID', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('CHAT_ID', sa.Integer, nullable=False),
+        sa.Column('USER_ID', sa.Unicode(255), nullable=False),
+        sa.Column('PDF_ID', sa.Integer, nullable=False),
+        sa.Column('IS_CHAT_CLOSED', sa.Boolean, nullable=False, server_default=sa.text('0')),
+    )
+
+    op.create_table(
+        'MESSAGES',
+        sa.Column('MESSAGE_ID', sa.BigInteger, primary_key=True, autoincrement=True),
+        sa.Column('USER_ID', sa.Unicode(255), nullable=False),
+        sa.Column('DATE', sa.DateTime, nullable=False),
+        sa.Column('TYPE_OF_MESSAGE', sa.CHAR(1), nullable=False),
+        sa.Column('MESSAGE', sa.UnicodeText, nullable=True),
+        sa.Column('PDF_ID', sa.Integer, nullable=False),
+        sa.Column('NUMBER_OF_TOKENS', sa.Integer, nullable=True),
+        sa.Column('CHAT_ID', sa.Integer, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('MESSAGES')
+    op.drop_table('CHATS')
+    op.drop_table('PDFSubFiles')
+    op.drop_table('PDFFiles')
+    op.drop_table('USERS')
@@ -0,0 +1,52 @@
+"""Covering indexes for the hot queries
+
+Revision ID: 0002_hot_query_indexes
+Revises: 0001_initial_schema
+Create Date: 2026-10-19
+
+- MESSAGES: history of a chat (chat_history.get_chat_history), filtered by CHAT_ID, USER_ID, PDF_ID and
+  TYPE_OF_MESSAGE ordered by DATE DESC. MESSAGE (NVARCHAR(MAX)) is not included, so the index does not duplicate the
+  table: it's read with a key lookup for the TOP (n) rows only.
+- PDFFiles: documents of a user (USER_ID, IS_DELETED) and duplicate check on upload (FILE_NAME, USER_ID, IS_DELETED).
+- PDFSubFiles: sections of a document updated on delete (PDF_ID).
+- CHATS: last open chat of a user and document (utils.get_new_chat_id).
+"""
+from alembic import op
+
+revision = '0002_hot_query_indexes'
+down_revision = '0001_initial_schema'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('IX_MESSAGES_CHAT_USER_PDF_TYPE_DATE',
+                    'MESSAGES',
+                    ['CHAT_ID', 'USER_ID', 'PDF_ID', 'TYPE_OF_MESSAGE', 'DATE'],
+                    mssql_include=['NUMBER_OF_TOKENS'])
+
+    op.create_index('IX_PDFFiles_USER_DELETED',
+                    'PDFFiles',
+                    ['USER_ID', 'IS_DELETED'],
+                    mssql_include=['FILE_NAME', 'IS_PROCESSED'])
+
+    op.create_index('IX_PDFFiles_FILE_NAME_USER_DELETED',
+                    'PDFFiles',
+                    ['FILE_NAME', 'USER_ID', 'IS_DELETED'])
+
+    op.create_index('IX_PDFSubFiles_PDF_ID',
+                    'PDFSubFiles',
+                    ['PDF_ID'],
+                    mssql_include=['IS_DELETED'])
+
+    op.create_index('IX_CHATS_USER_PDF_CLOSED_CHAT',
+                    'CHATS',
+                    ['USER_ID', 'PDF_ID', 'IS_CHAT_CLOSED', 'CHAT_ID'])
+
+
+def downgrade():
+    op.drop_index('IX_CHATS_USER_PDF_CLOSED_CHAT', table_name='CHATS')
+    op.drop_index('IX_PDFSubFiles_PDF_ID', table_name='PDFSubFiles')
+    op.drop_index('IX_PDFFiles_FILE_NAME_USER_DELETED', table_name='PDFFiles')
+    op.drop_index('IX_PDFFiles_USER_DELETED', table_name='PDFFiles')
+    op.drop_index('IX_MESSAGES_CHAT_USER_PDF_TYPE_DATE', table_name='MESSAGES')
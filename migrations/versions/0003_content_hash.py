@@ -0,0 +1,30 @@
+"""Content hash of the documents
+
+Revision ID: 0003_content_hash
+Revises: 0002_hot_query_indexes
+Create Date: 2026-10-19
+
+- PDFFiles.CONTENT_HASH: sha256 of the PDF, so the bulk ingestion (bulk_ingest.py) skips the documents of a user that
+  are already processed even if they come with another name. It's NULL for the documents uploaded before.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003_content_hash'
+down_revision = '0002_hot_query_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('PDFFiles', sa.Column('CONTENT_HASH', sa.CHAR(64), nullable=True))
+
+    op.create_index('IX_PDFFiles_USER_HASH',
+                    'PDFFiles',
+                    ['USER_ID', 'CONTENT_HASH'],
+                    mssql_include=['IS_DELETED', 'IS_PROCESSED'])
+
+
+def downgrade():
+    op.drop_index('IX_PDFFiles_USER_HASH', table_name='PDFFiles')
+    op.drop_column('PDFFiles', 'CONTENT_HASH')
@@ -0,0 +1,24 @@
+"""Tokens of the sections
+
+Revision ID: 0004_section_tokens
+Revises: 0003_content_hash
+Create Date: 2026-10-19
+
+- PDFSubFiles.TOKENS: tokens of the text of each section, counted when the document is split (CHUNKING_MODE). It's
+  NULL for the XML of the extraction and for the sections of the documents processed before.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004_section_tokens'
+down_revision = '0003_content_hash'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('PDFSubFiles', sa.Column('TOKENS', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('PDFSubFiles', 'TOKENS')
@@ -0,0 +1,25 @@
+"""Mode that answered each question
+
+Revision ID: 0005_answer_mode
+Revises: 0004_section_tokens
+Create Date: 2026-10-19
+
+- MESSAGES.ANSWER_MODE: 'llm' if the model answered the question, 'extractive' if it was answered with the sentences of
+  the sections because the request asked for it (mode=extractive) and 'fallback' if the model missed the deadline of
+  the request or was unavailable. It's set in the prompt ('P') and answer ('L') rows, NULL in the rest.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005_answer_mode'
+down_revision = '0004_section_tokens'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('MESSAGES', sa.Column('ANSWER_MODE', sa.String(10), nullable=True))
+
+
+def downgrade():
+    op.drop_column('MESSAGES', 'ANSWER_MODE')
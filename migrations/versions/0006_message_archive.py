@@ -0,0 +1,47 @@
+"""Compressed payloads and archive of the messages
+
+Revision ID: 0006_message_archive
+Revises: 0005_answer_mode
+Create Date: 2026-10-19
+
+- MESSAGES.MESSAGE_BLOB: gzip of the UTF-16 text of the messages of the types MESSAGE_COMPRESS_TYPES longer than
+  MESSAGE_COMPRESS_CHARS (the 'F' rows with the sections and the summary of a question), MESSAGE is NULL in those rows.
+  It's the format of COMPRESS in SQL Server, so CAST(DECOMPRESS(MESSAGE_BLOB) AS NVARCHAR(MAX)) reads them.
+- MESSAGES_ARCHIVE: messages of the closed chats, moved out of MESSAGES by src/message_archive.py, with the date they
+  were archived. The long messages are compressed in MESSAGE_BLOB as in MESSAGES.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006_message_archive'
+down_revision = '0005_answer_mode'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('MESSAGES', sa.Column('MESSAGE_BLOB', sa.LargeBinary(), nullable=True))
+
+    op.create_table(
+        'MESSAGES_ARCHIVE',
+        sa.Column('MESSAGE_ID', sa.BigInteger, primary_key=True, autoincrement=False),
+        sa.Column('USER_ID', sa.Unicode(255), nullable=False),
+        sa.Column('DATE', sa.DateTime, nullable=False),
+        sa.Column('TYPE_OF_MESSAGE', sa.CHAR(1), nullable=False),
+        sa.Column('MESSAGE', sa.UnicodeText, nullable=True),
+        sa.Column('MESSAGE_BLOB', sa.LargeBinary(), nullable=True),
+        sa.Column('PDF_ID', sa.Integer, nullable=False),
+        sa.Column('NUMBER_OF_TOKENS', sa.Integer, nullable=True),
+        sa.Column('CHAT_ID', sa.Integer, nullable=False),
+        sa.Column('ANSWER_MODE', sa.String(10), nullable=True),
+        sa.Column('ARCHIVED_DATE', sa.DateTime, nullable=False, server_default=sa.text('GETDATE()')),
+    )
+    op.create_index('IX_MESSAGES_ARCHIVE_CHAT_USER_PDF_DATE',
+                    'MESSAGES_ARCHIVE',
+                    ['CHAT_ID', 'USER_ID', 'PDF_ID', 'DATE'])
+
+
+def downgrade():
+    op.drop_index('IX_MESSAGES_ARCHIVE_CHAT_USER_PDF_DATE', table_name='MESSAGES_ARCHIVE')
+    op.drop_table('MESSAGES_ARCHIVE')
+    op.drop_column('MESSAGES', 'MESSAGE_BLOB')
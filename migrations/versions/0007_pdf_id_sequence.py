@@ -0,0 +1,35 @@
+"""Sequence of the pdf ids given by the server
+
+Revision ID: 0007_pdf_id_sequence
+Revises: 0006_message_archive
+Create Date: 2026-10-19
+
+- PDF_ID_SEQ: pdf ids of the documents registered without an id from the client, by src/bulk_ingest.py (--directory)
+  and src/folder_watcher.py. It starts at 1000000000 (env.SERVER_PDF_ID_START), or after the highest PDF_ID already in
+  that range, and the API rejects the ids from there, so the ids of the server and the ones of the client never
+  collide. Before it the ids were MAX(PDF_ID) + 1, taken at different times by each tool.
+"""
+from alembic import op
+
+revision = '0007_pdf_id_sequence'
+down_revision = '0006_message_archive'
+branch_labels = None
+depends_on = None
+
+# Same value as env.SERVER_PDF_ID_START
+SERVER_PDF_ID_START = 1000000000
+
+
+def upgrade():
+    # CREATE SEQUENCE only takes constants, the first value is computed first
+    op.execute(f"""
+    DECLARE @start BIGINT = (SELECT ISNULL(MAX(PDF_ID), 0) + 1 FROM PDFFiles WHERE PDF_ID >= {SERVER_PDF_ID_START});
+    IF @start < {SERVER_PDF_ID_START} SET @start = {SERVER_PDF_ID_START};
+    DECLARE @sql NVARCHAR(200) = N'CREATE SEQUENCE PDF_ID_SEQ AS INT START WITH ' + CAST(@start AS NVARCHAR(20))
+        + N' INCREMENT BY 1 CACHE 50';
+    EXEC (@sql);
+    """)
+
+
+def downgrade():
+    op.execute("DROP SEQUENCE PDF_ID_SEQ")
@@ -1,16 +1,29 @@
 import os
 import re
-import time
 import json
+import time
 import shutil
 import pyodbc
+import functools
 
 from dotenv import load_dotenv
 from env import path_to_listen as path
 from env import num_msgs_to_include_in_buffer as msgs_limit
-from env import MAX_RETRIES, SLEEP_TIME
-from flask import Flask, request, abort, jsonify
-from pdf_listener import UserInputHandler, extract_and_convert_to_xml
+from env import MAX_RETRIES, SLEEP_TIME, MAX_UPLOAD_BYTES, UPLOAD_CHUNK_SIZE, BATCH_MAX_QUESTIONS, QUESTION_DEADLINE
+from env import PROFILE_INGEST_SAMPLE_RATE, SERVER_PDF_ID_START
+from batch_questions import BatchQuestionHandler
+from chat_history import get_chat_history
+from message_store import wait_for_chat_messages
+from document_metadata import document_cache
+from execution import run_blocking
+from ingestion_jobs import IngestionCancelled, cancel_checker, clear_cancel, is_cancelled, move_to_trash
+from ingestion_jobs import request_cancel, get_reclaimer, mark_ingesting, clear_ingesting
+from llm_client import CircuitOpen
+from flask import Flask, Response, request, abort, jsonify, make_response
+from profiling import is_profile_key, start_profile, profiled
+from pdf_listener import UserInputHandler, extract_and_convert_to_xml, reingest_document, save_subfile_changes
+from upload_stream import StreamingRequest, UploadWriter, write_stream, resumable_writer, resumable_offset
+from utils import file_sha256, is_chat_closed
 from werkzeug.utils import secure_filename
 from multiprocessing import Process
 
@@ -18,15 +31,18 @@ from multiprocessing import Process
 load_dotenv()
 
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.secret_key = os.getenv('BOOK_READER_API_SECRET_KEY')
 app.config['UPLOAD_FOLDER'] = path
+# Bodies bigger than the biggest PDF (plus the multipart headers) are rejected before they are read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + UPLOAD_CHUNK_SIZE
 
 
 def get_database_connection():
     # Establishes the connection with the database
     for _ in range(MAX_RETRIES):
         try:
-            cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+            cnxn = run_blocking(pyodbc.connect, os.getenv('cnxn_str'))
             return cnxn, cnxn.cursor()
         except pyodbc.OperationalError:
             print(f"Connection error. Attempt {_ + 1} of {MAX_RETRIES}")
@@ -39,6 +55,41 @@ def check_api_key(api_key):
     return api_key == os.getenv('BOOK_READER_API_SECRET_KEY')
 
 
+def profile_requested():
+    # The X-Profile header or the profile query parameter has the PROFILE_KEY of the .env file
+    return is_profile_key(request.headers.get('X-Profile') or request.args.get('profile'))
+
+
+def profile_request(stage):
+    """
+    Profiles the view when profile_requested(), and a PROFILE_SAMPLE_RATE fraction of the other requests (see
+    profiling.py). The streamed responses are profiled until the stream ends. The name of a requested profile is
+    returned in the X-Profile header of the response.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            forced = profile_requested()
+            profile = start_profile(stage, kwargs.get('user_id'), kwargs.get('pdf_id'), force=forced)
+            if profile is None:
+                return view(*args, **kwargs)
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                profile.stop()
+                raise
+            if forced:
+                response.headers['X-Profile'] = profile.name
+            if response.is_streamed:
+                response.call_on_close(profile.stop)
+            else:
+                profile.stop()
+            return response
+        return wrapper
+    return decorator
+
+
 def check_and_create_user(cnxn, cursor, user_id):
     # Check if user_id exists in the database
     cursor.execute("""
@@ -80,12 +131,70 @@ def get_pdf_id(cursor, user_id):
     return str(row.PDF_ID) if row else None
 
 
+def mark_document_deleted(cnxn, cursor, user_id, pdf_id):
+    # (FILE_NAME, IS_PROCESSED) of the document deleted, None if the user has no such document
+    cursor.execute("""
+    UPDATE PDFFiles
+    SET IS_DELETED = 1, DELETED_DATE = GETDATE()
+    OUTPUT INSERTED.FILE_NAME, INSERTED.IS_PROCESSED
+    WHERE PDF_ID = ? AND USER_ID = ? AND IS_DELETED = 0
+    """, pdf_id, user_id)
+    row = cursor.fetchone()
+    cnxn.commit()
+    return row
+
+
+def get_document_file(cursor, user_id, pdf_id):
+    # (FILE_NAME, IS_PROCESSED) of the document, None if it doesn't exist
+    cursor.execute("""
+    SELECT FILE_NAME, IS_PROCESSED
+    FROM PDFFiles
+    WHERE PDF_ID = ? AND USER_ID = ? AND IS_DELETED = 0
+    """, pdf_id, user_id)
+    return cursor.fetchone()
+
+
+def claim_document(cnxn, cursor, user_id, pdf_id):
+    # Marks a processed document as being processed, in a single statement so two editions can't both claim it
+    # :return: (FILE_NAME,) of the document, None if it doesn't exist or it's already being processed
+    cursor.execute("""
+    UPDATE PDFFiles
+    SET IS_PROCESSED = 0
+    OUTPUT INSERTED.FILE_NAME
+    WHERE PDF_ID = ? AND USER_ID = ? AND IS_DELETED = 0 AND IS_PROCESSED = 1
+    """, pdf_id, user_id)
+    row = cursor.fetchone()
+    cnxn.commit()
+    return row
+
+
+def release_document(cnxn, cursor, pdf_id):
+    # The previous edition of a claimed document is kept, it's answered again
+    cursor.execute("""
+    UPDATE PDFFiles
+    SET IS_PROCESSED = 1
+    WHERE PDF_ID = ? AND IS_DELETED = 0
+    """, pdf_id)
+    cnxn.commit()
+
+
+def previous_edition_paths(pdf_path):
+    # Copies of the PDF and of the folder of the previous edition, kept until the new edition is processed
+    return pdf_path + '.previous', os.path.splitext(pdf_path)[0] + '.previous'
+
+
+def check_client_pdf_id(pdf_id):
+    # The ids from SERVER_PDF_ID_START are given by the sequence PDF_ID_SEQ to the bulk ingestion and the folder watcher
+    if not pdf_id.isdigit() or int(pdf_id) >= SERVER_PDF_ID_START:
+        abort(400, description=f"Invalid pdf_id, it must be a number lower than {SERVER_PDF_ID_START}")
+
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() == 'pdf'
 
 
-def handle_new_pdf(cnxn, cursor, pdf_id, pdf_path, user_id):
+def handle_new_pdf(cnxn, cursor, pdf_id, pdf_path, user_id, content_hash=None):
     print(f'New file - {pdf_path}')
 
     # Replace special characters in filename
@@ -102,30 +211,46 @@ def handle_new_pdf(cnxn, cursor, pdf_id, pdf_path, user_id):
     row = cursor.fetchone()
 
     if row is None:
+        # A marker left by a previous document with the same id must not cancel this one
+        clear_cancel(pdf_id)
         try:
             # Insert new record in PDFFiles and get the inserted PDF_ID
             cursor.execute("""
-                    INSERT INTO PDFFiles (FILE_NAME, UPLOAD_DATE, USER_ID, IS_DELETED, IS_PROCESSED, PDF_ID)
+                    INSERT INTO PDFFiles (FILE_NAME, UPLOAD_DATE, USER_ID, IS_DELETED, IS_PROCESSED, PDF_ID, CONTENT_HASH)
                     OUTPUT INSERTED.PDF_ID
-                    VALUES (?, GETDATE(), ?, 0, 0, ?)
-                    """, (pdf_foldername, user_id, pdf_id))
+                    VALUES (?, GETDATE(), ?, 0, 0, ?, ?)
+                    """, (pdf_foldername, user_id, pdf_id, content_hash or file_sha256(pdf_path)))
             pdf_id = cursor.fetchone()[0]
             cnxn.commit()
+            # The folder watcher finds it in PDFFiles from now on
+            clear_ingesting(pdf_path)
 
-            # Process the uploaded file
-            extract_and_convert_to_xml(cnxn, cursor, pdf_path, pdf_id)
+            # Process the uploaded file, the delete of the document stops it between pages and sections
+            extract_and_convert_to_xml(cnxn, cursor, pdf_path, pdf_id, cancel_check=cancel_checker(pdf_id))
 
-            # Mark the file as processed in the database
+            # Mark the file as processed in the database, unless it was deleted after the last check
             cursor.execute("""
             UPDATE PDFFiles
             SET IS_PROCESSED = 1
-            WHERE PDF_ID = ?
+            WHERE PDF_ID = ? AND IS_DELETED = 0
             """, pdf_id)
+            if cursor.rowcount == 0:
+                raise IngestionCancelled(f'Document {pdf_id} deleted while it was processed')
             cnxn.commit()
 
             return 'File uploaded and processed', 200
 
         except Exception as e:
+            if isinstance(e, IngestionCancelled) or is_cancelled(pdf_id):
+                # The document was deleted while it was processed, its files are removed by the reclaimer
+                cnxn.rollback()
+                cursor.close()
+                cnxn.close()
+                move_to_trash(pdf_id, pdf_path, os.path.splitext(pdf_path)[0])
+                clear_cancel(pdf_id)
+                print(f'Processing of {pdf_path} cancelled')
+                return 'Processing cancelled', 200
+
             # Handle any database error
             cnxn.rollback()
             cursor.close()
@@ -155,44 +280,9 @@ def handle_new_pdf(cnxn, cursor, pdf_id, pdf_path, user_id):
         abort(400, description="File already exists")
 
 
-def get_last_n_messages(cursor, user_id, pdf_id, chat_id, n):
-    # Get the last n messages from the database
-    cursor.execute("""
-    SELECT TOP (?) DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID
-    FROM MESSAGES
-    WHERE CHAT_ID = ? 
-    AND USER_ID = ? 
-    AND PDF_ID = ? 
-    ORDER BY DATE DESC
-    """, n, chat_id, user_id, pdf_id)
-    rows = cursor.fetchall()
-
-    if not rows:
-        return None
-
-    inputs = []
-    answers = []
-    questions = []
-    for row in rows:
-        if row.TYPE_OF_MESSAGE == 'F':  # Message from user
-            message = json.loads(row.MESSAGE)
-            inputs.append(({"input": message["input"]}, {"output": message["output"]}))
-        elif row.TYPE_OF_MESSAGE == 'L' or row.TYPE_OF_MESSAGE == 'P':  # Reply from system
-            if row.TYPE_OF_MESSAGE == 'L':
-                answers.append(row.MESSAGE)
-            else:
-                questions.append(row.MESSAGE)
-
-        # Check if the length of the lists of questions and answers is the same
-        if len(answers) == len(questions):
-            inputs.append(({"input": questions[-1]}, {"output": answers[-1]}))
-
-    return inputs
-
-
 @app.route('/users/<user_id>/documents/<pdf_id>', methods=['POST'])
+@profile_request('upload')
 def upload_file(user_id, pdf_id):
-    file = request.files['file']
     api_key = request.headers.get('X-Api-Key')
 
     if not api_key:
@@ -202,12 +292,102 @@ def upload_file(user_id, pdf_id):
     if not check_api_key(api_key):
         abort(401, description="Invalid API key")
 
-    if not user_id or 'file' not in request.files:
-        abort(404, description="Missing required data")
+    check_client_pdf_id(pdf_id)
+    filename, writer = read_upload(user_id)
+    return save_upload(user_id, pdf_id, filename, writer)
 
-    # Check if the post request has the file part
-    if file in ['', None]:
-        abort(400, description="Missing file")
+
+@app.route('/users/<user_id>/documents/<pdf_id>', methods=['PUT'])
+@profile_request('upload')
+def upload_edition(user_id, pdf_id):
+    """
+    Replaces the PDF of a processed document with a new edition, sent as in upload_file. Only the pages that changed
+    are extracted and only the sections that changed are updated, see reingest_document.
+    """
+    if not check_api_key(request.headers.get('X-Api-Key')):
+        abort(401, description="Invalid API key")
+
+    _, writer = read_upload(user_id)
+    return save_edition(user_id, pdf_id, writer)
+
+
+def read_upload(user_id):
+    """
+    Reads the PDF of the request, once the API key is checked. A PDF sent as the body of the request is streamed to
+    disk, the file of a multipart form is written to disk by StreamingRequest while the form is parsed
+    :return: (filename, writer) of the PDF
+    """
+    if request.mimetype == 'application/pdf':
+        filename = request.headers.get('X-File-Name') or request.args.get('filename')
+        if not user_id or not filename:
+            abort(404, description="Missing required data")
+        if not allowed_file(filename):
+            abort(400, description="File extension not allowed")
+        writer = write_stream(request.stream, UploadWriter())
+    else:
+        if not user_id or 'file' not in request.files:
+            abort(404, description="Missing required data")
+
+        # Check if the post request has the file part
+        file = request.files['file']
+        if not file.filename:
+            file.stream.discard()
+            abort(400, description="Missing file")
+        if not allowed_file(file.filename):
+            file.stream.discard()
+            abort(400, description="File extension not allowed")
+        filename, writer = file.filename, file.stream
+
+    return filename, writer
+
+
+@app.route('/users/<user_id>/documents/<pdf_id>/upload', methods=['GET'])
+def get_upload_offset(user_id, pdf_id):
+    # Returns the bytes received of a resumable upload, the client continues from there
+    if not check_api_key(request.headers.get('X-Api-Key')):
+        abort(401, description="Invalid API key")
+
+    return jsonify({'status': 200, 'user_id': user_id, 'pdf_id': pdf_id, 'offset': resumable_offset(user_id, pdf_id)})
+
+
+@app.route('/users/<user_id>/documents/<pdf_id>/upload', methods=['PATCH'])
+def upload_file_chunk(user_id, pdf_id):
+    """
+    Resumable upload of big files: each request sends the next chunk of the PDF as its body, with the headers
+    Upload-Offset (bytes already sent), Upload-Length (size of the file) and X-File-Name. When the last chunk is received
+    the file is processed as in upload_file.
+    """
+    if not check_api_key(request.headers.get('X-Api-Key')):
+        abort(401, description="Invalid API key")
+
+    check_client_pdf_id(pdf_id)
+    filename = request.headers.get('X-File-Name')
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.headers['Upload-Length'])
+    except (KeyError, ValueError):
+        abort(400, description="Missing or invalid Upload-Offset and Upload-Length headers")
+    if not filename or not allowed_file(filename):
+        abort(400, description="Missing file name or file extension not allowed")
+    if length > MAX_UPLOAD_BYTES:
+        abort(413, description=f"File bigger than {MAX_UPLOAD_BYTES} bytes")
+
+    # A chunk that does not continue the received bytes is rejected, the client must ask for the offset
+    received = resumable_offset(user_id, pdf_id)
+    if offset != received:
+        return jsonify({'status': 409, 'offset': received, 'message': 'Upload-Offset does not match'}), 409
+
+    writer = write_stream(request.stream, resumable_writer(user_id, pdf_id, max_bytes=length))
+    if writer.size < length:
+        writer.close()
+        return jsonify({'status': 200, 'user_id': user_id, 'pdf_id': pdf_id, 'offset': writer.size})
+
+    return save_upload(user_id, pdf_id, filename, writer)
+
+
+def save_upload(user_id, pdf_id, filename, writer):
+    # Moves the received PDF to the folder of the user and processes it in the background
+    writer.check_pages()
 
     # Get database connection
     cnxn, cursor = get_database_connection()
@@ -217,43 +397,41 @@ def upload_file(user_id, pdf_id):
 
     try:
         # Check if user exists and create if not
-        check_and_create_user(cnxn, cursor, user_id)
+        run_blocking(check_and_create_user, cnxn, cursor, user_id)
 
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user_id)
+        filename = secure_filename(filename)
+        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], user_id)
 
-            # If the user folder does not exist, we create it
-            if not os.path.exists(user_folder):
-                os.makedirs(user_folder)
+        # If the user folder does not exist, we create it
+        if not os.path.exists(user_folder):
+            os.makedirs(user_folder)
 
-            # Save the file in the user folder by standardizing its name and replacing all special characters
-            # with underscores and constructing the complete path
-            filename = re.sub(r'\W+', '_', os.path.splitext(filename)[0]) + '.pdf'
-            filepath = os.path.join(user_folder, filename)
+        # Save the file in the user folder by standardizing its name and replacing all special characters
+        # with underscores and constructing the complete path
+        filename = re.sub(r'\W+', '_', os.path.splitext(filename)[0]) + '.pdf'
+        filepath = os.path.join(user_folder, filename)
 
-            # Save the file on the server using the main process
-            file.save(filepath)
+        # The file is moved to the user folder once it's complete, it was already written and hashed while received.
+        # The folder watcher skips it until the process registers it in PDFFiles
+        mark_ingesting(filepath)
+        writer.commit(filepath)
+        document_cache.invalidate(user_id)
 
-            # Use multiprocessing to process the file in the background
-            process = Process(target=process_file, args=(pdf_id, filepath, user_id,))
-            process.start()
+        # Use multiprocessing to process the file in the background
+        process = Process(target=process_file, args=(pdf_id, filepath, user_id, writer.content_hash,
+                                                     profile_requested(),))
+        process.start()
 
-            cursor.close()
-            cnxn.close()
+        cursor.close()
+        cnxn.close()
 
-            return jsonify({
-                'status': 200,
-                'user_id': user_id,
-                'pdf_id': pdf_id,
-                'filename': filename,
-                'message': 'File uploaded and will be processed in the background'
-            })
-        else:
-            # Close the database connection
-            cursor.close()
-            cnxn.close()
-            abort(400, description="File extension not allowed")
+        return jsonify({
+            'status': 200,
+            'user_id': user_id,
+            'pdf_id': pdf_id,
+            'filename': filename,
+            'message': 'File uploaded and will be processed in the background'
+        })
 
     except Exception as e:
         # Handle any database error
@@ -266,9 +444,13 @@ def upload_file(user_id, pdf_id):
         except pyodbc.ProgrammingError:
             pass
 
+        writer.discard()
+
         # Remove the pdf file (<user_is>/file_name.pdf) if it exists
         if filepath and os.path.exists(filepath):
             os.remove(filepath)
+        if filepath:
+            clear_ingesting(filepath)
 
         # Remove the directory (<user_is>/file_name) of the pdf if it exists using filepath without the extension
         if filepath:
@@ -279,10 +461,152 @@ def upload_file(user_id, pdf_id):
         abort(500, description=f"Error uploading file: {e}")
 
 
-def process_file(pdf_id, filepath, user_id):
+def save_edition(user_id, pdf_id, writer):
+    # Replaces the PDF of the document with the received one and updates the document in the background
+    writer.check_pages()
+
+    # The document is claimed here, not in the background, so a second edition gets its 409 at once
     cnxn, cursor = get_database_connection()
     try:
-        api_mess, ret_code = handle_new_pdf(cnxn, cursor, pdf_id, filepath, user_id)
+        row = run_blocking(claim_document, cnxn, cursor, user_id, pdf_id)
+        exists = row is not None or run_blocking(get_document_file, cursor, user_id, pdf_id) is not None
+    except pyodbc.Error as e:
+        cursor.close()
+        cnxn.close()
+        writer.discard()
+        abort(500, description=f"Internal server error - {e}")
+
+    if row is None:
+        cursor.close()
+        cnxn.close()
+        writer.discard()
+        if not exists:
+            abort(404, description="Document not found")
+        abort(409, description="The document is still being processed")
+
+    # The files of the previous edition are kept, the new edition is compared with them and they are restored if it
+    # fails
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], user_id, row[0])
+    previous_pdf, _ = previous_edition_paths(filepath)
+    try:
+        os.replace(filepath, previous_pdf)
+        writer.commit(filepath)
+    except Exception as e:
+        writer.discard()
+        if os.path.exists(previous_pdf):
+            os.replace(previous_pdf, filepath)
+        try:
+            run_blocking(release_document, cnxn, cursor, pdf_id)
+        finally:
+            cursor.close()
+            cnxn.close()
+        abort(500, description=f"Error uploading file: {e}")
+    cursor.close()
+    cnxn.close()
+    document_cache.invalidate(user_id)
+
+    process = Process(target=process_edition, args=(pdf_id, filepath, user_id, writer.content_hash,
+                                                    profile_requested(),))
+    process.start()
+
+    return jsonify({
+        'status': 200,
+        'user_id': user_id,
+        'pdf_id': pdf_id,
+        'filename': row[0],
+        'message': 'New edition uploaded and will be processed in the background'
+    })
+
+
+def handle_new_edition(cnxn, cursor, pdf_id, pdf_path, user_id, content_hash=None):
+    """
+    Processes the new edition of a document claimed by save_edition (IS_PROCESSED = 0, so it's not answered while it's
+    updated). If it fails, the files of the previous edition are restored and the document is answered with them.
+    """
+    print(f'New edition - {pdf_path}')
+    clear_cancel(pdf_id)
+
+    dirpath = os.path.splitext(pdf_path)[0]
+    previous_pdf, previous_dir = previous_edition_paths(pdf_path)
+    try:
+        # The XML, the page hashes, the sections and the indexes are updated in place
+        for stale_dir in (previous_dir, previous_dir + '.tmp'):
+            if os.path.exists(stale_dir):
+                shutil.rmtree(stale_dir)
+        if os.path.exists(dirpath):
+            # Renamed when it's complete, restore_previous_edition only uses a complete copy
+            shutil.copytree(dirpath, previous_dir + '.tmp')
+            os.replace(previous_dir + '.tmp', previous_dir)
+
+        cancel_check = cancel_checker(pdf_id)
+        result = reingest_document(pdf_path, cancel_check=cancel_check)
+        if result is None:
+            # Documents ingested before the page hashes existed are processed again from scratch
+            if os.path.exists(dirpath):
+                shutil.rmtree(dirpath)
+            subfiles = []
+            extract_and_convert_to_xml(cnxn, cursor, pdf_path, pdf_id, subfiles=subfiles, cancel_check=cancel_check)
+            # The sections are replaced in the same transaction that marks the document as processed
+            cursor.execute("""
+            UPDATE PDFSubFiles
+            SET IS_DELETED = 1
+            WHERE PDF_ID = ? AND IS_DELETED = 0
+            """, pdf_id)
+            save_subfile_changes(cnxn, cursor, pdf_id, {'added': subfiles, 'updated': [], 'removed': []})
+        else:
+            save_subfile_changes(cnxn, cursor, pdf_id, result[1])
+
+        # Mark the file as processed in the database, unless it was deleted after the last check
+        cursor.execute("""
+        UPDATE PDFFiles
+        SET IS_PROCESSED = 1, CONTENT_HASH = ?
+        WHERE PDF_ID = ? AND IS_DELETED = 0
+        """, content_hash or file_sha256(pdf_path), pdf_id)
+        if cursor.rowcount == 0:
+            raise IngestionCancelled(f'Document {pdf_id} deleted while it was processed')
+        cnxn.commit()
+        document_cache.invalidate(user_id)
+        os.remove(previous_pdf)
+        shutil.rmtree(previous_dir, ignore_errors=True)
+
+        return 'New edition processed', 200
+
+    except Exception as e:
+        cnxn.rollback()
+        if isinstance(e, IngestionCancelled) or is_cancelled(pdf_id):
+            # The document was deleted while it was processed, its files are removed by the reclaimer
+            move_to_trash(pdf_id, pdf_path, dirpath, previous_pdf, previous_dir)
+            clear_cancel(pdf_id)
+            print(f'Processing of {pdf_path} cancelled')
+            return 'Processing cancelled', 200
+
+        try:
+            restore_previous_edition(cnxn, cursor, pdf_id, pdf_path)
+            document_cache.invalidate(user_id)
+            print(f'Previous edition of {pdf_path} restored')
+        except Exception as restore_error:
+            # The document stays unprocessed until a new edition is uploaded
+            print(f'Error restoring the previous edition of {pdf_path}: {restore_error}')
+        abort(500, description=f"Error processing the new edition: {e}")
+
+
+def restore_previous_edition(cnxn, cursor, pdf_id, pdf_path):
+    # Puts back the PDF and the folder that save_edition and handle_new_edition kept, and answers the document again
+    dirpath = os.path.splitext(pdf_path)[0]
+    previous_pdf, previous_dir = previous_edition_paths(pdf_path)
+    if os.path.exists(previous_dir):
+        if os.path.exists(dirpath):
+            shutil.rmtree(dirpath)
+        os.replace(previous_dir, dirpath)
+    os.replace(previous_pdf, pdf_path)
+    release_document(cnxn, cursor, pdf_id)
+
+
+def process_edition(pdf_id, filepath, user_id, content_hash=None, profile=False):
+    cnxn, cursor = get_database_connection()
+    try:
+        with profiled('edition', user_id, pdf_id, force=profile, sample_rate=PROFILE_INGEST_SAMPLE_RATE):
+            api_mess, ret_code = handle_new_edition(cnxn, cursor, pdf_id, filepath, user_id, content_hash)
         if ret_code != 200:
             abort(ret_code, description=api_mess)
     finally:
@@ -296,7 +620,28 @@ def process_file(pdf_id, filepath, user_id):
             pass
 
 
+def process_file(pdf_id, filepath, user_id, content_hash=None, profile=False):
+    cnxn, cursor = get_database_connection()
+    try:
+        # The ingestion is profiled when the upload requested it, or at random with PROFILE_INGEST_SAMPLE_RATE
+        with profiled('ingest', user_id, pdf_id, force=profile, sample_rate=PROFILE_INGEST_SAMPLE_RATE):
+            api_mess, ret_code = handle_new_pdf(cnxn, cursor, pdf_id, filepath, user_id, content_hash)
+        if ret_code != 200:
+            abort(ret_code, description=api_mess)
+    finally:
+        clear_ingesting(filepath)
+        try:
+            cursor.close()
+        except pyodbc.ProgrammingError:
+            pass
+        try:
+            cnxn.close()
+        except pyodbc.ProgrammingError:
+            pass
+
+
 @app.route('/users/<user_id>/documents/<pdf_id>/chats/<chat_id>/question', methods=['POST'])
+@profile_request('question')
 def get_document_and_question(user_id, pdf_id, chat_id):
     print('New request for document and question')
     data = request.get_json()
@@ -307,6 +652,11 @@ def get_document_and_question(user_id, pdf_id, chat_id):
     # Retrieve the question from the request
     question = data.get('question')
 
+    # 'llm' (default) or 'extractive' (the sentences of the document, without calling the model), in the body or in the
+    # query string, and the seconds the model has to answer before the extractive answer is returned
+    mode = request.args.get('mode') or data.get('mode') or 'llm'
+    deadline = request.args.get('deadline') or data.get('deadline', QUESTION_DEADLINE)
+
     # Retrieve the API key from the request
     api_key = request.headers.get('X-Api-Key')
 
@@ -323,10 +673,6 @@ def get_document_and_question(user_id, pdf_id, chat_id):
     if not check_api_key(api_key):
         abort(401, description="Invalid API key")
 
-    # Validate the user
-    if user_id not in os.listdir(path):
-        abort(400, description="Invalid the user_id does not exist on the server")
-
     # Validate pdf_id
     if not pdf_id:
         abort(400, description="Invalid pdf_id")
@@ -335,82 +681,74 @@ def get_document_and_question(user_id, pdf_id, chat_id):
     if not chat_id:
         abort(400, description="Invalid chat_id")
 
+    # Validate the question
+    if not question:
+        abort(400, description="Missing pdf_id or question")
+
+    # Validate the mode and the deadline
+    if mode not in ('llm', 'extractive'):
+        abort(400, description="Invalid mode, it must be 'llm' or 'extractive'")
+    if deadline is not None:
+        try:
+            deadline = float(deadline)
+        except (TypeError, ValueError):
+            abort(400, description="Invalid deadline")
+        if deadline <= 0:
+            abort(400, description="Invalid deadline")
+
     # Get the database connection
     cnxn, cursor = get_database_connection()
 
+    # Validate the user and the document with the cached metadata of the documents of the user
     try:
-        # Check if the document exists in the database and has been processed correctly
-        cursor.execute("""
-        SELECT PDF_ID
-        FROM PDFFiles
-        WHERE PDF_ID = ? 
-        AND IS_DELETED = 0
-        AND IS_PROCESSED = 1
-        """, pdf_id)
-        row = cursor.fetchone()
-
-        # Return a 202 if the document has not been processed yet
-        if row is None:
-            return jsonify({
-                'status': 202,
-                'user_id': user_id,
-                'pdf_id': pdf_id,
-                'chat_id': chat_id,
-                'message': 'Document is not processed yet'
-            })
-
-        # Retrieve the filename of the document from the database using pdf_id
-        cursor.execute("""
-        SELECT FILE_NAME
-        FROM PDFFiles
-        WHERE PDF_ID = ? AND IS_DELETED = 0
-        """, pdf_id)
-        row = cursor.fetchone()
-
-        if row is None:
-            cursor.close()
-            cnxn.close()
-            abort(400, description="Invalid pdf_id")
+        documents, document = document_cache.get_document(cursor, user_id, pdf_id)
+        chat_closed = document is not None and run_blocking(is_chat_closed, cursor, user_id, pdf_id, chat_id)
+    except pyodbc.Error as e:
+        cursor.close()
+        cnxn.close()
+        abort(500, description=f"Internal server error - {e}")
 
-        # Retrieve the dictionary of documents belonging to the user from the database
-        cursor.execute("""
-        SELECT PDF_ID, FILE_NAME
-        FROM PDFFiles
-        WHERE IS_DELETED = 0 AND USER_ID = ?
-        """, user_id)
+    if documents is None:
+        cursor.close()
+        cnxn.close()
+        abort(400, description="Invalid the user_id does not exist on the server")
 
-        rows = cursor.fetchall()
+    if document is None:
+        cursor.close()
+        cnxn.close()
+        abort(400, description="Invalid pdf_id")
 
-        pdf_slides = {}
-        for row in rows:
-            pdf_slides[str(row.PDF_ID)] = os.path.splitext(row.FILE_NAME)[0]
+    # Return a 202 if the document has not been processed yet
+    if not document['is_processed']:
+        cursor.close()
+        cnxn.close()
+        return jsonify({
+            'status': 202,
+            'user_id': user_id,
+            'pdf_id': pdf_id,
+            'chat_id': chat_id,
+            'message': 'Document is not processed yet'
+        })
 
-        # Validate the document and the question
-        if not pdf_id or not question:
-            cursor.close()
-            cnxn.close()
-            abort(400, description="Missing pdf_id or question")
+    # The messages of the closed chats are archived, a question would be answered without its history
+    if chat_closed:
+        cursor.close()
+        cnxn.close()
+        abort(409, description="The chat is closed")
 
-        # Validate that the document is in the dictionary
-        if pdf_id not in pdf_slides:
-            cursor.close()
-            cnxn.close()
-            abort(400, description="Invalid pdf_id")
+    # Dictionary of the documents belonging to the user
+    pdf_slides = {doc_id: os.path.splitext(doc['filename'])[0] for doc_id, doc in documents.items()}
 
-        inputs = get_last_n_messages(cursor, user_id, pdf_id, chat_id, msgs_limit*2)
-        if inputs:
-            user_input_handler = UserInputHandler(cnxn,
-                                                  cursor,
-                                                  app.config['UPLOAD_FOLDER'],
-                                                  chat_id,
-                                                  user_id,
-                                                  inputs,)
-        else:
-            user_input_handler = UserInputHandler(cnxn,
-                                                  cursor,
-                                                  app.config['UPLOAD_FOLDER'],
-                                                  chat_id,
-                                                  user_id)
+    try:
+        # Load the summary of the chat and its last turns, with the previous question written
+        wait_for_chat_messages(user_id, pdf_id, chat_id)
+        history = run_blocking(get_chat_history, cursor, user_id, pdf_id, chat_id, msgs_limit)
+        user_input_handler = UserInputHandler(cnxn,
+                                              cursor,
+                                              app.config['UPLOAD_FOLDER'],
+                                              chat_id,
+                                              user_id,
+                                              history=history)
 
         # Add the chat_id and the state of the chat
         user_input_handler.add_chat_id(chat_id=chat_id)
@@ -419,7 +757,7 @@ def get_document_and_question(user_id, pdf_id, chat_id):
         user_input_handler.add_pdf(pdf_id=pdf_id, pdfs_path=pdf_slides)
 
         # Add the question to the queue
-        user_input_handler.add_question(question=question)
+        user_input_handler.add_question(question=question, mode=mode, deadline=deadline)
 
         # Wait for the answer (this line will block until there is an available answer)
         answer = user_input_handler.get_next_answer()
@@ -428,14 +766,22 @@ def get_document_and_question(user_id, pdf_id, chat_id):
         cursor.close()
         cnxn.close()
 
-        return jsonify({
-                'status': 200,
-                'user_id': user_id,
-                'pdf_id': pdf_id,
-                'chat_id': chat_id,
-                'Question': question,
-                'Answer': answer
-            })
+        response = {
+            'status': 200,
+            'user_id': user_id,
+            'pdf_id': pdf_id,
+            'chat_id': chat_id,
+            'Question': question,
+            'Answer': answer,
+            'Mode': user_input_handler.answer_mode,
+        }
+        # The extractive answers cite the sections and pages of their sentences
+        if user_input_handler.citations is not None:
+            response['Citations'] = user_input_handler.citations
+        # Chapter paths (titles of the outline or the headings) of the sections the answer is based on
+        if user_input_handler.chapters:
+            response['Chapters'] = user_input_handler.chapters
+        return jsonify(response)
 
     except Exception as e:
         try:
@@ -446,9 +792,128 @@ def get_document_and_question(user_id, pdf_id, chat_id):
             cnxn.close()
         except pyodbc.ProgrammingError:
             pass
+        if isinstance(e, CircuitOpen):
+            abort(503, description=f"Service unavailable - {e}")
         abort(500, description=f"Internal server error - {e}")
 
 
+@app.route('/users/<user_id>/documents/<pdf_id>/chats/<chat_id>/questions', methods=['POST'])
+@profile_request('questions')
+def get_document_and_questions(user_id, pdf_id, chat_id):
+    """
+    Answers a list of questions about the document. The answers are streamed as JSON lines, in the order they finish,
+    each one with the position of its question in the list.
+    """
+    print('New request for document and questions')
+    data = request.get_json()
+
+    if not data:
+        abort(400, description="Missing required data")
+
+    questions = data.get('questions')
+    # The same mode and deadline as a single question, the deadline is the one of the whole batch
+    mode = request.args.get('mode') or data.get('mode') or 'llm'
+    deadline = request.args.get('deadline') or data.get('deadline', QUESTION_DEADLINE)
+
+    api_key = request.headers.get('X-Api-Key')
+    if not api_key:
+        abort(401, description="Missing API key")
+
+    if not check_api_key(api_key):
+        abort(401, description="Invalid API key")
+
+    if not pdf_id:
+        abort(400, description="Invalid pdf_id")
+
+    if not chat_id:
+        abort(400, description="Invalid chat_id")
+
+    if not questions or not isinstance(questions, list) or not all(isinstance(q, str) and q for q in questions):
+        abort(400, description="Missing questions, a list of questions is expected")
+
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        abort(400, description=f"Too many questions, the limit is {BATCH_MAX_QUESTIONS}")
+
+    if mode not in ('llm', 'extractive'):
+        abort(400, description="Invalid mode, it must be 'llm' or 'extractive'")
+    if deadline is not None:
+        try:
+            deadline = float(deadline)
+        except (TypeError, ValueError):
+            abort(400, description="Invalid deadline")
+        if deadline <= 0:
+            abort(400, description="Invalid deadline")
+
+    print(f'questions - {len(questions)}')
+    print(f'document - {pdf_id}')
+    print(f'user - {user_id}')
+    print(f'chat - {chat_id}')
+
+    cnxn, cursor = get_database_connection()
+    try:
+        documents, document = document_cache.get_document(cursor, user_id, pdf_id)
+        if documents is None:
+            abort(400, description="Invalid the user_id does not exist on the server")
+        if document is None:
+            abort(400, description="Invalid pdf_id")
+
+        # Return a 202 if the document has not been processed yet
+        if not document['is_processed']:
+            return jsonify({
+                'status': 202,
+                'user_id': user_id,
+                'pdf_id': pdf_id,
+                'chat_id': chat_id,
+                'message': 'Document is not processed yet'
+            })
+
+        # The messages of the closed chats are archived, the questions would be answered without their history
+        if run_blocking(is_chat_closed, cursor, user_id, pdf_id, chat_id):
+            abort(409, description="The chat is closed")
+
+        # The history is loaded once for all the questions, the answers don't need the connection
+        wait_for_chat_messages(user_id, pdf_id, chat_id)
+        history = run_blocking(get_chat_history, cursor, user_id, pdf_id, chat_id, msgs_limit)
+    except pyodbc.Error as e:
+        abort(500, description=f"Internal server error - {e}")
+    finally:
+        cursor.close()
+        cnxn.close()
+
+    handler = BatchQuestionHandler(app.config['UPLOAD_FOLDER'], user_id, pdf_id, chat_id,
+                                   os.path.splitext(document['filename'])[0], history=history, mode=mode,
+                                   deadline=deadline)
+    try:
+        # The sections are retrieved before the response starts, so its status reflects the errors of the document
+        handler.prepare(questions)
+    except Exception as e:
+        abort(500, description=f"Internal server error - {e}")
+
+    def generate():
+        for position, question, result, error in handler.answers():
+            line = {
+                'status': 200,
+                'user_id': user_id,
+                'pdf_id': pdf_id,
+                'chat_id': chat_id,
+                'index': position,
+                'Question': question,
+            }
+            if isinstance(error, CircuitOpen):
+                line.update(status=503, message=f"Service unavailable - {error}")
+            elif error:
+                line.update(status=500, message=f"Internal server error - {error}")
+            else:
+                line.update(Answer=result.answer, Mode=result.mode)
+                if result.citations is not None:
+                    line['Citations'] = result.citations
+                if result.chapters:
+                    line['Chapters'] = result.chapters
+            yield json.dumps(line) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 @app.route('/users/<user_id>/documents', methods=['GET'])
 def get_user_documents(user_id):
     # Obtain the API key from the query parameters
@@ -458,58 +923,35 @@ def get_user_documents(user_id):
     if not check_api_key(api_key):
         abort(401, description="Invalid API key")  # Unauthorized
 
-    # Get the database connection
-    cnxn, cursor = get_database_connection()
+    # The documents are read from the cache, the database is only used when the entry of the user is not valid
+    hit, documents = document_cache.lookup(user_id)
 
-    try:
-        # Verify if the user exists in the database
-        cursor.execute("""
-        SELECT USER_ID_FROM_UI
-        FROM USERS
-        WHERE USER_ID_FROM_UI = ?
-        """, (user_id,))
-        row = cursor.fetchone()
-
-        # If the user does not exist, return an error message
-        if row is None:
-            cursor.close()
-            cnxn.close()
-            abort(404, description="User not found")
+    if not hit:
+        # Get the database connection
+        cnxn, cursor = get_database_connection()
 
-        # Retrieve the list of documents for the user
-        cursor.execute("""
-        SELECT PDF_ID, FILE_NAME, IS_PROCESSED
-        FROM PDFFiles
-        WHERE USER_ID = ? AND IS_DELETED = 0
-        """, user_id)
-        rows = cursor.fetchall()
-
-        # If there are no documents, return an error message
-        if not rows:
-            cursor.close()
-            cnxn.close()
-            documents = []
-        else:
-            # Create a list of dictionaries with the data of the documents
-            documents = [{"id": str(row.PDF_ID), "filename": row.FILE_NAME, "isReady": True if int(row.IS_PROCESSED) == 1 else False} for row in rows]
+        try:
+            # Verify if the user exists and retrieve the list of documents for the user in a single query
+            documents = document_cache.get(cursor, user_id, refresh=True)
+        except Exception as e:
+            abort(500, description=f"Internal server error - {e}")
+        finally:
+            try:
+                cursor.close()
+            except pyodbc.ProgrammingError:
+                pass
+            try:
+                cnxn.close()
+            except pyodbc.ProgrammingError:
+                pass
 
-            # Close the database connection
-            cursor.close()
-            cnxn.close()
+    # If the user does not exist, return an error message
+    if documents is None:
+        abort(404, description="User not found")
 
-        # Return the list of documents in JSON format
-        return jsonify(documents)
-
-    except Exception as e:
-        try:
-            cursor.close()
-        except pyodbc.ProgrammingError:
-            pass
-        try:
-            cnxn.close()
-        except pyodbc.ProgrammingError:
-            pass
-        abort(500, description=f"Internal server error - {e}")
+    # Return the list of documents in JSON format
+    return jsonify([{"id": doc_id, "filename": doc['filename'], "isReady": doc['is_processed']}
+                    for doc_id, doc in documents.items()])
 
 
 @app.route('/users/<user_id>/documents/<pdf_id>', methods=['DELETE'])
@@ -537,122 +979,53 @@ def delete_file(user_id, pdf_id):
     cnxn, cursor = get_database_connection()
 
     try:
-        # Obtain the filename from the database using the file_id in a select
-        cursor.execute("""
-        SELECT FILE_NAME, IS_PROCESSED
-        FROM PDFFiles
-        WHERE PDF_ID = ?
-        """, pdf_id)
-        row = cursor.fetchone()
-        filename = None
-
-        # Control that the file has finished processing
-        if row.IS_PROCESSED == 0:
-            # If the file has not yet been processed, we send a 202 so that the client can retry later
-            cursor.close()
-            cnxn.close()
-            return jsonify({
-                'status': 202,
-                'user_id': user_id,
-                'pdf_id': pdf_id,
-                'message': 'Document is not processed yet'
-            })
-
-        if row:
-            filename = row.FILE_NAME
-        else:
-            cursor.close()
-            cnxn.close()
-            abort(404, description="File ID not found in database")
-
-        if not filename:
+        # Mark the file as deleted and obtain its filename in a single statement
+        row = run_blocking(mark_document_deleted, cnxn, cursor, user_id, pdf_id)
+    except Exception as e:
+        try:
+            cnxn.rollback()
             cursor.close()
             cnxn.close()
-            abort(404, description="Missing filename in database with this PDF_ID")
-
-        user_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
-        filepath = os.path.join(user_folder, filename)
-
-        # Proceed to delete the file, its folder, and its record in the database
-        folder_path = os.path.join(user_folder, re.sub(r'\W+', '_', os.path.splitext(filename)[0]))
+        except pyodbc.ProgrammingError:
+            pass
+        abort(500, description=f"Internal server error - {e}")
 
-        if os.path.exists(folder_path):
-            try:
-                # Check that the file exists before attempting to delete it
-                if os.path.exists(filepath):
-                    # Delete the file
-                    os.remove(filepath)
-                else:
-                    cnxn.rollback()
-                    cursor.close()
-                    cnxn.close()
-                    abort(404, description="File pdf not found in Server")
-
-                # Only delete the folder if the database updates were successful
-                shutil.rmtree(folder_path)
-
-                # Check if the user folder is empty
-                if not os.listdir(user_folder):
-                    # Execute a query to mark the file as deleted
-                    cursor.execute("""
-                    UPDATE PDFFiles
-                    SET IS_DELETED = 1, DELETED_DATE = GETDATE()
-                    WHERE PDF_ID = ?;
-                    """, pdf_id)
-                    cnxn.commit()
-
-                    # Execute a query to mark the subfiles as deleted
-                    cursor.execute("""
-                    UPDATE PDFSubFiles
-                    SET IS_DELETED = 1, DELETED_DATE = GETDATE()
-                    WHERE PDF_ID = ?;
-                    """, pdf_id)
-                    cnxn.commit()
-                else:
-                    cursor.close()
-                    cnxn.close()
-                    abort(500, description="User folder isnot empty, something is wrong deleting the pdf's file and folder")
-
-            except Exception as e:
-                # If something goes wrong, revert the database operations
-                cnxn.rollback()
+    cursor.close()
+    cnxn.close()
 
-                # Close the database connection
-                cursor.close()
-                cnxn.close()
+    if row is None:
+        abort(404, description="File ID not found in database")
 
-                abort(500, description=f"Error deleting file and subfiles in database or server: {e}")
-        else:
-            # Close the database connection
-            cursor.close()
-            cnxn.close()
+    filename = row.FILE_NAME
+    document_cache.invalidate(user_id)
 
-            abort(404, description="File folder not found in Server")
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
+    filepath = os.path.join(user_folder, filename)
+    folder_path = os.path.join(user_folder, re.sub(r'\W+', '_', os.path.splitext(filename)[0]))
 
-        # Close the database connection
-        cursor.close()
-        cnxn.close()
+    message = 'File deleted, its files will be removed in the background'
+    if int(row.IS_PROCESSED) == 0:
+        # The process that ingests the document stops at the next page or section, the files it writes after this
+        # point are moved to the trash when it stops
+        request_cancel(pdf_id)
+        message = 'Document processing cancelled, its files will be removed in the background'
 
-        return jsonify({
-            'status': 200,
-            'user_id': user_id,
-            'pdf_id': pdf_id,
-            'filename': filename,
-            'message': 'File and folder deleted'
-        })
+    # Moving the files is a rename, they are removed and the subfiles marked as deleted by the reclaimer
+    try:
+        move_to_trash(pdf_id, filepath, folder_path)
+    except OSError as e:
+        print(f"Error moving the files of the document {pdf_id} to the trash: {e}")
+    get_reclaimer().wake()
 
-    except Exception as e:
-        # Close the database connection
-        try:
-            cursor.close()
-        except pyodbc.ProgrammingError:
-            pass
-        try:
-            cnxn.close()
-        except pyodbc.ProgrammingError:
-            pass
-        abort(500, description=f"Internal server error - {e}")
+    return jsonify({
+        'status': 200,
+        'user_id': user_id,
+        'pdf_id': pdf_id,
+        'filename': filename,
+        'message': message
+    })
 
 
 if __name__ == "__main__":
+    get_reclaimer()
     app.run(host='0.0.0.0', port=5000)  # Start running your server on port 5000
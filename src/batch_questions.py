@@ -0,0 +1,163 @@
+import os
+import time
+from threading import Lock
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from chatgpt_responses import create_conversation_chain
+from env import num_msgs_to_include_in_buffer, BATCH_QUESTION_WORKERS, QUESTION_DEADLINE
+from execution import run_cpu, run_with_deadline
+from llm_client import get_llm_client
+from message_store import MessageBatch, save_messages_async
+from nlp_resources import get_tokenizer
+from pdf_listener import prepare_context, prepare_extractive_answer, answer_question
+from section_tree import chapter_paths
+
+# Answer of a question of the batch. conversation is None in the extractive answers, which have citations instead
+BatchAnswer = namedtuple('BatchAnswer', ['conversation', 'messages', 'prompt', 'answer', 'mode', 'citations',
+                                         'chapters'])
+
+
+class SharedSummaries:
+    """
+    Summaries of the prompts of sections shared by the questions of a batch. The first question that needs a prompt
+    sends it to its conversation; the questions that retrieved the same sections wait for that summary and add it to
+    their memory without calling the model again.
+    """
+
+    def __init__(self):
+        self._summaries = {}
+        self._lock = Lock()
+
+    def summarize(self, conversation, msg):
+        with self._lock:
+            future = self._summaries.get(msg)
+            owner = future is None
+            if owner:
+                future = self._summaries[msg] = Future()
+
+        if not owner:
+            summary = future.result()
+            conversation.memory.save_context({"input": msg}, {"output": summary})
+            return summary
+
+        try:
+            summary = conversation.predict(input=msg)
+        except BaseException as e:
+            # Also when the question is killed at its deadline, so the ones waiting for the summary don't hang
+            future.set_exception(e)
+            raise
+        future.set_result(summary)
+        return summary
+
+
+class BatchQuestionHandler:
+    """
+    Answers several questions about one document of a chat. The sections (or the sparse index) and the history of the
+    chat are loaded once, the questions are retrieved together and answered concurrently, each one with its own
+    conversation built from the same history, so the answers don't depend on each other.
+    Like a single question, the batch is answered by the model ('llm') or with the sentences of the document
+    ('extractive'), and the questions the model doesn't answer before the deadline of the batch get the extractive
+    answer ('fallback').
+    """
+
+    def __init__(self, path, user_id, pdf_id, chat_id, pdf_foldername, history=None, mode='llm',
+                 deadline=QUESTION_DEADLINE):
+        self.main_path = os.path.join(path, str(user_id))
+        self.user_id = user_id
+        self.pdf_id = pdf_id
+        self.chat_id = chat_id
+        self.pdf_foldername = pdf_foldername
+        self.history = history
+        self.mode = mode
+        self.deadline = deadline
+        self.tokenizer = get_tokenizer()
+        self.memory_inputs = history.memory_inputs(self.tokenizer) if history is not None else []
+        self.summaries = SharedSummaries()
+        self.questions = []
+        # Contexts of the questions for the model, see prepare_context
+        self.contexts = []
+        self.start = None
+
+    def prepare(self, questions):
+        """
+        Retrieves the sections of all the questions in a single task of a CPU worker. It's called before the answers
+        are streamed, so an error loading the document is answered with its status instead of inside the stream.
+        """
+        self.start = time.perf_counter()
+        self.questions = questions
+        if self.mode == 'extractive':
+            self.contexts = [None] * len(questions)
+        else:
+            self.contexts = run_cpu(prepare_context, self.pdf_foldername, self.user_id, self.main_path, questions)
+
+    def _answer(self, question, context):
+        if self.mode == 'extractive':
+            return self._extractive_answer(question, 'extractive')
+
+        conversation = create_conversation_chain(inputs=self.memory_inputs, num_msgs=num_msgs_to_include_in_buffer)
+        messages = MessageBatch(self.user_id, self.pdf_id, self.chat_id)
+        # The deadline is the one of the whole batch, the questions are answered at the same time
+        deadline = None if self.deadline is None else max(self.deadline - (time.perf_counter() - self.start), 0)
+        try:
+            prompt, response = run_with_deadline(deadline, answer_question, conversation, self.tokenizer, question,
+                                                 context, messages,
+                                                 summarize=lambda msg: self.summaries.summarize(conversation, msg))
+        except Exception as e:
+            if not isinstance(e, TimeoutError) and not get_llm_client().unavailable(e):
+                raise
+            print(f"The model did not answer in time ({type(e).__name__}: {e}), answering with the document sentences")
+            return self._extractive_answer(question, 'fallback')
+        return BatchAnswer(conversation, messages, prompt, response, 'llm', None, context[3])
+
+    def _extractive_answer(self, question, mode):
+        answer, citations = run_cpu(prepare_extractive_answer, self.pdf_foldername, self.user_id, self.main_path,
+                                    question)
+        chapters = chapter_paths({citation['section']: citation.get('chapter') for citation in citations},
+                                 [citation['section'] for citation in citations])
+        return BatchAnswer(None, MessageBatch(self.user_id, self.pdf_id, self.chat_id), question, answer, mode,
+                           citations, chapters)
+
+    def answers(self, workers=BATCH_QUESTION_WORKERS):
+        """
+        Yields (position, question, BatchAnswer, exception) of the prepared questions as each one is answered. The
+        messages of the answered questions are saved in the order of the questions when the batch ends, even if it's
+        not consumed to the end.
+        """
+        results = [None] * len(self.questions)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {executor.submit(self._answer, question, context): position
+                       for position, (question, context) in enumerate(zip(self.questions, self.contexts))}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    results[position] = future.result()
+                except Exception as e:
+                    print(f"Error answering the question {position} of the batch: {e}")
+                    yield position, self.questions[position], None, e
+                    continue
+                yield position, self.questions[position], results[position], None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._save([result for result in results if result is not None])
+
+    def _save(self, results):
+        # Messages are dated again in the order of the questions, so each question is followed by its answer
+        if not results:
+            return
+        messages = MessageBatch(self.user_id, self.pdf_id, self.chat_id)
+        for result in results:
+            for row in result.messages.rows:
+                messages.add(row.type_of_message, row.message, row.number_of_tokens, answer_mode=row.answer_mode)
+            messages.add('P', result.prompt, len(self.tokenizer.encode(result.prompt)), answer_mode=result.mode)
+            messages.add('L', result.answer, len(self.tokenizer.encode(result.answer)), answer_mode=result.mode)
+            if self.history is not None:
+                self.history.add_turn(messages.rows[-1].date, result.prompt, result.answer)
+        save_messages_async(messages)
+
+        # Fold the turns that are out of the buffer into the summary of the chat, once for the whole batch, with the
+        # model of a question it answered (the extractive turns are summarized with the next one)
+        conversations = [result.conversation for result in results if result.conversation is not None]
+        if self.history is not None and conversations:
+            self.history.compact_in_background(conversations[0].llm, self.tokenizer)
@@ -0,0 +1,105 @@
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from nlp_resources import get_tokenizer
+
+DIGITS_PATTERN = re.compile(r'\d+')
+SPACES_PATTERN = re.compile(r'\s+')
+WORD_PATTERN = re.compile(r'\w+')
+
+# Large prime for the MinHash permutations (a * x + b) % MERSENNE_PRIME
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+def count_tokens(text):
+    return len(get_tokenizer().encode(text))
+
+
+def normalize_line(text):
+    """
+    Normalizes a line to compare it between pages: lower case, collapsed spaces and every number replaced by '#',
+    so 'Página 12 de 300' and 'Página 13 de 300' are the same line
+    """
+    text = DIGITS_PATTERN.sub('#', text.lower())
+    return SPACES_PATTERN.sub(' ', text).strip()
+
+
+def find_repeated_lines(lines, min_page_ratio=0.5, min_pages=3, position_step=0.02):
+    """
+    Finds the running headers, footers, page numbers and copyright lines of a document.
+    :param lines: List of (text, page, y) tuples, y is the vertical position of the line relative to the page height
+    :param min_page_ratio: Ratio of the pages of the document where a line must repeat to be considered boilerplate
+    :param min_pages: Minimum number of pages where a line must repeat to be considered boilerplate
+    :param position_step: Size of the buckets used to compare the vertical positions
+    :return: Set with the indexes of the lines to remove
+    """
+    pages_by_key = defaultdict(set)
+    keys = []
+    num_pages = len({page for _, page, _ in lines})
+
+    for text, page, y in lines:
+        normalized = normalize_line(text)
+        if not normalized or y is None:
+            keys.append(None)
+            continue
+        key = (normalized, round(y / position_step))
+        pages_by_key[key].add(page)
+        keys.append(key)
+
+    min_repetitions = max(min_pages, min_page_ratio * num_pages)
+    repeated = {key for key, pages in pages_by_key.items() if len(pages) >= min_repetitions}
+
+    return {i for i, key in enumerate(keys) if key in repeated}
+
+
+class NearDuplicateDetector:
+    """
+    Detects sections that are near duplicates of a section already seen in the document, comparing the MinHash
+    signatures of their word shingles. Candidates are found with LSH (bands of the signature), so each section is only
+    compared with the sections that share at least one band.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=64, bands=16, shingle_size=5, seed=1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.buckets = defaultdict(list)
+        self.signatures = []
+
+    def signature(self, text):
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) < self.shingle_size:
+            return None
+
+        shingles = {' '.join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+        permuted = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME & MAX_HASH
+        return permuted.min(axis=0)
+
+    def is_duplicate(self, text):
+        """
+        Returns True if the text is a near duplicate of a previous one, otherwise it's added to the seen sections
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return False
+
+        band_keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                     for band in range(self.bands)]
+
+        candidates = {candidate for key in band_keys for candidate in self.buckets.get(key, [])}
+        for candidate in candidates:
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                return True
+
+        for key in band_keys:
+            self.buckets[key].append(len(self.signatures))
+        self.signatures.append(signature)
+        return False
@@ -0,0 +1,368 @@
+"""
+Bulk ingestion of PDFs, for the onboarding of an institution. It does the same as POST /users/<user_id>/documents/<pdf_id>
+(handle_new_pdf) for many documents at once: the extraction runs in a pool of processes and the PDFFiles and
+PDFSubFiles rows are inserted in bulk. The documents already processed for the user (same sha256) are skipped, so an
+interrupted backfill can be run again.
+
+    python bulk_ingest.py --manifest manifest.csv
+    python bulk_ingest.py --directory /data/institution --first-pdf-id 50000
+
+The manifest is a CSV file with the columns user_id, pdf_id and path (relative paths are resolved from the folder of the
+manifest). A directory must contain a folder per user with its PDFs (<directory>/<user_id>/*.pdf); their pdf ids are
+given in order from --first-pdf-id, or taken from the sequence PDF_ID_SEQ if it's not given, so they don't collide with
+the ids of the API and of the folder watcher. The PDFs copied to the folders of the users are marked as being ingested
+until they are in PDFFiles, so the folder watcher skips them.
+"""
+import os
+import re
+import csv
+import sys
+import time
+import shutil
+import argparse
+import traceback
+from collections import namedtuple
+from multiprocessing import Pool
+
+import pyodbc
+from dotenv import load_dotenv
+from werkzeug.utils import secure_filename
+
+from env import path_to_listen, BULK_INGEST_BATCH_SIZE, BULK_INGEST_TASKS_PER_WORKER, PROFILE_INGEST_SAMPLE_RATE
+from env import SERVER_PDF_ID_START
+from ingestion_jobs import mark_ingesting, clear_ingesting
+from profiling import profiled
+from pdf_listener import extract_and_convert_to_xml
+from utils import file_sha256, reserve_pdf_ids
+
+# SQL Server accepts up to 2100 parameters in a statement
+MAX_PARAMETERS = 2000
+
+IngestJob = namedtuple('IngestJob', ['user_id', 'pdf_id', 'source_path', 'file_path', 'content_hash'])
+
+
+def standard_filename(source_path):
+    # Name of the PDF with the same standardization as the upload endpoint
+    filename = secure_filename(os.path.basename(source_path))
+    return re.sub(r'\W+', '_', os.path.splitext(filename)[0]) + '.pdf'
+
+
+def storage_path(user_id, source_path):
+    # Path of the PDF in the folder of the user
+    return os.path.join(path_to_listen, str(user_id), standard_filename(source_path))
+
+
+def read_manifest(manifest_path):
+    # Returns the (user_id, pdf_id, source_path) entries of the manifest
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='', encoding='utf-8') as file:
+        return [(row['user_id'].strip(), int(row['pdf_id']), os.path.join(base_dir, row['path'].strip()))
+                for row in csv.DictReader(file)]
+
+
+def read_directory(directory):
+    # Returns the (user_id, None, source_path) entries of the PDFs in <directory>/<user_id>/
+    entries = []
+    for user_id in sorted(os.listdir(directory)):
+        user_dir = os.path.join(directory, user_id)
+        if not os.path.isdir(user_dir):
+            continue
+        for filename in sorted(os.listdir(user_dir)):
+            if filename.lower().endswith('.pdf'):
+                entries.append((user_id, None, os.path.join(user_dir, filename)))
+    return entries
+
+
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def hash_file(source_path):
+    # Runs in a worker, returns the sha256 of the file or None if it can't be read
+    try:
+        return file_sha256(source_path), None
+    except OSError as e:
+        return None, str(e)
+
+
+def fetch_existing_documents(cursor, user_ids):
+    """
+    Returns the documents that are not deleted of the users as a dictionary
+    user_id -> {'filenames': set of FILE_NAME, 'hashes': set of CONTENT_HASH of the processed documents}
+    """
+    existing = {user_id: {'filenames': set(), 'hashes': set()} for user_id in user_ids}
+    for users in chunks(existing, MAX_PARAMETERS):
+        cursor.execute(f"""
+        SELECT USER_ID, FILE_NAME, IS_PROCESSED, CONTENT_HASH
+        FROM PDFFiles
+        WHERE IS_DELETED = 0 AND USER_ID IN ({', '.join('?' * len(users))})
+        """, *users)
+        for row in cursor.fetchall():
+            documents = existing[row.USER_ID]
+            documents['filenames'].add(row.FILE_NAME)
+            if row.CONTENT_HASH and int(row.IS_PROCESSED) == 1:
+                documents['hashes'].add(row.CONTENT_HASH)
+    return existing
+
+
+def fetch_used_pdf_ids(cursor, pdf_ids):
+    # Returns the pdf ids that already exist in PDFFiles, deleted or not
+    used = set()
+    for ids in chunks(set(pdf_ids), MAX_PARAMETERS):
+        cursor.execute(f"SELECT PDF_ID FROM PDFFiles WHERE PDF_ID IN ({', '.join('?' * len(ids))})", *ids)
+        used.update(row.PDF_ID for row in cursor.fetchall())
+    return used
+
+
+def create_users(cnxn, cursor, user_ids):
+    # Inserts the users that don't exist yet
+    existing = set()
+    for users in chunks(user_ids, MAX_PARAMETERS):
+        cursor.execute(f"""
+        SELECT USER_ID_FROM_UI
+        FROM USERS
+        WHERE USER_ID_FROM_UI IN ({', '.join('?' * len(users))})
+        """, *users)
+        existing.update(row.USER_ID_FROM_UI for row in cursor.fetchall())
+
+    missing = [(user_id,) for user_id in user_ids if user_id not in existing]
+    if missing:
+        cursor.executemany("""
+        INSERT INTO USERS (DATE, USER_ID_FROM_UI)
+        VALUES (GETDATE(), ?)
+        """, missing)
+        cnxn.commit()
+
+
+def plan_jobs(cursor, entries, hashes, first_pdf_id=None):
+    """
+    Decides which entries must be processed.
+    :param entries: (user_id, pdf_id, source_path) entries, the pdf_id is None if it must be assigned
+    :param hashes: (content_hash, error) of each entry
+    :param first_pdf_id: First pdf id of the entries without one, they are taken from PDF_ID_SEQ if it's None
+    :return: (jobs, skipped entries, failures as (entry, error))
+    """
+    jobs, skipped, failures = [], [], []
+    existing = fetch_existing_documents(cursor, {user_id for user_id, _, _ in entries})
+    used_pdf_ids = fetch_used_pdf_ids(cursor, [pdf_id for _, pdf_id, _ in entries if pdf_id is not None])
+    new_pdf_id = first_pdf_id
+
+    for entry, (content_hash, error) in zip(entries, hashes):
+        user_id, pdf_id, source_path = entry
+        if error:
+            failures.append((entry, error))
+            continue
+
+        documents = existing[user_id]
+        if content_hash in documents['hashes']:
+            skipped.append(entry)
+            continue
+
+        file_path = storage_path(user_id, source_path)
+        if os.path.basename(file_path) in documents['filenames']:
+            failures.append((entry, f'File already exists: {os.path.basename(file_path)}'))
+            continue
+
+        if pdf_id is None and new_pdf_id is not None:
+            while new_pdf_id in used_pdf_ids:
+                new_pdf_id += 1
+            pdf_id = new_pdf_id
+        elif pdf_id is not None and pdf_id >= SERVER_PDF_ID_START:
+            failures.append((entry, f'PDF_ID reserved for the ids of the server: {pdf_id}'))
+            continue
+        elif pdf_id in used_pdf_ids:
+            failures.append((entry, f'PDF_ID already exists: {pdf_id}'))
+            continue
+
+        # Later entries of the run with the same content, name or id are checked against this one
+        documents['hashes'].add(content_hash)
+        documents['filenames'].add(os.path.basename(file_path))
+        if pdf_id is not None:
+            used_pdf_ids.add(pdf_id)
+        jobs.append(IngestJob(user_id, pdf_id, source_path, file_path, content_hash))
+
+    # The ids of the sequence are reserved in a single range once the jobs are known
+    missing = [position for position, job in enumerate(jobs) if job.pdf_id is None]
+    if missing:
+        first = reserve_pdf_ids(cursor, len(missing))
+        for offset, position in enumerate(missing):
+            jobs[position] = jobs[position]._replace(pdf_id=first + offset)
+
+    return jobs, skipped, failures
+
+
+def remove_document_files(job):
+    # Removes the directory (<user_id>/file_name) of the document and the PDF if it was copied
+    dirpath = os.path.splitext(job.file_path)[0]
+    if os.path.exists(dirpath):
+        shutil.rmtree(dirpath)
+    if os.path.abspath(job.source_path) != os.path.abspath(job.file_path) and os.path.exists(job.file_path):
+        os.remove(job.file_path)
+
+
+def ingest_file(job):
+    """
+    Runs in a worker: copies the PDF to the folder of the user, extracts and splits it without using the database
+    :return: (job, subfiles, stats, seconds, error)
+    """
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(job.file_path), exist_ok=True)
+        if os.path.abspath(job.source_path) != os.path.abspath(job.file_path):
+            shutil.copyfile(job.source_path, job.file_path)
+
+        subfiles = []
+        with profiled('bulk_ingest', job.user_id, job.pdf_id, sample_rate=PROFILE_INGEST_SAMPLE_RATE):
+            stats = extract_and_convert_to_xml(None, None, job.file_path, job.pdf_id, subfiles=subfiles)
+        return job, subfiles, stats, time.perf_counter() - start, None
+    except Exception:
+        try:
+            remove_document_files(job)
+        except OSError:
+            pass
+        return job, None, None, time.perf_counter() - start, traceback.format_exc(limit=3)
+
+
+def insert_documents(cnxn, cursor, documents):
+    """
+    Inserts the PDFFiles rows, already processed, and the PDFSubFiles rows of the documents in a single transaction
+    :param documents: (job, subfiles) of each document
+    """
+    cursor.fast_executemany = True
+    try:
+        cursor.executemany("""
+        INSERT INTO PDFFiles (FILE_NAME, UPLOAD_DATE, USER_ID, IS_DELETED, IS_PROCESSED, PDF_ID, CONTENT_HASH)
+        VALUES (?, GETDATE(), ?, 0, 1, ?, ?)
+        """, [(os.path.basename(job.file_path), job.user_id, job.pdf_id, job.content_hash) for job, _ in documents])
+
+        subfile_rows = [(job.pdf_id, subfile, tokens) for job, subfiles in documents for subfile, tokens in subfiles]
+        if subfile_rows:
+            cursor.executemany("""
+            INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED, TOKENS)
+            VALUES (?, ?, 0, ?)
+            """, subfile_rows)
+        cnxn.commit()
+    except pyodbc.Error:
+        cnxn.rollback()
+        raise
+    finally:
+        cursor.fast_executemany = False
+
+
+def flush_documents(cnxn, cursor, documents):
+    """
+    Inserts the documents in bulk. If the batch fails, they are inserted one by one so a single wrong row doesn't fail
+    the whole batch.
+    :return: (job, error) of the documents that could not be inserted
+    """
+    try:
+        insert_documents(cnxn, cursor, documents)
+        return []
+    except pyodbc.Error as e:
+        if len(documents) == 1:
+            return [(documents[0][0], str(e))]
+
+    failures = []
+    for document in documents:
+        try:
+            insert_documents(cnxn, cursor, [document])
+        except pyodbc.Error as e:
+            failures.append((document[0], str(e)))
+    return failures
+
+
+def _init_worker(quiet):
+    # The extraction prints the progress of each document, it's hidden with --quiet
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+
+def write_failures(failures_path, failures):
+    with open(failures_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['user_id', 'pdf_id', 'path', 'error'])
+        for (user_id, pdf_id, source_path), error in failures:
+            writer.writerow([user_id, pdf_id, source_path, error])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk ingestion of PDFs')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='CSV file with the columns user_id, pdf_id and path')
+    source.add_argument('--directory', help='folder with a subfolder of PDFs per user')
+    parser.add_argument('--first-pdf-id', type=int, help='first pdf id given to the PDFs of --directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=BULK_INGEST_BATCH_SIZE,
+                        help='documents inserted in the same transaction')
+    parser.add_argument('--failures', default='bulk_ingest_failures.csv', help='CSV file where failures are written')
+    parser.add_argument('--quiet', action='store_true', help='hide the output of the extraction of each document')
+    args = parser.parse_args()
+
+    load_dotenv()
+    entries = read_manifest(args.manifest) if args.manifest else read_directory(args.directory)
+    print(f'{len(entries)} documents to ingest with {args.workers} workers')
+
+    start = time.perf_counter()
+    with Pool(args.workers, initializer=_init_worker, initargs=(args.quiet,),
+              maxtasksperchild=BULK_INGEST_TASKS_PER_WORKER) as pool:
+        hashes = pool.map(hash_file, [source_path for _, _, source_path in entries], chunksize=16)
+
+        cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+        cursor = cnxn.cursor()
+        jobs = []
+        try:
+            jobs, skipped, failures = plan_jobs(cursor, entries, hashes, args.first_pdf_id)
+            print(f'{len(skipped)} documents already processed, {len(failures)} rejected, {len(jobs)} to process')
+            create_users(cnxn, cursor, sorted({job.user_id for job in jobs}))
+            # The folder watcher skips the PDFs copied to the folders of the users until they are in PDFFiles
+            for job in jobs:
+                mark_ingesting(job.file_path)
+
+            processed, pages, pending = 0, 0, []
+            for job, subfiles, stats, seconds, error in pool.imap_unordered(ingest_file, jobs):
+                if error:
+                    clear_ingesting(job.file_path)
+                    failures.append(((job.user_id, job.pdf_id, job.source_path), error))
+                    print(f'Error processing {job.source_path}: {error.strip().splitlines()[-1]}')
+                    continue
+
+                pending.append((job, subfiles))
+                pages += stats['pages']
+                if len(pending) >= args.batch_size:
+                    for failed_job, error in flush_documents(cnxn, cursor, pending):
+                        remove_document_files(failed_job)
+                        failures.append(((failed_job.user_id, failed_job.pdf_id, failed_job.source_path), error))
+                    for flushed_job, _ in pending:
+                        clear_ingesting(flushed_job.file_path)
+                    processed += len(pending)
+                    pending = []
+
+                    elapsed = time.perf_counter() - start
+                    print(f'{processed}/{len(jobs)} documents, {processed / elapsed:.2f} documents/s, '
+                          f'{pages / elapsed:.1f} pages/s, {len(failures)} failures')
+
+            for failed_job, error in flush_documents(cnxn, cursor, pending) if pending else []:
+                remove_document_files(failed_job)
+                failures.append(((failed_job.user_id, failed_job.pdf_id, failed_job.source_path), error))
+            processed += len(pending)
+        finally:
+            for job in jobs:
+                clear_ingesting(job.file_path)
+            cursor.close()
+            cnxn.close()
+
+    elapsed = time.perf_counter() - start
+    ingested = len(entries) - len(skipped) - len(failures)
+    print(f'Ingested {ingested} documents ({pages} pages) in {elapsed:.1f}s: {ingested / elapsed:.2f} documents/s, '
+          f'{pages / elapsed:.1f} pages/s. Skipped {len(skipped)}, failed {len(failures)}')
+
+    if failures:
+        write_failures(args.failures, failures)
+        print(f'Failures written to {args.failures}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import json
+from datetime import datetime
+from threading import Thread
+
+from env import HISTORY_SUMMARY_MAX_TOKENS, HISTORY_TURN_MAX_TOKENS, resumen_conversacion
+from message_store import MessageBatch, save_messages_async, read_message
+from model_router import llm_call_type
+
+SUMMARY_INPUT = "Resumen de la conversación anterior"
+# Lower bound of the dates of the messages when the chat has no summary yet (DATETIME starts in 1753)
+FIRST_DATE = datetime(1900, 1, 1)
+
+
+class ChatHistory:
+    """
+    History of a chat with a fixed token budget: a rolling summary ('S' message) of the old turns plus the last k raw
+    turns (question 'P' and answer 'L'). The intermediate 'F' messages with the full context are never loaded.
+    The summary stores the date of the last turn it includes, the turns after that date that fall out of the last k
+    are folded into the summary after each answer.
+    """
+
+    def __init__(self, user_id, pdf_id, chat_id, k, summary='', until=None, turns=None):
+        self.user_id = user_id
+        self.pdf_id = pdf_id
+        self.chat_id = chat_id
+        self.k = k
+        self.summary = summary
+        self.until = until
+        # (date of the answer, question, answer) of the turns not included in the summary, the oldest first
+        self.turns = turns if turns else []
+
+    def memory_inputs(self, tokenizer):
+        """
+        Returns the (input, output) pairs for the memory of the conversation: the summary and the last k turns, each one
+        truncated to its token budget
+        """
+        inputs = []
+        if self.summary:
+            inputs.append(({"input": SUMMARY_INPUT},
+                           {"output": truncate_tokens(tokenizer, self.summary, HISTORY_SUMMARY_MAX_TOKENS)}))
+
+        for _, question, answer in self.turns[-self.k:] if self.k else []:
+            inputs.append(({"input": truncate_tokens(tokenizer, question, HISTORY_TURN_MAX_TOKENS)},
+                           {"output": truncate_tokens(tokenizer, answer, HISTORY_TURN_MAX_TOKENS)}))
+        return inputs
+
+    def add_turn(self, date, question, answer):
+        self.turns.append((date, question, answer))
+
+    def turns_to_compact(self):
+        return self.turns[:-self.k] if self.k else list(self.turns)
+
+    def compact(self, llm, tokenizer):
+        """
+        Folds the turns that are out of the last k into the summary and saves the new summary
+        """
+        old_turns = self.turns_to_compact()
+        if not old_turns:
+            return
+
+        new_lines = "\n".join(f"Humano: {truncate_tokens(tokenizer, question, HISTORY_TURN_MAX_TOKENS)}\n"
+                              f"IA: {truncate_tokens(tokenizer, answer, HISTORY_TURN_MAX_TOKENS)}"
+                              for _, question, answer in old_turns)
+        # langchain is imported when it's used, so it's not loaded by the workers that don't need it
+        from langchain.chains import LLMChain
+        from langchain.prompts import PromptTemplate
+
+        prompt = PromptTemplate(input_variables=["summary", "new_lines", "max_tokens"], template=resumen_conversacion)
+        with llm_call_type('summarize'):
+            summary = LLMChain(llm=llm, prompt=prompt).predict(summary=self.summary,
+                                                               new_lines=new_lines,
+                                                               max_tokens=HISTORY_SUMMARY_MAX_TOKENS)
+        self.summary = truncate_tokens(tokenizer, summary.strip(), HISTORY_SUMMARY_MAX_TOKENS)
+        self.until = old_turns[-1][0]
+        self.turns = self.turns[len(old_turns):]
+
+        messages = MessageBatch(self.user_id, self.pdf_id, self.chat_id)
+        messages.add('S',
+                     json.dumps({"summary": self.summary, "until": self.until.isoformat()}),
+                     len(tokenizer.encode(self.summary)))
+        save_messages_async(messages)
+
+    def compact_in_background(self, llm, tokenizer):
+        """
+        Compacts the history in a thread so the answer is not delayed by the summary
+        """
+        if not self.turns_to_compact():
+            return None
+
+        def run():
+            try:
+                self.compact(llm, tokenizer)
+            except Exception as e:
+                print(f"Error updating the summary of the chat {self.chat_id}: {e}")
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+def truncate_tokens(tokenizer, text, max_tokens):
+    tokens = tokenizer.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return tokenizer.decode(tokens[:max_tokens])
+
+
+def get_chat_history(cursor, user_id, pdf_id, chat_id, k):
+    """
+    Loads the last summary of the chat and the turns after it (at most k + 1 turns, the extra one is the turn that
+    will be folded in the summary after the next answer)
+    """
+    cursor.execute("""
+    SELECT TOP 1 DATE, MESSAGE, MESSAGE_BLOB
+    FROM MESSAGES
+    WHERE CHAT_ID = ?
+    AND USER_ID = ?
+    AND PDF_ID = ?
+    AND TYPE_OF_MESSAGE = 'S'
+    ORDER BY DATE DESC
+    """, chat_id, user_id, pdf_id)
+    summary_row = cursor.fetchone()
+
+    summary, until = '', None
+    if summary_row:
+        stored = json.loads(read_message(summary_row.MESSAGE, summary_row.MESSAGE_BLOB))
+        summary, until = stored["summary"], datetime.fromisoformat(stored["until"])
+
+    cursor.execute("""
+    SELECT TOP (?) DATE, TYPE_OF_MESSAGE, MESSAGE, MESSAGE_BLOB
+    FROM MESSAGES
+    WHERE CHAT_ID = ?
+    AND USER_ID = ?
+    AND PDF_ID = ?
+    AND TYPE_OF_MESSAGE IN ('P', 'L')
+    AND DATE > ?
+    ORDER BY DATE DESC
+    """, (k + 1) * 2, chat_id, user_id, pdf_id, until or FIRST_DATE)
+    rows = cursor.fetchall()
+
+    # Pair each question with the answer that follows it
+    turns = []
+    question = None
+    for row in reversed(rows):
+        if row.TYPE_OF_MESSAGE == 'P':
+            question = read_message(row.MESSAGE, row.MESSAGE_BLOB)
+        elif question is not None:
+            turns.append((row.DATE, question, read_message(row.MESSAGE, row.MESSAGE_BLOB)))
+            question = None
+
+    return ChatHistory(user_id, pdf_id, chat_id, k, summary, until, turns)
@@ -3,18 +3,13 @@ import re
 from typing import List
 from env import path_to_listen as path
 
-import openai
-import tiktoken
 from dotenv import load_dotenv  # This is to load the .env file
-from langchain.chains import ConversationChain
-# from langchain.memory.buffer import ConversationBufferMemory
-from langchain.chains.conversation.prompt import ENTITY_MEMORY_CONVERSATION_TEMPLATE
-from langchain.chat_models import ChatOpenAI
-from langchain.memory.entity import ConversationEntityMemory
 
 from env import MAX_TOKENS, TOKENS_LIMIT, MODEL, PAGE_LIMIT
 from env import BM25_threshold, encabezado
 from infomation_retrival_for_questions import read_files, preprocess, get_most_relevant_docs
+from llm_client import get_llm_client
+from nlp_resources import get_tokenizer
 
 
 def create_conversation_chain(inputs, num_msgs=3):
@@ -25,13 +20,17 @@ def create_conversation_chain(inputs, num_msgs=3):
     """
     load_dotenv()
 
-    llm = ChatOpenAI(
-        temperature=0,
-        model_name=MODEL,
-        verbose=False,
-    )
+    # langchain is imported when it's used, the gunicorn master preloads it (see nlp_resources.preload)
+    from langchain.chains import ConversationChain
+    # from langchain.memory.buffer import ConversationBufferMemory
+    from langchain.chains.conversation.prompt import ENTITY_MEMORY_CONVERSATION_TEMPLATE
+    from langchain.memory.entity import ConversationEntityMemory
+
+    # The model is shared by all the conversations of the process, its calls go through the pooled LLM client. The
+    # entity extraction and summaries of the memory are routed as 'entities' calls, see model_router.py
+    llm = get_llm_client().chat_model(model_name=MODEL, temperature=0)
     memory = ConversationEntityMemory(
-        llm=llm,
+        llm=get_llm_client().chat_model(model_name=MODEL, temperature=0, call_type='entities'),
         k=num_msgs,
     )
 
@@ -61,9 +60,10 @@ def initialize_conversation():
     return msgs
 
 
-def compose_input_with_relevant_info(path, relevant_info, prefix_info_phrase = "Resume detalladamente el texto con el que poder responder cualquier pregunta y genera una lista de ideas principales: "):
+def compose_input_with_relevant_info(path, relevant_info, prefix_info_phrase = "Resume detalladamente el texto con el que poder responder cualquier pregunta y genera una lista de ideas principales: ",
+                                     threshold=BM25_threshold):
     not_found_info = False
-    tokenizer = tiktoken.encoding_for_model(MODEL)
+    tokenizer = get_tokenizer()
     acc_tokens = len(tokenizer.encode(prefix_info_phrase))
     total_tokens = acc_tokens
     msgs_content = ""
@@ -73,8 +73,8 @@ def compose_input_with_relevant_info(path, relevant_info, prefix_info_phrase = "
     relevant_info = sorted(relevant_info, key=lambda x: x[1], reverse=True)[:PAGE_LIMIT]
 
     for filename, score in relevant_info:
-        if score < BM25_threshold:
-            print(f"File {filename} has a BM25 score lower than the threshold. Skipping...")
+        if score < threshold:
+            print(f"File {filename} has a score lower than the threshold. Skipping...")
             continue
         doc_folder = re.sub(r"_\d+\.txt$", "", filename)
         try:
@@ -112,7 +112,7 @@ def compose_input_with_relevant_info(path, relevant_info, prefix_info_phrase = "
 
 
 def add_relevant_info(path, msgs, relevant_info, question):
-    tokenizer = tiktoken.encoding_for_model(MODEL)
+    tokenizer = get_tokenizer()
     acc_tokens: int = len(tokenizer.encode(question)) + len(msgs[0]['content'])
     msgs_content = ""
     for filename, _ in relevant_info[::-1]:  # Reverse the list to add the most relevant text at the final prompt
@@ -150,12 +150,13 @@ def generate_response(msgs, added_tokens=0, tolerance=10):
     :param tolerance: Tolerance for the token limit
     :return: The response from GPT-3
     """
-    tokenizer = tiktoken.encoding_for_model(MODEL)
+    tokenizer = get_tokenizer()
     print(f"Generating response. Accumulated tokens: {len(tokenizer.encode(msgs[1]['content']))}")
-    response = openai.ChatCompletion.create(
+    response = get_llm_client().create(
         model=MODEL,
         messages=msgs,
-        max_tokens=TOKENS_LIMIT - added_tokens - tolerance
+        max_tokens=TOKENS_LIMIT - added_tokens - tolerance,
+        call_type='answer'
     )
     return response.choices[0].message["content"]
 
@@ -183,6 +184,7 @@ def chatgpt_response(question, slides_directory):
     # Add the user question to the conversation
     msgs = add_user_question(msgs, question)
     # Generate the response
+    import openai
     try:
         response = generate_response(msgs, added_tokens)
     except openai.error.InvalidRequestError:
@@ -0,0 +1,187 @@
+import os
+import numpy as np
+
+from env import EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_LENGTH, EMBEDDING_THREADS
+from env import HYBRID_CANDIDATES, RRF_K, HYBRID_MIN_RATIO, PAGE_LIMIT
+
+# Names of the model files in the folder of the model, the quantized one is used if it's there
+MODEL_FILES = ['model_quantized.onnx', 'model.onnx']
+
+
+class EmbeddingModel:
+    """
+    Sentence embeddings of a transformer exported to ONNX and stored in a local folder (model.onnx or
+    model_quantized.onnx and the tokenizer.json of the tokenizers library), so it works offline and without torch.
+    The embedding of a text is the mean of the vectors of its tokens, L2 normalized; a model whose output is already
+    one vector per text is used as is.
+    """
+
+    def __init__(self, path, max_length=EMBEDDING_MAX_LENGTH, threads=EMBEDDING_THREADS):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_file = next((os.path.join(path, name) for name in MODEL_FILES
+                           if os.path.exists(os.path.join(path, name))), None)
+        if model_file is None:
+            raise FileNotFoundError(f'No {" or ".join(MODEL_FILES)} in the embedding model folder {path}')
+
+        self.name = os.path.basename(os.path.normpath(path)) + '/' + os.path.basename(model_file)
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        pad_id = self.tokenizer.token_to_id('[PAD]') or 0
+        self.tokenizer.enable_padding(pad_id=pad_id, pad_token=self.tokenizer.id_to_token(pad_id) or '[PAD]')
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def encode(self, texts, batch_size=EMBEDDING_BATCH_SIZE):
+        """
+        Returns the float32 matrix (texts x dimensions) of the embeddings. The texts are sorted by length before they
+        are split in batches, so each batch is padded to similar lengths.
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch([texts[i] for i in order[start:start + batch_size]])
+            input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = np.zeros_like(input_ids)
+
+            output = self.session.run(None, feeds)[0]
+            if output.ndim == 3:
+                mask = attention_mask[:, :, None].astype(np.float32)
+                output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1.0)
+            batches.append(output.astype(np.float32))
+
+        embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.vstack(batches)
+        return normalize(embeddings)
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class DenseIndex:
+    """
+    Embeddings of the sections of a document. They are stored as float16, half the size, and used as float32, so the
+    scores of the queries are a single matrix product. The hashes of the texts of the sections are stored with them, so
+    the embeddings of the sections that don't change are reused when the document is ingested again.
+    """
+
+    def __init__(self, embeddings, filenames, model_name, hashes=None):
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.filenames = list(filenames)
+        self.model_name = model_name
+        self.hashes = list(hashes) if hashes is not None else None
+
+    def top_k_many(self, query_embeddings, k=10):
+        """
+        Returns the k best (filename, cosine similarity) pairs of each query, sorted by similarity
+        """
+        if not len(self.filenames):
+            return [[] for _ in range(len(query_embeddings))]
+        scores = np.asarray(query_embeddings, dtype=np.float32).dot(self.embeddings.T)
+        k = min(k, len(self.filenames))
+        results = []
+        for row in scores:
+            best = np.argpartition(-row, k - 1)[:k]
+            best = best[np.argsort(-row[best], kind='stable')]
+            results.append([(self.filenames[i], float(row[i])) for i in best])
+        return results
+
+    def save(self, file_path):
+        np.savez(file_path,
+                 embeddings=self.embeddings.astype(np.float16),
+                 filenames=np.array(self.filenames),
+                 model=np.array(self.model_name),
+                 hashes=np.array(self.hashes if self.hashes is not None else []))
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            # The indexes stored before the hashes have none
+            hashes = [str(text_hash) for text_hash in data['hashes']] if 'hashes' in data.files else []
+            return cls(data['embeddings'], [str(filename) for filename in data['filenames']], str(data['model']),
+                       hashes if len(hashes) == len(data['filenames']) else None)
+
+    def embeddings_by_hash(self):
+        # {text hash: embedding} of the sections, empty if the hashes are not known
+        if self.hashes is None:
+            return {}
+        return dict(zip(self.hashes, self.embeddings))
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Fuses several rankings of filenames: each filename scores the sum of 1 / (k + rank) over the rankings where it
+    appears. Returns the (filename, score) pairs sorted by score.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, filename in enumerate(ranking, 1):
+            scores[filename] = scores.get(filename, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+class HybridIndex:
+    """
+    BM25 (SparseBM25Index) and embeddings (DenseIndex) of the sections of a document. The best candidates of both are
+    fused with reciprocal rank fusion. The fused scores are not in BM25 units, so the sections are cut on the fused
+    ranking itself (the best k, with at least HYBRID_MIN_RATIO of the best fused score) instead of with
+    retrival_threshold and BM25_threshold, and the ones found only by the embeddings are kept.
+    """
+
+    def __init__(self, sparse, dense):
+        self.sparse = sparse
+        self.dense = dense
+
+    @property
+    def filenames(self):
+        return self.sparse.filenames
+
+    @property
+    def total_tokens(self):
+        return self.sparse.total_tokens
+
+    def top_k_many(self, queries_tokens, query_embeddings, k=10, candidates=HYBRID_CANDIDATES, rrf_k=RRF_K, **kwargs):
+        """
+        :param kwargs: lsa_weight and lsa_candidates of SparseBM25Index.top_k_many
+        :return: The (filename, fused score) of the k best sections of each query
+        """
+        candidates = max(k, candidates)
+        sparse_rankings = self.sparse.top_k_many(queries_tokens, k=candidates, **kwargs)
+        dense_rankings = self.dense.top_k_many(query_embeddings, k=candidates)
+
+        results = []
+        for sparse_ranked, dense_ranked in zip(sparse_rankings, dense_rankings):
+            # The sections without any term of the query are not ranked by BM25
+            results.append(reciprocal_rank_fusion([[filename for filename, score in sparse_ranked if score > 0],
+                                                   [filename for filename, _ in dense_ranked]], rrf_k)[:k])
+        return results
+
+    @staticmethod
+    def above_ratio(ranked, ratio=HYBRID_MIN_RATIO):
+        # The sections with at least ratio times the fused score of the best one
+        if not ranked:
+            return []
+        return [(filename, score) for filename, score in ranked if score >= ratio * ranked[0][1]]
+
+    def most_relevant_many(self, queries_tokens, query_embeddings, k=PAGE_LIMIT, ratio=HYBRID_MIN_RATIO, **kwargs):
+        return [self.above_ratio(ranked, ratio)
+                for ranked in self.top_k_many(queries_tokens, query_embeddings, k=k, **kwargs)]
+
+
+def dense_index_file_path(folder_path):
+    # Stored next to the section files of the document and the sparse index: <user_id>/<pdf>/<pdf>_dense.npz
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_dense.npz')
@@ -0,0 +1,96 @@
+import os
+import time
+from threading import Lock
+
+from env import path_to_listen, DOCUMENT_CACHE_TTL
+from execution import run_blocking
+
+
+def fetch_user_documents(cursor, user_id):
+    """
+    Fetches in a single query whether the user exists and the metadata of all its documents that are not deleted
+    :return: None if the user does not exist, otherwise a dictionary pdf_id -> {'filename', 'is_processed'}
+    """
+    cursor.execute("""
+    SELECT u.USER_ID_FROM_UI, f.PDF_ID, f.FILE_NAME, f.IS_PROCESSED
+    FROM USERS u
+    LEFT JOIN PDFFiles f
+    ON f.USER_ID = u.USER_ID_FROM_UI AND f.IS_DELETED = 0
+    WHERE u.USER_ID_FROM_UI = ?
+    """, user_id)
+    rows = cursor.fetchall()
+
+    if not rows:
+        return None
+
+    return {str(row.PDF_ID): {'filename': row.FILE_NAME, 'is_processed': int(row.IS_PROCESSED) == 1}
+            for row in rows if row.PDF_ID is not None}
+
+
+class DocumentMetadataCache:
+    """
+    Per process cache of the documents of each user. An entry is valid for ttl seconds while the folder of the user is
+    not modified: uploads and deletes change the folder, so the other workers see them without waiting for the ttl.
+    The process that uploads or deletes a document also invalidates the entry directly. The documents are processed in
+    other processes, so the users with a document not processed yet are not cached and isReady changes as soon as
+    the processing ends.
+    """
+
+    def __init__(self, ttl=DOCUMENT_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _folder_version(user_id):
+        try:
+            return os.stat(os.path.join(path_to_listen, str(user_id))).st_mtime_ns
+        except OSError:
+            return None
+
+    def lookup(self, user_id):
+        """
+        Returns (True, documents) if the entry of the user is cached and valid, otherwise (False, None)
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic() and entry[1] == self._folder_version(user_id):
+            return True, entry[2]
+        return False, None
+
+    def get(self, cursor, user_id, refresh=False):
+        """
+        Returns the documents of the user (see fetch_user_documents), from the cache when it's valid
+        """
+        if not refresh:
+            hit, documents = self.lookup(user_id)
+            if hit:
+                return documents
+
+        version = self._folder_version(user_id)
+        documents = run_blocking(fetch_user_documents, cursor, user_id)
+        with self._lock:
+            if documents is not None and not all(document['is_processed'] for document in documents.values()):
+                self._entries.pop(user_id, None)
+            else:
+                self._entries[user_id] = (time.monotonic() + self.ttl, version, documents)
+        return documents
+
+    def get_document(self, cursor, user_id, pdf_id):
+        """
+        Returns the documents of the user and the metadata of pdf_id. A document that is missing or not processed in the
+        cache is read again from the database, as it may have been uploaded or processed by another process.
+        """
+        documents = self.get(cursor, user_id)
+        document = documents.get(str(pdf_id)) if documents else None
+        if documents is not None and (document is None or not document['is_processed']):
+            documents = self.get(cursor, user_id, refresh=True)
+            document = documents.get(str(pdf_id)) if documents else None
+        return documents, document
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+document_cache = DocumentMetadataCache()
@@ -0,0 +1,234 @@
+"""
+Execution layer for the gevent workers of gunicorn. The pyodbc calls block in C code and the NLP work (preprocess,
+BM25, tiktoken) holds the GIL, so when a greenlet runs them every other request of the worker waits.
+run_blocking() runs a call in a native thread of the gevent hub and run_cpu() in a worker process; the greenlet that
+calls them waits for the result without blocking the others. Without gevent (flask dev server, scripts) the functions
+are called directly. The CPU workers are fresh interpreters: with PRELOAD_NLP_RESOURCES they load the NLP resources of
+their tasks (not langchain nor openai) when they start, and gunicorn starts them with its worker (see gunicorn.conf.py),
+so no question waits for them.
+"""
+import os
+import sys
+import queue
+import pickle
+import socket
+import struct
+import atexit
+import subprocess
+from threading import Lock
+
+from env import DB_THREADS, CPU_WORKERS, CPU_TASK_TIMEOUT, PRELOAD_NLP_RESOURCES
+from profiling import active_profile, run_profiled
+
+HEADER = struct.Struct('!Q')
+
+
+def gevent_active():
+    # True in the gevent workers, where the standard library is monkey patched
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def run_blocking(fn, *args, **kwargs):
+    """
+    Runs a blocking call (pyodbc, disk) in a native thread, at most DB_THREADS at the same time per worker
+    """
+    if not gevent_active():
+        return fn(*args, **kwargs)
+
+    import gevent
+    threadpool = gevent.get_hub().threadpool
+    if threadpool.maxsize != DB_THREADS:
+        threadpool.maxsize = DB_THREADS
+    return threadpool.apply(fn, args, kwargs)
+
+
+def run_cpu(fn, *args, **kwargs):
+    """
+    Runs a CPU bound function in one of the CPU_WORKERS processes of the worker. The function, its arguments and its
+    result are pickled, so it must be a module level function. With CPU_WORKERS = 0 it runs in a native thread.
+    While a profile is running (see profiling.py) the function is profiled where it runs and merged in the profile.
+    """
+    profile = active_profile()
+    if profile is not None and (gevent_active() or not profile.in_current_thread()):
+        fn, args = run_profiled, (profile.part_path(), fn) + args
+    if not CPU_WORKERS or not gevent_active():
+        return run_blocking(fn, *args, **kwargs)
+    return get_cpu_pool().run(fn, *args, **kwargs)
+
+
+def run_with_deadline(deadline, fn, *args, **kwargs):
+    """
+    Runs fn and waits at most deadline seconds (None waits forever) for its result, raising TimeoutError after that.
+    In the gevent workers fn runs in a greenlet that is killed at the deadline, which interrupts its pending socket
+    reads (the call to the model); otherwise it runs in a thread that keeps running and its result is discarded.
+    """
+    if deadline is None:
+        return fn(*args, **kwargs)
+
+    if gevent_active():
+        import gevent
+        greenlet = gevent.spawn(fn, *args, **kwargs)
+        try:
+            return greenlet.get(timeout=deadline)
+        except gevent.Timeout:
+            greenlet.kill(block=False)
+            raise TimeoutError(f'{fn.__name__} did not finish in {deadline}s')
+
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        return executor.submit(fn, *args, **kwargs).result(timeout=deadline)
+    except FutureTimeout:
+        raise TimeoutError(f'{fn.__name__} did not finish in {deadline}s')
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1024 * 1024))
+        if not chunk:
+            raise EOFError('Connection with the CPU worker closed')
+        data += chunk
+    return bytes(data)
+
+
+def _recv(sock):
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+def serve(fd, warm_up=False):
+    # Loop of a CPU worker process: receives (function, args, kwargs) and sends back (ok, result or exception)
+    if warm_up:
+        # The tasks sent meanwhile wait in the socket, the ones that need a resource that failed raise its error
+        from nlp_resources import preload, CPU_MODULES
+        try:
+            preload(CPU_MODULES)
+        except Exception as e:
+            print(f'Error preloading the NLP resources in the CPU worker: {e}')
+    sock = socket.socket(fileno=fd)
+    # The socket pair was created non blocking by gevent
+    sock.setblocking(True)
+    while True:
+        try:
+            fn, args, kwargs = _recv(sock)
+        except EOFError:
+            return
+        try:
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            _send(sock, result)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            _send(sock, (False, RuntimeError(f'Result of {fn.__name__} could not be sent: {e}')))
+
+
+class CpuWorker:
+    """
+    Worker process connected with a socket pair. The gevent socket of this side is cooperative, so the greenlet that
+    waits for a result lets the others run; the worker is a fresh interpreter without gevent, that loads the NLP
+    resources before its first task with PRELOAD_NLP_RESOURCES.
+    """
+
+    def __init__(self):
+        own, other = socket.socketpair()
+        # The worker imports the same modules as this process
+        path = [os.path.dirname(os.path.abspath(__file__))] + [p or os.getcwd() for p in sys.path]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+        command = f'import execution; execution.serve({other.fileno()}, warm_up={PRELOAD_NLP_RESOURCES})'
+        self.process = subprocess.Popen([sys.executable, '-c', command], pass_fds=[other.fileno()], env=env)
+        other.close()
+        self.sock = own
+
+    def call(self, fn, args, kwargs, timeout=CPU_TASK_TIMEOUT):
+        self.sock.settimeout(timeout)
+        _send(self.sock, (fn, args, kwargs))
+        return _recv(self.sock)
+
+    def close(self):
+        self.sock.close()
+        self.process.kill()
+        self.process.wait()
+
+
+class CpuPool:
+    """
+    Pool of CPU workers, started with start() or on first use. A worker that times out or dies is replaced by a new
+    one.
+    """
+
+    def __init__(self, size=CPU_WORKERS):
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._workers = []
+        for _ in range(size):
+            self._idle.put(None)
+
+    def start(self):
+        # Starts the workers that are not running yet
+        idle = []
+        while not self._idle.empty():
+            idle.append(self._idle.get())
+        for worker in idle:
+            if worker is None:
+                worker = CpuWorker()
+                self._workers.append(worker)
+            self._idle.put(worker)
+
+    def run(self, fn, *args, **kwargs):
+        worker = self._idle.get()
+        try:
+            if worker is None:
+                worker = CpuWorker()
+                self._workers.append(worker)
+            ok, result = worker.call(fn, args, kwargs)
+        except BaseException:
+            # Timeout, dead worker or killed greenlet (run_with_deadline): its state is unknown, so it's not reused
+            if worker is not None:
+                self._workers.remove(worker)
+                worker.close()
+                worker = None
+            raise
+        finally:
+            self._idle.put(worker)
+
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_cpu_pool():
+    # The pool is created lazily, so each forked worker starts its own processes
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = CpuPool()
+            atexit.register(_pool.close)
+    return _pool
+
+
+def start_cpu_workers():
+    # Called when a gunicorn worker starts, so its CPU workers load the NLP resources before the first question
+    if CPU_WORKERS and gevent_active():
+        get_cpu_pool().start()
@@ -0,0 +1,97 @@
+"""
+Extractive answers: the sentences of the relevant sections that best match the question, with the section and pages
+they come from. They are built locally in a few milliseconds, for the questions that ask for them (mode=extractive)
+and as the answer of the questions whose call to the model misses its deadline.
+"""
+import re
+import math
+from collections import Counter
+from functools import lru_cache
+
+from env import stopwords_spanish, EXTRACTIVE_SENTENCES, EXTRACTIVE_MIN_WORDS, respuesta_extractiva_sin_info
+from nlp_resources import get_stemmer
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?;])\s+|\n+')
+WORD_PATTERN = re.compile(r'\w+')
+STOPWORDS = set(stopwords_spanish)
+
+# BM25 parameters of the scoring of the sentences
+K1 = 1.2
+B = 0.75
+
+
+@lru_cache(maxsize=100000)
+def stem(word):
+    return get_stemmer().stem(word)
+
+
+def terms(text):
+    # Stems of the words of the text without stopwords and numbers, much faster than preprocess (no POS tagging)
+    return [stem(word) for word in WORD_PATTERN.findall(text.lower())
+            if len(word) > 2 and word not in STOPWORDS and not word.isdigit()]
+
+
+def split_sentences(text):
+    sentences = (sentence.strip() for sentence in SENTENCE_PATTERN.split(text))
+    return [sentence for sentence in sentences if len(sentence.split()) >= EXTRACTIVE_MIN_WORDS]
+
+
+def extract_answer(question, sections, max_sentences=EXTRACTIVE_SENTENCES):
+    """
+    Builds the answer of the question with the sentences of the sections that best match it. The sentences are scored
+    with BM25 against the question, weighted by the score of their section.
+    :param sections: List of (filename, score, text, pages) of the relevant sections, pages is [first, last] or None
+    :return: (answer, citations). Each sentence of the answer ends with the [id] of its citation, a dictionary with
+    the id, the section file and its pages
+    """
+    query = set(terms(question))
+    candidates = []
+    for position, (_, _, text, _) in enumerate(sections):
+        for sentence in split_sentences(text):
+            candidates.append((position, sentence, Counter(terms(sentence))))
+    if not query or not candidates:
+        return respuesta_extractiva_sin_info, []
+
+    count = len(candidates)
+    average_length = sum(sum(counts.values()) for _, _, counts in candidates) / count or 1
+    document_frequency = Counter(term for _, _, counts in candidates for term in query & counts.keys())
+    # The small documents are not ranked (their sections have an infinite score), all of them weigh the same
+    section_scores = [score for _, score, _, _ in sections]
+    best_section = max((score for score in section_scores if math.isfinite(score)), default=0)
+
+    scored = []
+    for position, sentence, counts in candidates:
+        length = sum(counts.values())
+        score = 0.0
+        for term in query & counts.keys():
+            frequency = document_frequency[term]
+            idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            tf = counts[term]
+            score += idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / average_length))
+        if score <= 0:
+            continue
+        section_score = section_scores[position]
+        if math.isfinite(section_score) and best_section > 0:
+            score *= 0.5 + 0.5 * section_score / best_section
+        scored.append((score, position, sentence))
+
+    if not scored:
+        return respuesta_extractiva_sin_info, []
+
+    scored.sort(key=lambda x: x[0], reverse=True)
+    answer = []
+    citations = {}
+    seen = set()
+    for _, position, sentence in scored:
+        # The overlapping chunks repeat sentences
+        if sentence in seen:
+            continue
+        seen.add(sentence)
+        filename, _, _, pages = sections[position]
+        if filename not in citations:
+            citations[filename] = {'id': len(citations) + 1, 'section': filename, 'pages': pages}
+        answer.append(f"{sentence} [{citations[filename]['id']}]")
+        if len(answer) == max_sentences:
+            break
+
+    return ' '.join(answer), list(citations.values())
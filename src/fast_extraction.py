@@ -0,0 +1,175 @@
+from pdfminer.pdfdevice import PDFTextDevice
+from pdfminer.utils import apply_matrix_pt, mult_matrix
+
+# Negative kerning (thousandths of text space unit) inside a TJ array from which a space is inserted
+SPACE_KERNING = 200
+# Gap between two text runs of the same line, relative to the font size, from which they are separate words. The runs
+# positioned with Td or TJ offsets don't have the space character between the words
+SPACE_GAP_RATIO = 0.15
+# Gap between two text runs of the same baseline, relative to the font size, from which the second one starts a new
+# line: the gutter between two columns or the cells of a table. Then the rows of a page with columns are not merged in
+# one line starting at the left margin, and is_simple_layout sees the lines of each column
+COLUMN_GAP_RATIO = 1.5
+
+
+def char_size(matrix, font, fontsize, scaling, cid):
+    """
+    Size of the LTChar of cid rendered with matrix: the height of its box in device space, or its width with a vertical
+    font, computed as pdfminer does so both engines give the same sizes
+    """
+    (a, b, c, d, e, f) = matrix
+    adv = font.char_width(cid) * fontsize * scaling
+    if font.is_vertical():
+        return abs(a * font.get_width() * fontsize - c * adv)
+    return abs(b * adv + d * font.get_height() * fontsize)
+
+
+class FastTextDevice(PDFTextDevice):
+    """
+    pdfminer device that reads the text runs (Tj/TJ operators) with their font and size directly from the content
+    stream, without creating one LTChar per character nor running the layout analysis of PDFPageAggregator.
+    A new line starts each time the baseline of the text changes or a run starts far after the end of the previous one,
+    so the lines follow the order of the content stream.
+    With record, the text runs of the page are also kept so they can be replayed in a PDFPageAggregator, and a page
+    without a simple layout is analyzed without parsing its content stream again.
+    """
+
+    def __init__(self, rsrcmgr, record=False):
+        PDFTextDevice.__init__(self, rsrcmgr)
+        self.record = record
+        self.lines = []
+        self.page_width = 0
+        self.page_height = 0
+        self._baseline = None
+        self._end_x = None
+        self._page = None
+        self._page_ctm = None
+        self._runs = []
+        self._figures = 0
+
+    def begin_page(self, page, ctm):
+        (x0, y0, x1, y1) = page.mediabox
+        (x0, y0) = apply_matrix_pt(ctm, (x0, y0))
+        (x1, y1) = apply_matrix_pt(ctm, (x1, y1))
+        self.page_width = abs(x1 - x0)
+        self.page_height = abs(y1 - y0)
+        self.lines = []
+        self._baseline = None
+        self._end_x = None
+        self._page = page
+        self._page_ctm = ctm
+        self._runs = []
+        self._figures = 0
+
+    def end_page(self, page):
+        for line in self.lines:
+            line[0] = ''.join(line[0]) + '\n'
+
+    def begin_figure(self, name, bbox, matrix):
+        # The full layout analysis keeps the text of the forms in figures, which extract_layout_lines skips
+        self._figures += 1
+
+    def end_figure(self, name):
+        self._figures -= 1
+
+    def render_string(self, textstate, seq, *args):
+        font = textstate.font
+        if font is None:
+            return
+        if self.record and not self._figures:
+            self._runs.append((self.ctm, textstate.copy(), seq, args))
+
+        (a, b, c, d, e, f) = matrix = mult_matrix(textstate.matrix, self.ctm)
+        x, y = apply_matrix_pt(matrix, textstate.linematrix)
+        # Font size in device space, the size of the line is the one of the LTChar of its first character
+        scale = textstate.fontsize * (abs(d) if b == 0 else (c * c + d * d) ** 0.5)
+        size = None
+
+        # Advance of the run in text space, as PDFTextDevice.render_string_horizontal computes it
+        scaling = textstate.scaling * 0.01
+        charspace = textstate.charspace * scaling
+        wordspace = 0 if font.is_multibyte() else textstate.wordspace * scaling
+        advance = 0
+        text = []
+        for obj in seq:
+            if isinstance(obj, (int, float)):
+                advance -= obj * 0.001 * textstate.fontsize * scaling
+                if -obj > SPACE_KERNING and text and text[-1] != ' ':
+                    text.append(' ')
+                continue
+            for cid in font.decode(obj):
+                if size is None:
+                    size = char_size(matrix, font, textstate.fontsize, scaling, cid)
+                advance += font.char_width(cid) * textstate.fontsize * scaling + charspace
+                if cid == 32:
+                    advance += wordspace
+                try:
+                    text.append(font.to_unichr(cid))
+                except Exception:
+                    text.append(f'(cid:{cid})')
+
+        # The next run without a Td starts where this one ends
+        (line_x, line_y) = textstate.linematrix
+        textstate.linematrix = (line_x + advance, line_y)
+        end_x = apply_matrix_pt(matrix, textstate.linematrix)[0]
+
+        if not text:
+            return
+
+        if (self._baseline is None or abs(y - self._baseline) > 0.5 * scale
+                or x - self._end_x > COLUMN_GAP_RATIO * scale):
+            # The bottom of the line is used as its position, like the y0 of the LTTextLine in the full layout
+            descent = font.get_descent() * scale
+            self.lines.append([text, font.fontname, size, x, y + descent])
+            self._baseline = y
+        else:
+            line_text = self.lines[-1][0]
+            if (x - self._end_x > SPACE_GAP_RATIO * scale and line_text and not line_text[-1].isspace()
+                    and not text[0].isspace()):
+                line_text.append(' ')
+            line_text.extend(text)
+        self._end_x = end_x
+
+    def replay(self, device):
+        """
+        Renders the text runs of the last processed page in device, a PDFPageAggregator, and returns its layout
+        """
+        page = self._page
+        device.begin_page(page, self._page_ctm)
+        for ctm, textstate, seq, args in self._runs:
+            device.set_ctm(ctm)
+            device.render_string(textstate, seq, *args)
+        device.end_page(page)
+        return device.get_result()
+
+    def get_result(self, page_number, records):
+        """
+        Appends the lines of the last processed page to the LineRecords of the extraction
+        """
+        for text, font, size, _, y in self.lines:
+            records.append(text, font, size, page_number, y / self.page_height if self.page_height else None)
+        return records
+
+
+def is_simple_layout(lines, page_width, max_backward_ratio=0.2, max_column_ratio=0.25):
+    """
+    Decides if the content stream order of a page can be used as reading order, so the page can be extracted with the
+    fast engine. A page is not simple when many lines go back up the page (the stream is not written top to bottom)
+    or when there are lines starting on both sides of the page (several columns).
+    :param lines: Lines of FastTextDevice, [text, font, size, x, y]
+    :param page_width: Width of the page
+    """
+    if len(lines) < 2:
+        return True
+
+    backward = sum(1 for previous, line in zip(lines, lines[1:]) if line[4] - previous[4] > previous[2])
+    if backward / (len(lines) - 1) > max_backward_ratio:
+        return False
+
+    if page_width:
+        right_column = sum(1 for line in lines if line[3] > 0.45 * page_width)
+        left_column = sum(1 for line in lines if line[3] < 0.2 * page_width)
+        if left_column and right_column / len(lines) > max_column_ratio:
+            return False
+
+    return True
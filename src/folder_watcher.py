@@ -0,0 +1,272 @@
+"""
+Daemon that ingests the PDFs dropped in the folders of the users (<path_to_listen>/<user_id>/<file>.pdf), so batch
+pipelines (SFTP, scripts) can feed documents without going through the upload endpoint.
+
+    python folder_watcher.py --workers 2
+
+A file is ingested once it has not changed for WATCH_DEBOUNCE_SECONDS and ends with the PDF trailer, so partially
+written files are not processed. The documents take their pdf id from the sequence PDF_ID_SEQ, like bulk_ingest. Files
+that are already in PDFFiles, that the API or bulk_ingest are still ingesting (see ingestion_jobs.mark_ingesting) or
+with the same content as a processed document of the user are skipped. The files that fail are moved to
+WATCH_REJECTED_DIR (<folder>/<user_id>/<file>.pdf), so they are not processed again at every start. At startup the
+folders are scanned for PDFs dropped while the daemon was stopped.
+"""
+import os
+import re
+import time
+import shutil
+import argparse
+import traceback
+from threading import Lock
+from multiprocessing import Pool
+
+import pyodbc
+from dotenv import load_dotenv
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from env import path_to_listen, WATCH_DEBOUNCE_SECONDS, WATCH_WORKERS, WATCH_REJECTED_DIR, BULK_INGEST_TASKS_PER_WORKER
+from env import PROFILE_INGEST_SAMPLE_RATE
+from bulk_ingest import standard_filename, create_users
+from ingestion_jobs import is_ingesting
+from pdf_listener import extract_and_convert_to_xml
+from profiling import profiled
+from utils import file_sha256
+
+# A complete PDF ends with this marker, followed at most by some whitespace
+PDF_TRAILER = b'%%EOF'
+
+
+def user_of(root, path):
+    # Returns the user_id if path is a PDF directly inside the folder of a user, otherwise None
+    parts = os.path.relpath(path, root).split(os.sep)
+    # The folders that start with a dot (INGESTING_DIR, WATCH_REJECTED_DIR) are not of a user
+    if len(parts) == 2 and parts[1].lower().endswith('.pdf') and not parts[0].startswith('.') \
+            and not parts[1].startswith('.'):
+        return parts[0]
+    return None
+
+
+def is_complete_pdf(path):
+    try:
+        with open(path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - 1024, 0))
+            return PDF_TRAILER in file.read()
+    except OSError:
+        return False
+
+
+class DroppedFiles(FileSystemEventHandler):
+    """
+    Collects the PDFs created, modified or moved into the folders of the users with the time of their last event
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._events = {}
+        self._lock = Lock()
+
+    def touch(self, path, when=None):
+        if user_of(self.root, path) is not None:
+            with self._lock:
+                self._events[path] = time.monotonic() if when is None else when
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.touch(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.touch(event.dest_path)
+
+    def scan(self):
+        # Adds the PDFs that are already in the folders of the users
+        for user_id in os.listdir(self.root):
+            user_dir = os.path.join(self.root, user_id)
+            if os.path.isdir(user_dir):
+                for filename in os.listdir(user_dir):
+                    self.touch(os.path.join(user_dir, filename), when=0)
+
+    def pop_quiet(self, seconds, limit):
+        # Removes and returns up to limit paths without events in the last seconds, the oldest first
+        deadline = time.monotonic() - seconds
+        with self._lock:
+            quiet = sorted((when, path) for path, when in self._events.items() if when <= deadline)[:limit]
+            for _, path in quiet:
+                del self._events[path]
+        return [path for _, path in quiet]
+
+
+def reject_file(user_id, file_path, rejected_dir):
+    # Moves a PDF that could not be ingested out of the folder of the user, keeping its name
+    target_dir = os.path.join(rejected_dir, str(user_id))
+    os.makedirs(target_dir, exist_ok=True)
+    target_path = os.path.join(target_dir, os.path.basename(file_path))
+    if os.path.exists(target_path):
+        target_path = os.path.join(target_dir, f'{time.strftime("%Y%m%d-%H%M%S")}_{os.path.basename(file_path)}')
+    os.replace(file_path, target_path)
+    return target_path
+
+
+def ingest_dropped_file(user_id, file_path, rejected_dir=WATCH_REJECTED_DIR):
+    """
+    Runs in a worker: registers the PDF with a new pdf id, extracts and splits it, and marks it as processed. If it
+    fails the PDF is moved to rejected_dir
+    :return: Message with the result
+    """
+    filename = os.path.basename(file_path)
+    cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+    cursor = cnxn.cursor()
+    pdf_id = None
+    try:
+        content_hash = file_sha256(file_path)
+        cursor.execute("""
+        SELECT TOP 1 FILE_NAME
+        FROM PDFFiles
+        WHERE USER_ID = ? AND IS_DELETED = 0 AND (FILE_NAME = ? OR (CONTENT_HASH = ? AND IS_PROCESSED = 1))
+        """, user_id, filename, content_hash)
+        row = cursor.fetchone()
+        if row is not None:
+            if row.FILE_NAME == filename:
+                return f'Skipped {file_path}: already registered'
+            return f'Skipped {file_path}: same content as {row.FILE_NAME}'
+
+        create_users(cnxn, cursor, [user_id])
+
+        # The same sequence as bulk_ingest, above the ids of the API
+        cursor.execute("""
+        INSERT INTO PDFFiles (FILE_NAME, UPLOAD_DATE, USER_ID, IS_DELETED, IS_PROCESSED, PDF_ID, CONTENT_HASH)
+        OUTPUT INSERTED.PDF_ID
+        VALUES (?, GETDATE(), ?, 0, 0, NEXT VALUE FOR PDF_ID_SEQ, ?)
+        """, filename, user_id, content_hash)
+        pdf_id = cursor.fetchone()[0]
+        cnxn.commit()
+
+        subfiles = []
+        with profiled('watch_ingest', user_id, pdf_id, sample_rate=PROFILE_INGEST_SAMPLE_RATE):
+            stats = extract_and_convert_to_xml(cnxn, cursor, file_path, pdf_id, subfiles=subfiles)
+
+        if subfiles:
+            cursor.fast_executemany = True
+            cursor.executemany("""
+            INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED, TOKENS)
+            VALUES (?, ?, 0, ?)
+            """, [(pdf_id, subfile, tokens) for subfile, tokens in subfiles])
+        cursor.execute("""
+        UPDATE PDFFiles
+        SET IS_PROCESSED = 1
+        WHERE PDF_ID = ?
+        """, pdf_id)
+        cnxn.commit()
+        return f'Ingested {file_path} as pdf {pdf_id} ({stats["pages"]} pages)'
+
+    except Exception:
+        error = traceback.format_exc(limit=3)
+        cnxn.rollback()
+        # Mark the document as deleted so it can be dropped again once it's fixed
+        if pdf_id is not None:
+            cursor.execute("""
+            UPDATE PDFFiles
+            SET IS_DELETED = 1, DELETED_DATE = GETDATE()
+            WHERE PDF_ID = ?
+            """, pdf_id)
+            cnxn.commit()
+        dirpath = os.path.join(os.path.dirname(file_path), re.sub(r'\W+', '_', os.path.splitext(filename)[0]))
+        if os.path.isdir(dirpath):
+            shutil.rmtree(dirpath)
+        try:
+            rejected_path = reject_file(user_id, file_path, rejected_dir)
+        except OSError as e:
+            return f'Error processing {file_path}, it could not be moved to {rejected_dir} ({e}): {error}'
+        return f'Error processing {file_path}, moved to {rejected_path}: {error}'
+    finally:
+        cursor.close()
+        cnxn.close()
+
+
+def watch(root, workers, debounce, rejected_dir=WATCH_REJECTED_DIR):
+    dropped = DroppedFiles(root)
+    observer = Observer()
+    observer.schedule(dropped, dropped.root, recursive=True)
+    observer.start()
+    dropped.scan()
+    print(f'Watching {dropped.root} with {workers} workers')
+
+    in_flight = set()
+    in_flight_lock = Lock()
+
+    def done(path):
+        def callback(message):
+            print(message)
+            with in_flight_lock:
+                in_flight.discard(path)
+        return callback
+
+    with Pool(workers, maxtasksperchild=BULK_INGEST_TASKS_PER_WORKER) as pool:
+        try:
+            while True:
+                time.sleep(0.5)
+                with in_flight_lock:
+                    free = workers - len(in_flight)
+                if free <= 0:
+                    continue
+
+                for path in dropped.pop_quiet(debounce, free):
+                    with in_flight_lock:
+                        if path in in_flight:
+                            # It changed while it was processed, it's checked again when it's done
+                            dropped.touch(path)
+                            continue
+                    if not os.path.isfile(path):
+                        continue
+                    if not is_complete_pdf(path):
+                        print(f'Waiting for {path} to be complete')
+                        continue
+                    if is_ingesting(path):
+                        # Copied by the API or bulk_ingest, it's checked again until it's in PDFFiles
+                        dropped.touch(path)
+                        continue
+
+                    user_id = user_of(dropped.root, path)
+                    target_path = os.path.join(os.path.dirname(path), standard_filename(path))
+                    if target_path != path:
+                        # Standardize the name as the upload endpoint does, the move is seen as a new event
+                        if not os.path.exists(target_path):
+                            os.replace(path, target_path)
+                        else:
+                            print(f'Skipped {path}: {os.path.basename(target_path)} already exists')
+                        continue
+
+                    with in_flight_lock:
+                        in_flight.add(path)
+                    pool.apply_async(ingest_dropped_file, (user_id, path, rejected_dir), callback=done(path),
+                                     error_callback=done(path))
+        except KeyboardInterrupt:
+            print('Stopping')
+        finally:
+            observer.stop()
+            observer.join()
+            pool.close()
+            pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingests the PDFs dropped in the folders of the users')
+    parser.add_argument('--root', default=path_to_listen, help='folder with a subfolder per user')
+    parser.add_argument('--workers', type=int, default=WATCH_WORKERS, help='PDFs processed at the same time')
+    parser.add_argument('--debounce', type=float, default=WATCH_DEBOUNCE_SECONDS,
+                        help='seconds without changes before a PDF is processed')
+    parser.add_argument('--rejected', default=WATCH_REJECTED_DIR, help='folder where the PDFs that fail are moved')
+    args = parser.parse_args()
+
+    load_dotenv()
+    watch(args.root, args.workers, args.debounce, args.rejected)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings, read from the working directory. The flags of the command (workers, worker class, timeout, bind)
+are kept in the Dockerfile.
+With PRELOAD_NLP_RESOURCES the master loads the tokenizer, the NLTK data and the heavy modules before forking the
+workers, so they are shared copy-on-write instead of loaded by every worker on its first request. The CPU workers of
+each gunicorn worker (see execution.py) are started, and load the NLP resources, when the gunicorn worker starts, and so
+is the reclaimer of the trash, which removes the documents left there before a restart.
+"""
+from env import PRELOAD_NLP_RESOURCES
+
+if PRELOAD_NLP_RESOURCES:
+    # The gevent workers patch the standard library when they start, the preloaded modules must import the patched one
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def on_starting(server):
+    if PRELOAD_NLP_RESOURCES:
+        from nlp_resources import preload
+        preload()
+
+
+def post_worker_init(worker):
+    # After the gevent worker patched the standard library, so the sockets of the CPU workers are cooperative
+    from execution import start_cpu_workers
+    from ingestion_jobs import get_reclaimer
+    start_cpu_workers()
+    get_reclaimer()
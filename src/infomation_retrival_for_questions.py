@@ -1,22 +1,59 @@
 import os
-import tiktoken
+from threading import Lock
+from collections import OrderedDict
+
 import numpy as np
 
-from rank_bm25 import BM25Okapi
-from env import retrival_threshold, MODEL, path_to_listen
+from env import retrival_threshold, path_to_listen, INDEX_CACHE_SIZE
+from env import RETRIEVAL_ENGINE, RETRIEVAL_TOP_K, LSA_COMPONENTS, LSA_WEIGHT, LSA_CANDIDATES, PAGE_LIMIT
 from preprocess_text import preprocess
+from sparse_retrieval import SparseBM25Index, index_file_path, is_index_outdated
+from dense_retrieval import DenseIndex, dense_index_file_path
+from nlp_resources import get_tokenizer, get_embedding_model
+from section_tree import load_section_tree, build_chapter_index
+from utils import text_sha256
+
+
+class IndexCache:
+    """
+    Indexes already loaded by this process, by folder path. Only the maxsize most recently used are kept, the rest are
+    loaded again from their files
+    """
+
+    def __init__(self, maxsize=INDEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, folder_path):
+        with self._lock:
+            entry = self._entries.get(folder_path)
+            if entry is not None:
+                self._entries.move_to_end(folder_path)
+            return entry
+
+    def __setitem__(self, folder_path, entry):
+        with self._lock:
+            self._entries[folder_path] = entry
+            self._entries.move_to_end(folder_path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
-tokenizer_BM25 = tiktoken.encoding_for_model(MODEL)
+
+# Sparse, dense and chapter indexes already loaded by this process
+_sparse_indexes = IndexCache()
+_dense_indexes = IndexCache()
+_chapter_indexes = IndexCache()
 
 
 # Function to tokenize text for BM25
 def tokenize_text(text):
     text = preprocess(text)
-    return tokenizer_BM25.encode(text)
+    return get_tokenizer().encode(text)
 
 
 # Function to tokenize text for BERT embeddings
-def read_files(pdf_foldername, user_id):
+def read_files(pdf_foldername, user_id, tokenize=True):
     corpus = []
     corpus_tokenized = []
     filenames = []
@@ -29,24 +66,205 @@ def read_files(pdf_foldername, user_id):
                 # To use BERT embeddings, uncomment the following line
                 # corpus_tokenized.append(get_embedding(text))
                 # To use BM25, uncomment the following line
-                corpus_tokenized.append(tokenize_text(text))
+                if tokenize:
+                    corpus_tokenized.append(tokenize_text(text))
                 filenames.append(filename)
     return corpus, corpus_tokenized, filenames
 
 
+def tokens_cache_path(folder_path):
+    # <user_id>/<pdf>/<pdf>_tokens.npz, the tokens of the sections by the hash of their text
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_tokens.npz')
+
+
+# Function to tokenize the sections of a document for BM25. The tokens are cached by the hash of the text of each
+# section, so when a new edition of the document is ingested only the sections that changed are tokenized again
+def tokenize_sections(folder_path, corpus):
+    file_path = tokens_cache_path(folder_path)
+    cached = {}
+    try:
+        with np.load(file_path) as data:
+            offsets = data['offsets']
+            tokens = data['tokens']
+            cached = {str(text_hash): tokens[offsets[i]:offsets[i + 1]] for i, text_hash in enumerate(data['hashes'])}
+    except (OSError, KeyError, ValueError):
+        pass
+
+    hashes = [text_sha256(text) for text in corpus]
+    corpus_tokenized = [cached[text_hash].tolist() if text_hash in cached else tokenize_text(text)
+                        for text_hash, text in zip(hashes, corpus)]
+    if set(cached) != set(hashes):
+        lengths = [len(tokens) for tokens in corpus_tokenized]
+        try:
+            np.savez(file_path,
+                     hashes=np.array(hashes),
+                     offsets=np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+                     tokens=np.fromiter((token for tokens in corpus_tokenized for token in tokens), dtype=np.int32,
+                                        count=sum(lengths)))
+        except OSError as e:
+            print(f"Error saving the tokens of {folder_path}: {e}")
+    return corpus_tokenized
+
+
 # Function to compute BM25 similarity
 def compute_bm25_similarity(raw_query, corpus_tokenized):
     query = tokenize_text(raw_query)
+    from rank_bm25 import BM25Okapi
+
     bm25 = BM25Okapi(corpus_tokenized)
     doc_scores = bm25.get_scores(query)
 
     return doc_scores
 
 
+# Function to load the sparse BM25 index of a document, building and storing it if it's missing or outdated
+def load_sparse_index(pdf_foldername, user_id):
+    folder_path = os.path.join(path_to_listen, user_id, pdf_foldername)
+    file_path = index_file_path(folder_path)
+
+    index = _sparse_indexes.get(folder_path)
+    if index is not None and not is_index_outdated(folder_path):
+        return index
+
+    if not is_index_outdated(folder_path):
+        index = SparseBM25Index.load(file_path, lsa_components=LSA_COMPONENTS)
+    else:
+        corpus, _, filenames = read_files(pdf_foldername, user_id, tokenize=False)
+        corpus_tokenized = tokenize_sections(folder_path, corpus)
+        index = SparseBM25Index(corpus_tokenized, filenames, lsa_components=LSA_COMPONENTS)
+        try:
+            index.save(file_path)
+        except OSError as e:
+            print(f"Error saving the sparse index {file_path}: {e}")
+        # The chapter index is built with the same tokens, so the sections are tokenized once
+        save_chapter_index(folder_path, corpus_tokenized, filenames)
+
+    _sparse_indexes[folder_path] = index
+    return index
+
+
+def chapter_index_file_path(folder_path):
+    # <user_id>/<pdf>/<pdf>_chapters.npz, next to the sparse index of the sections
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_chapters.npz')
+
+
+def save_chapter_index(folder_path, corpus_tokenized, filenames):
+    tree = load_section_tree(folder_path)
+    if tree is None:
+        return None
+    index = build_chapter_index(corpus_tokenized, filenames, tree)
+    try:
+        index.save(chapter_index_file_path(folder_path))
+    except OSError as e:
+        print(f"Error saving the chapter index of {folder_path}: {e}")
+    return index
+
+
+# Function to load the section tree and the BM25 index of the chapters of a document, building the index if it's
+# missing or outdated. Returns (None, None) if the document has no chapters
+def load_chapter_index(pdf_foldername, user_id):
+    folder_path = os.path.join(path_to_listen, user_id, pdf_foldername)
+    file_path = chapter_index_file_path(folder_path)
+
+    cached = _chapter_indexes.get(folder_path)
+    if cached is not None and not is_index_outdated(folder_path, file_path):
+        return cached
+
+    tree = load_section_tree(folder_path)
+    if tree is None:
+        return None, None
+    if not is_index_outdated(folder_path, file_path):
+        index = SparseBM25Index.load(file_path)
+    else:
+        corpus, _, filenames = read_files(pdf_foldername, user_id, tokenize=False)
+        index = save_chapter_index(folder_path, tokenize_sections(folder_path, corpus), filenames)
+
+    _chapter_indexes[folder_path] = tree, index
+    return tree, index
+
+
+# Function to load the embeddings of the sections of a document, computing and storing them if they are missing,
+# outdated or computed with another model
+def load_dense_index(pdf_foldername, user_id):
+    folder_path = os.path.join(path_to_listen, user_id, pdf_foldername)
+    file_path = dense_index_file_path(folder_path)
+    model = get_embedding_model()
+
+    index = _dense_indexes.get(folder_path)
+    if index is not None and index.model_name == model.name and not is_index_outdated(folder_path, file_path):
+        return index
+
+    stored = DenseIndex.load(file_path) if os.path.exists(file_path) else None
+    if stored is not None and stored.model_name == model.name and not is_index_outdated(folder_path, file_path):
+        index = stored
+    else:
+        corpus, _, filenames = read_files(pdf_foldername, user_id, tokenize=False)
+        hashes = [text_sha256(text) for text in corpus]
+        # Only the sections that changed since the stored embeddings are embedded
+        known = stored.embeddings_by_hash() if stored is not None and stored.model_name == model.name else {}
+        missing = [i for i, text_hash in enumerate(hashes) if text_hash not in known]
+        embeddings = dict(zip(missing, model.encode([corpus[i] for i in missing]))) if missing else {}
+        index = DenseIndex([embeddings[i] if i in embeddings else known[text_hash]
+                            for i, text_hash in enumerate(hashes)], filenames, model.name, hashes)
+        try:
+            index.save(file_path)
+        except OSError as e:
+            print(f"Error saving the dense index {file_path}: {e}")
+
+    _dense_indexes[folder_path] = index
+    return index
+
+
+# Function to get the most relevant documents of several questions with BM25 and the embeddings (RETRIEVAL_ENGINE
+# 'hybrid'), the questions are embedded in a single batch
+def get_most_relevant_docs_hybrid_many(raw_queries, index):
+    # The sections that go to the prompt, cut on the fused ranking (see HybridIndex)
+    return index.most_relevant_many([tokenize_text(raw_query) for raw_query in raw_queries],
+                                    get_embedding_model().encode(list(raw_queries)),
+                                    k=PAGE_LIMIT,
+                                    lsa_weight=LSA_WEIGHT,
+                                    lsa_candidates=LSA_CANDIDATES)
+
+
+# Function to get the most relevant documents with the sparse index
+def get_most_relevant_docs_sparse(raw_query, index):
+    return index.most_relevant(tokenize_text(raw_query),
+                               k=RETRIEVAL_TOP_K,
+                               lsa_weight=LSA_WEIGHT,
+                               lsa_candidates=LSA_CANDIDATES)
+
+
+# Function to get the most relevant documents of several questions with the sparse index, in a single matrix product
+def get_most_relevant_docs_sparse_many(raw_queries, index):
+    return index.most_relevant_many([tokenize_text(raw_query) for raw_query in raw_queries],
+                                    k=RETRIEVAL_TOP_K,
+                                    lsa_weight=LSA_WEIGHT,
+                                    lsa_candidates=LSA_CANDIDATES)
+
+
 # Function to get the most relevant documents
 def get_most_relevant_docs(raw_query, embeddings, filenames):
+    if RETRIEVAL_ENGINE == 'sparse':
+        return get_most_relevant_docs_sparse(raw_query, SparseBM25Index(embeddings, filenames,
+                                                                        lsa_components=LSA_COMPONENTS))
+
     doc_scores = compute_bm25_similarity(raw_query, embeddings)
+    return select_relevant_docs(doc_scores, filenames)
 
+
+# Function to get the most relevant documents of several questions, the BM25 model is built once for all of them
+def get_most_relevant_docs_many(raw_queries, embeddings, filenames):
+    if RETRIEVAL_ENGINE == 'sparse':
+        return get_most_relevant_docs_sparse_many(raw_queries, SparseBM25Index(embeddings, filenames,
+                                                                               lsa_components=LSA_COMPONENTS))
+    from rank_bm25 import BM25Okapi
+
+    bm25 = BM25Okapi(embeddings)
+    return [select_relevant_docs(bm25.get_scores(tokenize_text(raw_query)), filenames) for raw_query in raw_queries]
+
+
+# Function to keep the documents whose score is greater than retrival_threshold * best score
+def select_relevant_docs(doc_scores, filenames):
     sorted_doc_ids = np.argsort(doc_scores)[::-1]
     sorted_filenames = [filenames[i] for i in sorted_doc_ids]
     sorted_scores = [doc_scores[i] for i in sorted_doc_ids]
@@ -59,3 +277,5 @@ def get_most_relevant_docs(raw_query, embeddings, filenames):
             relevant_docs.append(i)
         else:
             return relevant_docs
+
+    return relevant_docs
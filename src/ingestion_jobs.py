@@ -0,0 +1,179 @@
+import os
+import uuid
+import hashlib
+import shutil
+from threading import Thread, Lock, Event
+
+import pyodbc
+
+from env import INGESTION_CANCEL_DIR, INGESTING_DIR, TRASH_DIR, RECLAIM_INTERVAL
+from execution import run_blocking
+from message_store import OWNER_PATTERN, process_owner, is_owner_alive
+
+
+class IngestionCancelled(Exception):
+    pass
+
+
+def _cancel_marker(pdf_id):
+    return os.path.join(INGESTION_CANCEL_DIR, str(pdf_id))
+
+
+def request_cancel(pdf_id):
+    # Asks the process that ingests the document to stop, the marker is seen by all the processes
+    os.makedirs(INGESTION_CANCEL_DIR, exist_ok=True)
+    open(_cancel_marker(pdf_id), 'w').close()
+
+
+def is_cancelled(pdf_id):
+    return os.path.exists(_cancel_marker(pdf_id))
+
+
+def clear_cancel(pdf_id):
+    try:
+        os.remove(_cancel_marker(pdf_id))
+    except FileNotFoundError:
+        pass
+
+
+def cancel_checker(pdf_id):
+    """
+    Returns a function that raises IngestionCancelled if the ingestion of the document was cancelled. The ingestion
+    calls it between pages and sections, it only checks if the marker file exists.
+    """
+    marker = _cancel_marker(pdf_id)
+
+    def check():
+        if os.path.exists(marker):
+            raise IngestionCancelled(f'Ingestion of the document {pdf_id} cancelled')
+    return check
+
+
+def _ingesting_marker(file_path):
+    return os.path.join(INGESTING_DIR, hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest())
+
+
+def mark_ingesting(file_path):
+    """
+    Marks a PDF copied to the folder of a user that is not in PDFFiles yet, so the folder watcher doesn't ingest it too.
+    The marker has the owner of the process (its pid and start time), it's ignored once the process stops, also when
+    its pid is used again after a restart.
+    """
+    os.makedirs(INGESTING_DIR, exist_ok=True)
+    with open(_ingesting_marker(file_path), 'w') as file:
+        file.write(process_owner())
+
+
+def clear_ingesting(file_path):
+    try:
+        os.remove(_ingesting_marker(file_path))
+    except FileNotFoundError:
+        pass
+
+
+def is_ingesting(file_path):
+    try:
+        with open(_ingesting_marker(file_path), 'r') as file:
+            owner = file.read().strip()
+    except OSError:
+        return False
+    return bool(OWNER_PATTERN.fullmatch(owner)) and is_owner_alive(owner)
+
+
+def move_to_trash(pdf_id, *paths):
+    """
+    Moves the files of a deleted document to the trash in a single rename each, the reclaimer removes them and marks
+    its sections as deleted in the background. Paths that don't exist are ignored.
+    """
+    entry = os.path.join(TRASH_DIR, f'{pdf_id}.{uuid.uuid4().hex}')
+    os.makedirs(entry + '.tmp')
+    for path in paths:
+        if path and os.path.exists(path):
+            os.replace(path, os.path.join(entry + '.tmp', os.path.basename(path)))
+    # The entry is visible to the reclaimer only when it's complete
+    os.replace(entry + '.tmp', entry)
+    return entry
+
+
+class Reclaimer(Thread):
+    """
+    Removes the files of the deleted documents from the trash and marks their sections as deleted in PDFSubFiles.
+    Each process has its own reclaimer, started with the worker; the trash entries are named <pdf_id>.<id> and are
+    claimed by renaming them to <pdf_id>.<id>.<owner> (process_owner), so only one process reclaims each of them and the
+    entries of a stopped process, or of a previous run of the container, are reclaimed again by the others.
+    """
+
+    def __init__(self, interval=RECLAIM_INTERVAL):
+        Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.pid = os.getpid()
+        self.owner = process_owner()
+        self._wake = Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                run_blocking(self.reclaim_all)
+            except Exception as e:
+                print(f"Error reclaiming deleted documents: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _claim(self, entry):
+        # Returns the (pdf_id, path) of the claimed entry, or None if it's not complete or another process has it
+        parts = entry.split('.')
+        if len(parts) not in (2, 3) or not parts[0].isdigit():
+            return None
+        if len(parts) == 3:
+            if not OWNER_PATTERN.fullmatch(parts[2]):
+                return None
+            if parts[2] != self.owner and is_owner_alive(parts[2]):
+                return None
+
+        claimed_path = os.path.join(TRASH_DIR, f'{parts[0]}.{parts[1]}.{self.owner}')
+        try:
+            os.replace(os.path.join(TRASH_DIR, entry), claimed_path)
+        except OSError:
+            return None
+        return int(parts[0]), claimed_path
+
+    def reclaim_all(self):
+        if not os.path.isdir(TRASH_DIR):
+            return
+        cnxn = None
+        try:
+            for entry in os.listdir(TRASH_DIR):
+                claimed = self._claim(entry)
+                if claimed is None:
+                    continue
+                pdf_id, path = claimed
+                if cnxn is None:
+                    cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+                with cnxn.cursor() as cursor:
+                    cursor.execute("""
+                    UPDATE PDFSubFiles
+                    SET IS_DELETED = 1, DELETED_DATE = GETDATE()
+                    WHERE PDF_ID = ? AND IS_DELETED = 0
+                    """, pdf_id)
+                    cnxn.commit()
+                shutil.rmtree(path)
+        finally:
+            if cnxn is not None:
+                cnxn.close()
+
+
+_reclaimer = None
+_reclaimer_lock = Lock()
+
+
+def get_reclaimer():
+    # Each forked worker starts its own thread, when it starts (gunicorn.conf.py) or on its first delete
+    global _reclaimer
+    with _reclaimer_lock:
+        if _reclaimer is None or _reclaimer.pid != os.getpid():
+            _reclaimer = Reclaimer()
+            _reclaimer.start()
+    return _reclaimer
@@ -0,0 +1,153 @@
+import math
+import xml.etree.ElementTree as ET
+from array import array
+
+import numpy as np
+
+# Number of texts merged in every chunk of the text arena
+ARENA_CHUNK = 4096
+
+
+class LineRecords:
+    """
+    Columnar storage of the lines extracted from a PDF. Instead of one dict per line, the texts are kept in a text
+    arena (one string every ARENA_CHUNK lines) with the offset of every line, the font names are interned, and the
+    sizes, pages and vertical positions are kept in typed arrays (float32/int32), so they can be used as NumPy arrays
+    without copies.
+    Iterating the records still yields the {'text', 'font', 'size', 'page', 'y'} dicts of extract_text_with_font_info.
+    """
+
+    def __init__(self):
+        self._arena = []
+        self._pending = []
+        self._offsets = array('q', [0])
+        self._font_ids = array('H')
+        self._sizes = array('f')
+        self._pages = array('i')
+        self._ys = array('f')
+        self.fonts = []
+        self._font_index = {}
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def append(self, text, font, size, page, y=None):
+        font_id = self._font_index.get(font)
+        if font_id is None:
+            font_id = self._font_index[font] = len(self.fonts)
+            self.fonts.append(font)
+
+        self._pending.append(text)
+        self._offsets.append(self._offsets[-1] + len(text))
+        self._font_ids.append(font_id)
+        self._sizes.append(size)
+        self._pages.append(page)
+        self._ys.append(math.nan if y is None else y)
+
+        if len(self._pending) == ARENA_CHUNK:
+            self._arena.append(''.join(self._pending))
+            self._pending = []
+
+    def text(self, i):
+        chunk = i // ARENA_CHUNK
+        if chunk == len(self._arena):
+            return self._pending[i % ARENA_CHUNK]
+
+        chunk_start = self._offsets[chunk * ARENA_CHUNK]
+        return self._arena[chunk][self._offsets[i] - chunk_start:self._offsets[i + 1] - chunk_start]
+
+    def font(self, i):
+        return self.fonts[self._font_ids[i]]
+
+    @property
+    def sizes(self):
+        return np.frombuffer(self._sizes, dtype=np.float32)
+
+    @property
+    def pages(self):
+        return np.frombuffer(self._pages, dtype=np.int32)
+
+    @property
+    def ys(self):
+        return np.frombuffer(self._ys, dtype=np.float32)
+
+    def __getitem__(self, i):
+        y = self._ys[i]
+        return {'text': self.text(i),
+                'font': self.font(i),
+                'size': self._sizes[i],
+                'page': self._pages[i],
+                'y': None if math.isnan(y) else y}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lines_by_page(self):
+        """
+        Returns the indexes of the lines of each page, {page: array of indexes} in the order of the document
+        """
+        pages = self.pages
+        order = np.argsort(pages, kind='stable')
+        unique, starts = np.unique(pages[order], return_index=True)
+        return dict(zip(unique.tolist(), np.split(order, starts[1:])))
+
+    def extend(self, other, indexes, page):
+        # Appends the lines of other at indexes, moved to page
+        for i in indexes:
+            record = other[i]
+            self.append(record['text'], record['font'], record['size'], page, record['y'])
+
+    def section_boundaries(self, indexes=None, threshold=0.85):
+        """
+        Vectorized version of the size ratio test of segment_text: a line starts a new section when the size of the
+        previous line divided by its size is between 0 and threshold (the font grows more than 1 - threshold).
+        :param indexes: Indexes of the lines taken into account (the rest are skipped), by default all of them
+        :return: Positions (in indexes) of the lines that start a new section
+        """
+        sizes = self.sizes if indexes is None else self.sizes[indexes]
+        if len(sizes) < 2:
+            return np.array([], dtype=np.int64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = sizes[:-1].astype(np.float64) / sizes[1:]
+        return np.nonzero((ratios > 0.0) & (ratios < threshold))[0] + 1
+
+    def to_xml(self, file_obj, clean=None):
+        """
+        Writes the records as the XML of the extraction (root/doc/field1..field5) line by line, without building the
+        element tree in memory
+        :param clean: Function applied to every text to remove the characters that are not allowed in XML
+        """
+        file_obj.write('<root>')
+        for i in range(len(self)):
+            record = self[i]
+            doc = ET.Element('doc')
+            ET.SubElement(doc, "field1", name="text").text = record['text']
+            ET.SubElement(doc, "field2", name="font").text = record['font']
+            ET.SubElement(doc, "field3", name="size").text = str(round(record['size'], 4))
+            ET.SubElement(doc, "field4", name="page").text = str(record['page'])
+            if record['y'] is not None:
+                ET.SubElement(doc, "field5", name="y").text = str(round(record['y'], 4))
+            content = ET.tostring(doc, encoding='unicode')
+            file_obj.write(clean(content) if clean else content)
+        file_obj.write('</root>')
+
+    @classmethod
+    def from_xml(cls, xml_file_path):
+        """
+        Loads the records of an XML written by the extraction. The XML files written before the page and position of
+        the lines were stored get page -1 and no position.
+        """
+        records = cls()
+        for _, doc in ET.iterparse(xml_file_path):
+            if doc.tag != 'doc':
+                continue
+            y = doc.findtext('field5')
+            records.append(doc.findtext('field1') or '',
+                           doc.findtext('field2'),
+                           float(doc.findtext('field3')),
+                           int(doc.findtext('field4') or -1),
+                           float(y) if y else None)
+            doc.clear()
+        return records
@@ -0,0 +1,240 @@
+"""
+Process wide client of the LLM API. All the calls, the direct ones and the ones of langchain, share a pooled HTTP
+session with keep-alive and go through the same timeout, retries with jittered exponential backoff and circuit
+breaker, and the latency and tokens of each call are logged. With MODEL_ROUTING the model and max_tokens of each call
+are chosen by model_router.ModelRouter.
+LLM_API_BASE (or the LLM_API_BASE environment variable) points the client to any OpenAI compatible server, for
+example benchmarks/llm_stub_server.py in the tests and benchmarks.
+"""
+import os
+import time
+import random
+from threading import Lock
+
+from env import MODEL, LLM_API_BASE, LLM_TIMEOUT, LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX
+from env import LLM_BREAKER_FAILURES, LLM_BREAKER_RESET, LLM_POOL_SIZE, MODEL_ROUTING
+from model_router import ModelRouter, current_call_type
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed calls, then rejects the calls for reset_after seconds. After that one
+    call is let through: if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, failures=LLM_BREAKER_FAILURES, reset_after=LLM_BREAKER_RESET):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or time.monotonic() - self.opened_at < self.reset_after:
+                raise CircuitOpen(f'LLM API unavailable after {self.consecutive_failures} failed calls')
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial = False
+            if self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        # The call ended without a result of the API (killed at its deadline, a bug before the request), the next call
+        # can be the trial
+        with self._lock:
+            self._trial = False
+
+
+class LLMClient:
+    """
+    Drop-in replacement of openai.ChatCompletion: create() takes the same arguments and returns the same response.
+    """
+
+    def __init__(self, api_base=None, api_key=None, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                 pool_size=LLM_POOL_SIZE, routing=MODEL_ROUTING):
+        import openai
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_base = api_base
+        # A local OpenAI compatible server doesn't check the key, but openai needs one
+        self.api_key = api_key or os.getenv('OPENAI_API_KEY') or ('stub' if api_base else None)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker()
+        self.router = ModelRouter() if routing else None
+        self._stats = {'calls': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0,
+                       'prompt_tokens': 0, 'completion_tokens': 0}
+        self._stats_lock = Lock()
+
+        # openai keeps a session per thread, which is a session per greenlet in the gevent workers, so the
+        # connections would not be reused between requests. This session is shared by all of them.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        openai.requestssession = self.session
+
+        error = openai.error
+        self._retryable = (error.RateLimitError, error.APIConnectionError, error.Timeout,
+                           error.ServiceUnavailableError, error.TryAgain)
+        self._api_error = error.APIError
+
+    def _should_retry(self, e):
+        if isinstance(e, self._retryable):
+            return True
+        # Server errors of the API, the errors of the request (4xx) are not retried
+        return type(e) is self._api_error and (getattr(e, 'http_status', None) or 500) >= 500
+
+    def unavailable(self, e):
+        # True if the exception means that the API is down, overloaded or rate limited, not that the request is wrong
+        return isinstance(e, CircuitOpen) or self._should_retry(e)
+
+    def _backoff(self, attempt, e):
+        retry_after = (getattr(e, 'headers', None) or {}).get('retry-after')
+        delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt)
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        # Full jitter, so the workers that were rate limited at the same time don't retry at the same time
+        return random.uniform(delay / 2, delay)
+
+    def _route(self, call_type, kwargs):
+        # Sets the model and max_tokens of the call, an explicit max_tokens is kept if it's lower, or always in the
+        # answers (see ModelRouter)
+        from nlp_resources import get_tokenizer
+
+        prompt_tokens = self.router.prompt_tokens(get_tokenizer(), kwargs.get('messages') or [])
+        tier, model, max_tokens = self.router.route(call_type, prompt_tokens, kwargs.get('max_tokens'))
+        kwargs['model'] = model
+        kwargs['max_tokens'] = min(kwargs['max_tokens'], max_tokens) if kwargs.get('max_tokens') else max_tokens
+        print(f"LLM route {call_type}: {prompt_tokens} prompt tokens -> {model} (tier {tier}, "
+              f"max_tokens {kwargs['max_tokens']})")
+
+    def create(self, call_type=None, **kwargs):
+        """
+        :param call_type: 'entities', 'summarize' or 'answer', the type set with model_router.llm_call_type by default
+        """
+        self.breaker.before_call()
+        try:
+            return self._call(call_type or current_call_type(), kwargs)
+        except BaseException:
+            # Also GreenletExit, when run_with_deadline kills the greenlet of the call
+            self.breaker.release()
+            raise
+
+    def _call(self, call_type, kwargs):
+        import openai
+
+        if self.router is not None:
+            self._route(call_type, kwargs)
+        # langchain passes the arguments it doesn't set as None or empty strings
+        for name, value in (('model', MODEL), ('request_timeout', self.timeout), ('api_base', self.api_base),
+                            ('api_key', self.api_key)):
+            if not kwargs.get(name) and value is not None:
+                kwargs[name] = value
+
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = openai.ChatCompletion.create(**kwargs)
+                break
+            except Exception as e:
+                if not self._should_retry(e):
+                    # The request is wrong (too many tokens, invalid key...), the API is fine
+                    self.breaker.success()
+                    self._record(time.perf_counter() - start, error=True)
+                    raise
+                if attempt == self.max_retries:
+                    self.breaker.failure()
+                    self._record(time.perf_counter() - start, error=True)
+                    raise
+                delay = self._backoff(attempt, e)
+                print(f"LLM call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+                self._record(0, retry=True)
+                time.sleep(delay)
+
+        self.breaker.success()
+        latency = time.perf_counter() - start
+        usage = response.get('usage') or {}
+        self._record(latency, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        print(f"LLM call {call_type} {kwargs['model']}: {latency:.2f}s, {usage.get('prompt_tokens', 0)} prompt tokens, "
+              f"{usage.get('completion_tokens', 0)} completion tokens")
+        return response
+
+    def _record(self, seconds, prompt_tokens=0, completion_tokens=0, error=False, retry=False):
+        with self._stats_lock:
+            self._stats['calls'] += not retry
+            self._stats['errors'] += error
+            self._stats['retries'] += retry
+            self._stats['seconds'] += seconds
+            self._stats['prompt_tokens'] += prompt_tokens
+            self._stats['completion_tokens'] += completion_tokens
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def chat_model(self, model_name=MODEL, temperature=0, call_type=None):
+        """
+        Returns the langchain ChatOpenAI of the model, shared by all the conversations, whose calls go through this
+        client
+        :param call_type: Type of all the calls of the model for the routing, by default the one of llm_call_type
+        """
+        key = (model_name, temperature, call_type)
+        model = _chat_models.get(key)
+        if model is None:
+            from langchain.chat_models import ChatOpenAI
+
+            credentials = {'openai_api_key': self.api_key} if self.api_key else {}
+            if self.api_base:
+                credentials['openai_api_base'] = self.api_base
+            model = ChatOpenAI(temperature=temperature, model_name=model_name, verbose=False,
+                               request_timeout=self.timeout, max_retries=1, **credentials)
+            # ChatOpenAI sets openai.ChatCompletion as its client, the retries and the breaker are the ones of this one
+            model.client = self if call_type is None else TypedCalls(self, call_type)
+            _chat_models[key] = model
+        return model
+
+
+class TypedCalls:
+    # Client of a langchain model whose calls have all the same type
+    def __init__(self, client, call_type):
+        self.client = client
+        self.call_type = call_type
+
+    def create(self, **kwargs):
+        return self.client.create(call_type=self.call_type, **kwargs)
+
+
+_client = None
+_chat_models = {}
+_client_lock = Lock()
+
+
+def get_llm_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMClient(api_base=LLM_API_BASE or os.getenv('LLM_API_BASE'))
+    return _client
@@ -0,0 +1,164 @@
+"""
+Archiver of the messages of the closed chats (CHATS.IS_CHAT_CLOSED). They are moved from MESSAGES to MESSAGES_ARCHIVE,
+with their long texts compressed, in transactions of ARCHIVE_BATCH_CHATS chats, so MESSAGES only keeps the open chats
+that the questions read. Each chat is moved with a single DELETE ... OUTPUT INTO that seeks the history index of
+MESSAGES, and the bytes removed from MESSAGES and the ones written in the archive are reported.
+
+    python message_archive.py             # a pass every ARCHIVE_INTERVAL seconds
+    python message_archive.py --once      # a single pass
+    python message_archive.py --report    # bytes saved by the compression and the archive
+
+The report reads every row of MESSAGES and MESSAGES_ARCHIVE, so it's meant to be run now and then, not in every pass.
+"""
+import os
+import time
+import argparse
+
+import pyodbc
+from dotenv import load_dotenv
+
+from env import ARCHIVE_BATCH_CHATS, ARCHIVE_INTERVAL, MESSAGE_COMPRESS_CHARS
+
+CLOSED_CHATS = """
+SELECT TOP (?) c.CHAT_ID, c.USER_ID, c.PDF_ID
+FROM CHATS c
+WHERE c.IS_CHAT_CLOSED = 1
+AND EXISTS (SELECT 1 FROM MESSAGES m WHERE m.CHAT_ID = c.CHAT_ID AND m.USER_ID = c.USER_ID AND m.PDF_ID = c.PDF_ID)
+"""
+
+# The messages longer than MESSAGE_COMPRESS_CHARS are compressed with COMPRESS (gzip), as message_store does for the
+# ones in MESSAGE_COMPRESS_TYPES. The second OUTPUT returns the id and the bytes each message used in MESSAGES
+ARCHIVE_CHAT = """
+DELETE FROM MESSAGES
+OUTPUT DELETED.MESSAGE_ID, DELETED.USER_ID, DELETED.DATE, DELETED.TYPE_OF_MESSAGE,
+       CASE WHEN LEN(DELETED.MESSAGE) > ? THEN NULL ELSE DELETED.MESSAGE END,
+       CASE WHEN LEN(DELETED.MESSAGE) > ? THEN COMPRESS(DELETED.MESSAGE) ELSE DELETED.MESSAGE_BLOB END,
+       DELETED.PDF_ID, DELETED.NUMBER_OF_TOKENS, DELETED.CHAT_ID, DELETED.ANSWER_MODE
+INTO MESSAGES_ARCHIVE (MESSAGE_ID, USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, MESSAGE_BLOB, PDF_ID, NUMBER_OF_TOKENS,
+                       CHAT_ID, ANSWER_MODE)
+OUTPUT DELETED.MESSAGE_ID, ISNULL(DATALENGTH(DELETED.MESSAGE), 0) + ISNULL(DATALENGTH(DELETED.MESSAGE_BLOB), 0)
+WHERE CHAT_ID = ? AND USER_ID = ? AND PDF_ID = ?
+"""
+
+# The messages of the chat archived by a previous pass have lower ids than the ones just moved
+ARCHIVED_BYTES = """
+SELECT SUM(ISNULL(CAST(DATALENGTH(MESSAGE) AS BIGINT), 0) + ISNULL(DATALENGTH(MESSAGE_BLOB), 0))
+FROM MESSAGES_ARCHIVE
+WHERE CHAT_ID = ? AND USER_ID = ? AND PDF_ID = ? AND MESSAGE_ID >= ?
+"""
+
+
+def archive_closed_chats(cnxn, cursor, batch_chats=ARCHIVE_BATCH_CHATS, max_batches=None):
+    """
+    Moves the messages of the closed chats to MESSAGES_ARCHIVE, a transaction per batch of chats, until no closed chat
+    has messages in MESSAGES (or max_batches batches)
+    :return: Dictionary with the chats and messages moved, the bytes removed from MESSAGES and the bytes they use in
+    the archive
+    """
+    stats = {'chats': 0, 'messages': 0, 'bytes_removed': 0, 'bytes_archived': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        cursor.execute(CLOSED_CHATS, batch_chats)
+        chats = cursor.fetchall()
+        if not chats:
+            break
+
+        try:
+            for chat_id, user_id, pdf_id in chats:
+                cursor.execute(ARCHIVE_CHAT, MESSAGE_COMPRESS_CHARS, MESSAGE_COMPRESS_CHARS, chat_id, user_id, pdf_id)
+                moved = cursor.fetchall()
+                if not moved:
+                    continue
+                cursor.execute(ARCHIVED_BYTES, chat_id, user_id, pdf_id, min(row[0] for row in moved))
+                stats['bytes_archived'] += cursor.fetchone()[0] or 0
+                stats['messages'] += len(moved)
+                stats['bytes_removed'] += sum(row[1] for row in moved)
+            cnxn.commit()
+        except pyodbc.Error:
+            cnxn.rollback()
+            raise
+        stats['chats'] += len(chats)
+        batches += 1
+        print(f"Archived {stats['chats']} chats, {stats['messages']} messages, "
+              f"{stats['bytes_removed']} bytes removed from MESSAGES")
+    return stats
+
+
+def storage_report(cursor):
+    """
+    :return: {table: (rows, bytes of the messages, compressed rows, bytes of the compressed rows, bytes of their text)}
+    of MESSAGES and MESSAGES_ARCHIVE
+    """
+    report = {}
+    for table in ('MESSAGES', 'MESSAGES_ARCHIVE'):
+        cursor.execute(f"""
+        SELECT COUNT_BIG(*),
+               SUM(ISNULL(CAST(DATALENGTH(MESSAGE) AS BIGINT), 0) + ISNULL(DATALENGTH(MESSAGE_BLOB), 0)),
+               COUNT_BIG(MESSAGE_BLOB),
+               SUM(CAST(DATALENGTH(MESSAGE_BLOB) AS BIGINT)),
+               SUM(CAST(DATALENGTH(DECOMPRESS(MESSAGE_BLOB)) AS BIGINT))
+        FROM {table}
+        """)
+        report[table] = tuple(value or 0 for value in cursor.fetchone())
+    return report
+
+
+def print_report(report):
+    saved = 0
+    for table, (rows, size, compressed_rows, compressed_size, text_size) in report.items():
+        saved += text_size - compressed_size
+        print(f'{table}: {rows} messages, {size} bytes. {compressed_rows} compressed messages use {compressed_size} '
+              f'bytes instead of {text_size} ({text_size - compressed_size} bytes saved)')
+    print(f'Bytes saved by the compression: {saved}. Bytes of the closed chats kept out of MESSAGES in the archive: '
+          f'{report["MESSAGES_ARCHIVE"][1]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Moves the messages of the closed chats to MESSAGES_ARCHIVE')
+    parser.add_argument('--once', action='store_true', help='run a single pass')
+    parser.add_argument('--report', action='store_true', help='print the bytes saved and exit')
+    parser.add_argument('--batch-chats', type=int, default=ARCHIVE_BATCH_CHATS)
+    parser.add_argument('--interval', type=float, default=ARCHIVE_INTERVAL, help='seconds between passes')
+    args = parser.parse_args()
+
+    load_dotenv()
+    cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+    cursor = cnxn.cursor()
+    try:
+        if args.report:
+            print_report(storage_report(cursor))
+            return
+
+        while True:
+            start = time.perf_counter()
+            try:
+                stats = archive_closed_chats(cnxn, cursor, args.batch_chats)
+                print(f"Pass done in {time.perf_counter() - start:.1f}s: {stats['chats']} chats, "
+                      f"{stats['messages']} messages, {stats['bytes_removed']} bytes removed from MESSAGES, "
+                      f"{stats['bytes_archived']} bytes in the archive "
+                      f"({stats['bytes_removed'] - stats['bytes_archived']} bytes saved)")
+            except pyodbc.Error as e:
+                print(f'Error archiving the messages: {e}')
+                if args.once:
+                    raise
+                try:
+                    cnxn.close()
+                except pyodbc.Error:
+                    pass
+                time.sleep(args.interval)
+                cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+                cursor = cnxn.cursor()
+                continue
+            if args.once:
+                break
+            time.sleep(args.interval)
+    finally:
+        try:
+            cursor.close()
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+
+
+if __name__ == '__main__':
+    main()
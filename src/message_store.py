@@ -0,0 +1,418 @@
+import os
+import re
+import gzip
+import json
+import time
+import uuid
+import queue
+import atexit
+from datetime import datetime, timedelta
+from threading import Thread, Lock
+from collections import Counter, namedtuple
+
+import pyodbc
+
+from env import MESSAGES_WRITE_BEHIND, MESSAGES_SPOOL_DIR, MESSAGES_BATCH_SIZE, MESSAGES_MAX_ATTEMPTS, SLEEP_TIME
+from env import MESSAGE_COMPRESS_TYPES, MESSAGE_COMPRESS_CHARS, MESSAGES_HISTORY_WAIT
+from execution import run_blocking
+
+INSERT_MESSAGES = """
+INSERT INTO MESSAGES (USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID, NUMBER_OF_TOKENS, CHAT_ID, ANSWER_MODE,
+                      MESSAGE_BLOB)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# DATETIME columns of SQL Server round to 1/300 s, the messages of a batch are kept this far apart so they are still
+# returned in order by ORDER BY DATE
+MIN_DATE_STEP = timedelta(milliseconds=4)
+
+# A row of MESSAGES in the order of INSERT_MESSAGES, without MESSAGE_BLOB
+MessageRow = namedtuple('MessageRow', ['user_id', 'date', 'type_of_message', 'message', 'pdf_id', 'number_of_tokens',
+                                       'chat_id', 'answer_mode'])
+
+# <pid> or <pid>-<start time> of the process that owns a file, see process_owner
+OWNER_PATTERN = re.compile(r'\d+(-\d+)?')
+
+
+class MessageBatch:
+    """
+    Messages of a question (intermediate 'F' prompts, 'P' prompt and 'L' answer) that are saved together.
+    The date of each message is taken when it's added, so the order of the conversation does not depend on when the
+    batch is written.
+    """
+
+    def __init__(self, user_id, pdf_id, chat_id):
+        self.user_id = user_id
+        self.pdf_id = pdf_id
+        self.chat_id = chat_id
+        self.rows = []
+
+    def add(self, type_of_message, message, number_of_tokens, answer_mode=None):
+        """
+        :param answer_mode: 'llm', 'extractive' or 'fallback' in the prompt and answer of a question, see ANSWER_MODE
+        """
+        date = datetime.now()
+        if self.rows and date - self.rows[-1].date < MIN_DATE_STEP:
+            date = self.rows[-1].date + MIN_DATE_STEP
+        self.rows.append(MessageRow(self.user_id, date, type_of_message, message, self.pdf_id, number_of_tokens,
+                                    self.chat_id, answer_mode))
+
+
+def compress_message(message):
+    # gzip of the UTF-16 text, the format of COMPRESS(<NVARCHAR>) in SQL Server
+    return gzip.compress(message.encode('utf-16-le'))
+
+
+def read_message(message, message_blob=None):
+    """
+    Returns the text of a row of MESSAGES or MESSAGES_ARCHIVE, from MESSAGE_BLOB when it's compressed
+    """
+    if message_blob is None:
+        return message
+    return gzip.decompress(message_blob).decode('utf-16-le')
+
+
+def compact_row(row):
+    # The long messages of MESSAGE_COMPRESS_TYPES are stored in MESSAGE_BLOB and their MESSAGE is NULL
+    message = row[3]
+    if row[2] in MESSAGE_COMPRESS_TYPES and message and len(message) > MESSAGE_COMPRESS_CHARS:
+        return (*row[:3], None, *row[4:8], compress_message(message))
+    return (*row[:8], None)
+
+
+def insert_messages(cnxn, cursor, rows):
+    """
+    Inserts the rows in MESSAGES in a single transaction
+    """
+    if not rows:
+        return
+    try:
+        cursor.fast_executemany = True
+        # fast_executemany takes the types of the first row, where MESSAGE (compressed) or MESSAGE_BLOB can be NULL
+        cursor.setinputsizes([None] * 3 + [(pyodbc.SQL_WVARCHAR, 0, 0)] + [None] * 4 + [(pyodbc.SQL_VARBINARY, 0, 0)])
+        cursor.executemany(INSERT_MESSAGES, [compact_row(row) for row in rows])
+        cnxn.commit()
+    finally:
+        cursor.fast_executemany = False
+        cursor.setinputsizes(None)
+
+
+def is_connection_error(error):
+    # The errors of the connection or the server are retried, the ones of the rows (constraints, truncation...) are not
+    return isinstance(error, (pyodbc.OperationalError, pyodbc.InterfaceError, pyodbc.InternalError))
+
+
+def chat_key(rows):
+    # (user, document, chat) of the batch, as strings since the routes and the spool files don't keep the same types
+    return str(rows[0][0]), str(rows[0][4]), str(rows[0][6])
+
+
+class MessageWriter(Thread):
+    """
+    Write-behind queue for the MESSAGES inserts. Every batch is first written to a spool file (fsync'ed), so the
+    request can return without waiting for the database, and a background thread inserts the queued batches with its
+    own connection, deleting the spool files once they are committed. If the database is slow or down the batches stay
+    in the queue and in the spool, and the spool files left by a stopped process are inserted when the writer starts.
+    When the rows of the batches are rejected, the batches are inserted one by one, and the ones rejected
+    MESSAGES_MAX_ATTEMPTS times are moved to the failed folder of the spool so they don't block the others.
+    """
+
+    def __init__(self, spool_dir=MESSAGES_SPOOL_DIR, batch_size=MESSAGES_BATCH_SIZE,
+                 max_attempts=MESSAGES_MAX_ATTEMPTS):
+        Thread.__init__(self, daemon=True)
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue()
+        self.cnxn = None
+        self.pid = os.getpid()
+        self.owner = process_owner()
+        # Rejected attempts of each spool file and batches not written yet of each chat
+        self.attempts = Counter()
+        self.pending = Counter()
+        self.pending_lock = Lock()
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def submit(self, rows):
+        if rows:
+            self._put((self._spool(rows), rows))
+
+    def _put(self, item):
+        with self.pending_lock:
+            self.pending[chat_key(item[1])] += 1
+        self.queue.put(item)
+
+    def _done(self, item):
+        key = chat_key(item[1])
+        with self.pending_lock:
+            self.pending[key] -= 1
+            if self.pending[key] <= 0:
+                del self.pending[key]
+        self.attempts.pop(item[0], None)
+
+    def _spool(self, rows):
+        # The spool files are named <id>.<owner>.json, so the other workers know which process owns them
+        file_path = os.path.join(self.spool_dir, f'{uuid.uuid4().hex}.{self.owner}.json')
+        with open(file_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump([[row[0], row[1].isoformat(), *row[2:]] for row in rows], file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_path + '.tmp', file_path)
+        return file_path
+
+    def recover_spool(self):
+        """
+        Queues the spool files of the processes that are no longer running, including the ones of a previous run of the
+        container whose pids are used again. The files are claimed by renaming them with the owner of this process, so
+        only one writer inserts each of them.
+        """
+        for filename in os.listdir(self.spool_dir):
+            parts = filename.split('.')
+            if len(parts) != 3 or parts[2] != 'json' or not OWNER_PATTERN.fullmatch(parts[1]):
+                continue
+            if parts[1] == self.owner or is_owner_alive(parts[1]):
+                continue
+
+            claimed_path = os.path.join(self.spool_dir, f'{parts[0]}.{self.owner}.json')
+            try:
+                os.replace(os.path.join(self.spool_dir, filename), claimed_path)
+            except OSError as e:
+                print(f"Error recovering the spooled messages {filename}: {e}")
+                continue
+            try:
+                with open(claimed_path, 'r', encoding='utf-8') as file:
+                    # The files spooled before ANSWER_MODE have 7 columns
+                    rows = [(row[0], datetime.fromisoformat(row[1]), *row[2:7], row[7] if len(row) > 7 else None)
+                            for row in json.load(file)]
+            except (OSError, ValueError, TypeError, IndexError) as e:
+                print(f"Error recovering the spooled messages {filename}, moved to {self.failed_dir}: {e}")
+                self._quarantine(claimed_path)
+                continue
+            if rows:
+                self._put((claimed_path, rows))
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._write_items(items)
+            except Exception as e:
+                # The thread must not stop, the batches that are still in the spool are queued again
+                print(f"Error writing {len(items)} message batches, retrying in {SLEEP_TIME}s: {e}")
+                self._close()
+                time.sleep(SLEEP_TIME)
+                for item in items:
+                    if os.path.exists(item[0]):
+                        self.queue.put(item)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _write_items(self, items):
+        try:
+            # Under gevent this thread is a greenlet, the inserts run in a native thread
+            run_blocking(self._write, items)
+        except Exception as e:
+            if isinstance(e, pyodbc.Error) and is_connection_error(e):
+                self._retry(items, e)
+                return
+            if len(items) == 1:
+                self._rejected(items[0], e)
+                return
+            print(f"Error writing {len(items)} message batches, writing them one by one: {e}")
+        else:
+            for item in items:
+                self._done(item)
+            return
+
+        # One rejected row makes the whole transaction fail, so the batches are written alone to find it
+        for position, item in enumerate(items):
+            try:
+                run_blocking(self._write, [item])
+            except Exception as e:
+                if isinstance(e, pyodbc.Error) and is_connection_error(e):
+                    self._retry(items[position:], e)
+                    return
+                self._rejected(item, e)
+            else:
+                self._done(item)
+
+    def _retry(self, items, error):
+        print(f"Error writing {len(items)} message batches, retrying in {SLEEP_TIME}s: {error}")
+        self._close()
+        time.sleep(SLEEP_TIME)
+        for item in items:
+            self.queue.put(item)
+
+    def _rejected(self, item, error):
+        spool_path = item[0]
+        self.attempts[spool_path] += 1
+        if self.attempts[spool_path] < self.max_attempts:
+            print(f"Error writing the messages of {spool_path} (attempt {self.attempts[spool_path]}): {error}")
+            self.queue.put(item)
+            return
+        print(f"Messages of {spool_path} rejected {self.attempts[spool_path]} times, moved to {self.failed_dir}: "
+              f"{error}")
+        self._quarantine(spool_path)
+        self._done(item)
+
+    def _quarantine(self, spool_path):
+        try:
+            os.makedirs(self.failed_dir, exist_ok=True)
+            os.replace(spool_path, os.path.join(self.failed_dir, os.path.basename(spool_path)))
+        except OSError as e:
+            print(f"Error moving {spool_path} to {self.failed_dir}: {e}")
+
+    def _write(self, items):
+        if self.cnxn is None:
+            self.cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+        cursor = self.cnxn.cursor()
+        try:
+            insert_messages(self.cnxn, cursor, [row for _, rows in items for row in rows])
+        except Exception:
+            self.cnxn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        for spool_path, _ in items:
+            try:
+                os.remove(spool_path)
+            except OSError:
+                pass
+
+    def _close(self):
+        try:
+            self.cnxn.close()
+        except (pyodbc.Error, AttributeError):
+            pass
+        self.cnxn = None
+
+    def flush(self, timeout=10):
+        """
+        Waits up to timeout seconds for the queued batches to be written, the rest remain in the spool
+        """
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def wait_for_chat(self, user_id, pdf_id, chat_id, timeout):
+        """
+        Waits up to timeout seconds for the queued batches of the chat to be written
+        :return: True if the chat has no batches left in the queue
+        """
+        key = str(user_id), str(pdf_id), str(chat_id)
+        deadline = time.monotonic() + timeout
+        while self.pending.get(key) and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return not self.pending.get(key)
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_start_time(pid):
+    # Start time of the process in clock ticks after the boot, None if it's not running or there is no /proc
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as file:
+            stat = file.read()
+    except OSError:
+        return None
+    # The name of the process (2nd field) can have spaces, starttime is the 20th field after it
+    try:
+        return int(stat.rsplit(b')', 1)[1].split()[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def process_owner(pid=None):
+    """
+    Owner written in the spool files, the ingestion markers and the trash entries of a process: <pid>-<start time>, so
+    a pid used again after a restart of the container is not taken for the process that wrote them. Only the pid
+    without /proc.
+    """
+    pid = os.getpid() if pid is None else pid
+    start = process_start_time(pid)
+    return str(pid) if start is None else f'{pid}-{start}'
+
+
+def is_owner_alive(owner):
+    # True if the process of the owner (process_owner) is running, the owners without start time are checked by the pid
+    pid, _, start = owner.partition('-')
+    if not is_process_alive(int(pid)):
+        return False
+    return not start or process_start_time(int(pid)) == int(start)
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def get_message_writer():
+    # The writer is created lazily, so each forked worker starts its own thread
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = MessageWriter()
+            _writer.recover_spool()
+            _writer.start()
+            atexit.register(_writer.flush)
+    return _writer
+
+
+def wait_for_chat_messages(user_id, pdf_id, chat_id, timeout=MESSAGES_HISTORY_WAIT):
+    """
+    With write-behind, waits for the messages of the chat queued by this process to be written, so the history read
+    for the next question includes the previous one
+    """
+    writer = _writer
+    if not MESSAGES_WRITE_BEHIND or writer is None or writer.pid != os.getpid():
+        return
+    if not writer.wait_for_chat(user_id, pdf_id, chat_id, timeout):
+        print(f"The history of the chat {chat_id} is read without the messages not written yet")
+
+
+def save_messages(cnxn, cursor, batch):
+    """
+    Saves the messages of the batch: with write-behind enabled (env.MESSAGES_WRITE_BEHIND) they are spooled and
+    written in the background, otherwise they are inserted now in a single transaction
+    """
+    if MESSAGES_WRITE_BEHIND:
+        get_message_writer().submit(batch.rows)
+    else:
+        run_blocking(insert_messages, cnxn, cursor, batch.rows)
+
+
+def save_messages_async(batch):
+    """
+    Saves the messages of a batch from a background thread, which can't use the connection of the request
+    """
+    if MESSAGES_WRITE_BEHIND:
+        get_message_writer().submit(batch.rows)
+        return
+
+    run_blocking(insert_messages_with_new_connection, batch.rows)
+
+
+def insert_messages_with_new_connection(rows):
+    cnxn = pyodbc.connect(os.getenv('cnxn_str'))
+    try:
+        cursor = cnxn.cursor()
+        insert_messages(cnxn, cursor, rows)
+        cursor.close()
+    finally:
+        cnxn.close()
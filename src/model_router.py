@@ -0,0 +1,69 @@
+"""
+Chooses the model and the max_tokens of each call to the LLM from its type and the tokens of its prompt, so the short
+calls (the entity extraction of the memory, the questions without retrieved sections) go to the faster models of
+MODEL_TIERS and only the prompts that need a bigger context go to the bigger ones.
+The type of a call is the one of the chat model it's sent from (LLMClient.chat_model) or, when it has none, the one set
+with llm_call_type around the call.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from env import MODEL_TIERS, ROUTING_MAX_TOKENS, ROUTING_MIN_TIER
+
+# Type of the calls of the current request (or greenlet) when the chat model doesn't set one
+_call_type = ContextVar('llm_call_type', default='answer')
+
+# Tokens added by the API to each message and to the answer (role, separators), as counted by OpenAI
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_ANSWER = 3
+
+
+@contextmanager
+def llm_call_type(call_type):
+    token = _call_type.set(call_type)
+    try:
+        yield
+    finally:
+        _call_type.reset(token)
+
+
+def current_call_type():
+    return _call_type.get()
+
+
+class ModelRouter:
+    """
+    Each call goes to the first tier, from ROUTING_MIN_TIER of its type, whose context fits the prompt and the
+    ROUTING_MAX_TOKENS of its type. max_tokens is the one of the type, or what is left of the context of the biggest
+    tier when the prompt doesn't fit in any.
+    The answers are not cut by the routing: their ROUTING_MAX_TOKENS only chooses the tier, and max_tokens is the
+    budget of the caller (then the tier must fit it) or what is left of the context of the tier.
+    """
+
+    def __init__(self, tiers=None, max_tokens=None, min_tier=None):
+        self.tiers = tiers or MODEL_TIERS
+        self.max_tokens = max_tokens or ROUTING_MAX_TOKENS
+        self.min_tier = min_tier if min_tier is not None else ROUTING_MIN_TIER
+
+    @staticmethod
+    def prompt_tokens(tokenizer, messages):
+        return TOKENS_PER_ANSWER + sum(TOKENS_PER_MESSAGE + len(tokenizer.encode(str(message.get('content') or '')))
+                                       for message in messages)
+
+    def route(self, call_type, prompt_tokens, requested_tokens=None):
+        """
+        :param requested_tokens: max_tokens given by the caller of an answer
+        :return: (tier index, model, max_tokens) of the call
+        """
+        answer_tokens = self.max_tokens.get(call_type, self.max_tokens['answer'])
+        if call_type == 'answer' and requested_tokens:
+            answer_tokens = requested_tokens
+        first = min(self.min_tier.get(call_type, 0), len(self.tiers) - 1)
+        for i in range(first, len(self.tiers)):
+            if prompt_tokens + answer_tokens <= self.tiers[i]['context']:
+                if call_type == 'answer' and not requested_tokens:
+                    return i, self.tiers[i]['model'], self.tiers[i]['context'] - prompt_tokens
+                return i, self.tiers[i]['model'], answer_tokens
+
+        last = len(self.tiers) - 1
+        return last, self.tiers[last]['model'], max(self.tiers[last]['context'] - prompt_tokens, 1)
@@ -0,0 +1,100 @@
+"""
+Process wide registry of the tokenizers and NLP models. They are loaded on first use instead of at import, and only
+once per process. preload() loads them together with the heavy modules in the gunicorn master (see gunicorn.conf.py),
+so the forked workers share them copy-on-write instead of each one loading its own copy. The CPU workers of
+execution.py are not forked, they preload only CPU_MODULES.
+"""
+import time
+import importlib
+from threading import Lock
+
+from env import MODEL, DENSE_MODEL_PATH
+
+# Modules that are imported lazily by the requests, preload() imports them in the master
+HEAVY_MODULES = ['numpy', 'scipy.sparse', 'tiktoken', 'nltk', 'rank_bm25', 'openai',
+                 'langchain.chains', 'langchain.chat_models', 'langchain.memory.entity', 'langchain.prompts']
+# Modules of the functions run in the CPU workers (prepare_context, prepare_extractive_answer), langchain and openai are
+# only used by the gevent workers
+CPU_MODULES = ['numpy', 'scipy.sparse', 'tiktoken', 'nltk', 'rank_bm25']
+
+_tokenizers = {}
+_lemmatizer = None
+_tagger = None
+_stemmer = None
+_embedding_models = {}
+_lock = Lock()
+
+
+def get_tokenizer(model=MODEL):
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.get(model)
+            if tokenizer is None:
+                import tiktoken
+                tokenizer = _tokenizers[model] = tiktoken.encoding_for_model(model)
+    return tokenizer
+
+
+def get_lemmatizer():
+    # WordNetLemmatizer with the WordNet data already loaded (nltk loads it on the first lemmatize otherwise)
+    global _lemmatizer
+    if _lemmatizer is None:
+        with _lock:
+            if _lemmatizer is None:
+                from nltk.corpus import wordnet
+                from nltk.stem import WordNetLemmatizer
+                wordnet.ensure_loaded()
+                _lemmatizer = WordNetLemmatizer()
+    return _lemmatizer
+
+
+def get_tagger():
+    # nltk.pos_tag creates a new PerceptronTagger on every call, this one is created once
+    global _tagger
+    if _tagger is None:
+        with _lock:
+            if _tagger is None:
+                from nltk.tag.perceptron import PerceptronTagger
+                _tagger = PerceptronTagger()
+    return _tagger
+
+
+def get_stemmer():
+    # Spanish Snowball stemmer of the extractive answers, it doesn't need any NLTK data
+    global _stemmer
+    if _stemmer is None:
+        with _lock:
+            if _stemmer is None:
+                from nltk.stem.snowball import SpanishStemmer
+                _stemmer = SpanishStemmer()
+    return _stemmer
+
+
+def get_embedding_model(path=DENSE_MODEL_PATH):
+    # ONNX sessions are not shared with the forked workers, so the model is not preloaded: it's loaded in the process
+    # that uses it (ingestion and CPU workers)
+    model = _embedding_models.get(path)
+    if model is None:
+        with _lock:
+            model = _embedding_models.get(path)
+            if model is None:
+                from dense_retrieval import EmbeddingModel
+                model = _embedding_models[path] = EmbeddingModel(path)
+    return model
+
+
+def pos_tag(words):
+    # Same tags as nltk.pos_tag(words)
+    return get_tagger().tag(words)
+
+
+def preload(modules=HEAVY_MODULES):
+    start = time.perf_counter()
+    for module in modules:
+        importlib.import_module(module)
+    get_tokenizer()
+    get_lemmatizer().lemmatize('casas')
+    get_tagger()
+    get_stemmer()
+    print(f'NLP resources preloaded in {time.perf_counter() - start:.2f}s')
@@ -1,23 +1,41 @@
 import os
 import re
 import json
+import hashlib
 import queue
-import xml.etree.ElementTree as ET
+import time
 from threading import Thread, Event
 from typing import List
 from dotenv import load_dotenv
 
-import tiktoken
 from pdfminer.converter import PDFPageAggregator
 from pdfminer.layout import LAParams, LTTextBox, LTTextLine
+from pdfminer.pdfdocument import PDFDocument, PDFNoOutlines
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1, PDFStream
+from pdfminer.psparser import PSLiteral
 
 # from chatgpt_responses import chatgpt_response
+from chat_history import ChatHistory
 from chatgpt_responses import create_conversation_chain, compose_input_with_relevant_info
-from env import num_msgs_to_include_in_buffer, encabezado, MAX_TOKENS, MODEL, prefix_info_phrase
-from infomation_retrival_for_questions import read_files, get_most_relevant_docs
-from typograph_text_spliter import segment_text
+from env import num_msgs_to_include_in_buffer, encabezado, MAX_TOKENS, prefix_info_phrase, RETRIEVAL_ENGINE
+from env import EXTRACTION_ENGINE, PAGE_LIMIT, QUESTION_DEADLINE, BM25_threshold, HIERARCHICAL_MIN_SECTIONS
+from extractive_answers import extract_answer
+from fast_extraction import FastTextDevice, is_simple_layout
+from line_records import LineRecords
+from llm_client import get_llm_client
+from model_router import llm_call_type
+from message_store import MessageBatch, save_messages
+from nlp_resources import get_tokenizer
+from infomation_retrival_for_questions import read_files, get_most_relevant_docs_many, get_most_relevant_docs_sparse_many
+from infomation_retrival_for_questions import load_sparse_index, load_dense_index, get_most_relevant_docs_hybrid_many
+from infomation_retrival_for_questions import load_chapter_index
+from dense_retrieval import HybridIndex
+from section_tree import HierarchicalIndex, load_section_tree, chapter_paths
+from typograph_text_spliter import segment_text, load_section_pages
+from execution import run_cpu, run_with_deadline
 
 # Load environment variables
 load_dotenv()
@@ -30,39 +48,167 @@ def remove_illegal_chars(input_string):
     return illegal_xml_chars_re.sub('', input_string)
 
 
-def extract_text_with_font_info(pdf_path):
+def extract_layout_lines(layout, page_number, records):
+    """
+    Appends to the records the lines of a page analyzed by PDFPageAggregator with the font and size of their first
+    character
+    """
+    for element in layout:
+        if not isinstance(element, LTTextBox):
+            continue
+
+        for text_line in element:
+            if not isinstance(text_line, LTTextLine):
+                continue
+
+            text = text_line.get_text()
+            font, size = None, None
+
+            for character in text_line:
+                if hasattr(character, 'fontname'):
+                    font = character.fontname
+                    size = character.size
+                    break
+
+            if font is not None and size is not None:
+                # The vertical position relative to the page height is used to detect headers and footers
+                y = text_line.y0 / layout.height if layout.height else None
+                records.append(text, font, size, page_number, y)
+
+    return records
+
+
+def extract_text_with_font_info(pdf_path, engine=EXTRACTION_ENGINE, cancel_check=None, pages=None):
+    """
+    Extracts the lines of the PDF with their font, size, page and vertical position.
+    :param engine: 'full' runs the layout analysis of pdfminer on every page, 'fast' reads the text runs directly from
+    the content stream and 'auto' uses the fast engine on the pages with a simple layout and the full one on the rest
+    :param cancel_check: Function called before each page, it raises an exception to stop the extraction
+    :param pages: Set of the pages (0 based) to extract, all of them by default
+    :return: LineRecords with the lines of the document
+    """
     resource_manager = PDFResourceManager()
     device = PDFPageAggregator(resource_manager, laparams=LAParams())
     interpreter = PDFPageInterpreter(resource_manager, device)
+    # With 'auto' the text runs are recorded, so the pages without a simple layout are parsed once
+    fast_device = FastTextDevice(resource_manager, record=engine == 'auto')
+    fast_interpreter = PDFPageInterpreter(resource_manager, fast_device)
 
-    extracted_text = []
+    extracted_text = LineRecords()
 
     with open(pdf_path, 'rb') as fp:
-        for page in PDFPage.get_pages(fp):
-            interpreter.process_page(page)
-            layout = device.get_result()
-
-            for element in layout:
-                if not isinstance(element, LTTextBox):
-                    continue
-
-                for text_line in element:
-                    if not isinstance(text_line, LTTextLine):
-                        continue
+        for page_number, page in enumerate(PDFPage.get_pages(fp)):
+            if pages is not None and page_number not in pages:
+                continue
+            if cancel_check is not None:
+                cancel_check()
+
+            if engine != 'full':
+                fast_interpreter.process_page(page)
+                if engine == 'fast' or is_simple_layout(fast_device.lines, fast_device.page_width):
+                    fast_device.get_result(page_number, extracted_text)
+                else:
+                    extract_layout_lines(fast_device.replay(device), page_number, extracted_text)
+                continue
 
-                    text = text_line.get_text()
-                    font, size = None, None
+            interpreter.process_page(page)
+            extract_layout_lines(device.get_result(), page_number, extracted_text)
 
-                    for character in text_line:
-                        if hasattr(character, 'fontname'):
-                            font = character.fontname
-                            size = character.size
-                            break
+    return extracted_text
 
-                    if font is not None and size is not None:
-                        extracted_text.append({'text': text, 'font': font, 'size': size})
 
-    return extracted_text
+def page_hashes(pdf_path):
+    """
+    Returns the sha256 of each page of the PDF: its content streams, the ones of its forms and the names of its fonts.
+    They are read without the layout analysis, so the pages of a new edition of a document are compared in a fraction of
+    the time of their extraction.
+    """
+    hashes = []
+    with open(pdf_path, 'rb') as fp:
+        document = PDFDocument(PDFParser(fp))
+        for page in PDFPage.create_pages(document):
+            digest = hashlib.sha256(repr(page.mediabox).encode())
+            for stream in page.contents or []:
+                stream = resolve1(stream)
+                if isinstance(stream, PDFStream):
+                    digest.update(stream.get_data())
+            resources = resolve1(page.resources) or {}
+            fonts = resolve1(resources.get('Font')) or {}
+            for name in sorted(fonts, key=str):
+                font = resolve1(fonts[name])
+                base_font = resolve1(font.get('BaseFont')) if isinstance(font, dict) else None
+                digest.update(f'{name}={getattr(base_font, "name", base_font)}'.encode())
+            xobjects = resolve1(resources.get('XObject')) or {}
+            for name in sorted(xobjects, key=str):
+                xobject = resolve1(xobjects[name])
+                # The forms can have text, the images don't
+                if isinstance(xobject, PDFStream) and getattr(xobject.get('Subtype'), 'name', None) == 'Form':
+                    digest.update(xobject.get_data())
+            hashes.append(digest.hexdigest())
+    return hashes
+
+
+def page_hashes_path(folder_path):
+    # The hashes of the pages are stored next to the XML of the extraction: <user_id>/<pdf>/<pdf>_page_hashes.json
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_page_hashes.json')
+
+
+def save_page_hashes(folder_path, hashes):
+    with open(page_hashes_path(folder_path), 'w', encoding='utf-8') as file:
+        json.dump(hashes, file)
+
+
+def load_page_hashes(folder_path):
+    try:
+        with open(page_hashes_path(folder_path), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def extract_outline(pdf_path):
+    """
+    Reads the outline (bookmarks) of the PDF.
+    :return: List of (level, title, page) of the entries that point to a page, the levels start at 1 and the pages are
+    0 based. It's empty if the PDF has no outline or it can't be read
+    """
+    outline = []
+    with open(pdf_path, 'rb') as fp:
+        try:
+            document = PDFDocument(PDFParser(fp))
+            page_numbers = {page.pageid: page_number for page_number, page in
+                            enumerate(PDFPage.create_pages(document))}
+            for level, title, dest, action, _ in document.get_outlines():
+                page = outline_entry_page(document, dest, action, page_numbers)
+                if page is not None and title:
+                    if isinstance(title, bytes):
+                        title = title.decode('utf-8', errors='ignore')
+                    outline.append((level, ' '.join(title.split()), page))
+        except PDFNoOutlines:
+            pass
+        except Exception as e:
+            print(f"Error reading the outline of {pdf_path}: {e}")
+    return outline
+
+
+def outline_entry_page(document, dest, action, page_numbers):
+    # The destination of an entry is an explicit [page, view...] array, a named destination or a GoTo action
+    if dest is None and action is not None:
+        action = resolve1(action)
+        if not isinstance(action, dict) or getattr(action.get('S'), 'name', None) != 'GoTo':
+            return None
+        dest = action.get('D')
+    dest = resolve1(dest)
+    if isinstance(dest, (str, bytes, PSLiteral)):
+        try:
+            dest = resolve1(document.get_dest(dest.name if isinstance(dest, PSLiteral) else dest))
+        except Exception:
+            return None
+    if isinstance(dest, dict):
+        dest = resolve1(dest.get('D'))
+    if not isinstance(dest, list) or not dest:
+        return None
+    return page_numbers.get(getattr(dest[0], 'objid', None))
 
 
 def extract_paragraphs_with_font_info(pdf_path):
@@ -99,52 +245,184 @@ def extract_paragraphs_with_font_info(pdf_path):
     return extracted_paragraphs
 
 
-def extract_and_convert_to_xml(cnxn, cursor, file_path, pdf_id):
+def extract_and_convert_to_xml(cnxn, cursor, file_path, pdf_id, subfiles=None, cancel_check=None):
+    """
+    Extracts the lines of the PDF to an XML file, splits them in sections and saves the sections as text files.
+    :param subfiles: If a list is given, the (name, tokens) of the XML and the sections are appended to it instead of
+    being inserted in PDFSubFiles, so the connection is not used and the caller can insert them in bulk
+    :param cancel_check: Function called between pages and sections, it raises an exception to cancel the ingestion
+    :return: Dictionary with the pages, the lines and the token stats of segment_text
+    """
     print(f'Extracting text from - {file_path}')
-    extracted_text_with_font_info = extract_text_with_font_info(file_path)
+    extracted_text_with_font_info = extract_text_with_font_info(file_path, cancel_check=cancel_check)
 
-    root = ET.Element("root")
-    for text_info in extracted_text_with_font_info:
-        doc = ET.SubElement(root, "doc")
-        ET.SubElement(doc, "field1", name="text").text = text_info['text']
-        ET.SubElement(doc, "field2", name="font").text = text_info['font']
-        ET.SubElement(doc, "field3", name="size").text = str(text_info['size'])
-
-    # Replace special characters in filename
-    filename_dir = re.sub(r'\W+', '_', os.path.split(os.path.splitext(file_path)[0])[1])
-    parent_dir = os.path.dirname(file_path)
-    complete_dir = os.path.join(parent_dir, filename_dir)
-
-    xml_file_path = os.path.join(complete_dir, filename_dir + '.xml')
-    text_files_dir = os.path.join(complete_dir, filename_dir)
+    filename_dir, parent_dir, complete_dir, xml_file_path, text_files_dir = document_paths(file_path)
 
     # Ensure the directory exists
     os.makedirs(os.path.dirname(xml_file_path), exist_ok=True)
 
-    # Clean XML content
-    xml_content = ET.tostring(root, encoding='utf-8').decode('utf-8')
-    clean_xml_content = remove_illegal_chars(xml_content)
-
-    # Write cleaned content to the file
+    # Write the cleaned XML content to the file line by line
     with open(xml_file_path, 'w', encoding='utf-8') as file:
-        file.write(clean_xml_content)
+        extracted_text_with_font_info.to_xml(file, clean=remove_illegal_chars)
+    # The hashes of the pages tell which pages a new edition of the document changes, see reingest_document
+    save_page_hashes(complete_dir, page_hashes(file_path))
 
     print(f'xml extracted and saved in - {xml_file_path} \n')
 
     # Save XML to the database
-    cursor.execute("""
-    INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED)
-    VALUES (?, ?, 0)
-    """, pdf_id, xml_file_path)
-    cnxn.commit()
-
-    # Split text in segments
+    if subfiles is not None:
+        subfiles.append((xml_file_path, None))
+    else:
+        cursor.execute("""
+        INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED)
+        VALUES (?, ?, 0)
+        """, pdf_id, xml_file_path)
+        cnxn.commit()
+
+    # Split text in segments, the outline of the PDF gives the chapters of the sections
     print(f'Splitting text in segments')
-    segment_text(xml_file_path, pdf_id, save_to_file=True, file_path=text_files_dir)
+    stats = segment_text(xml_file_path, pdf_id, save_to_file=True, file_path=text_files_dir,
+                         records=extracted_text_with_font_info, subfiles=subfiles, cancel_check=cancel_check,
+                         outline=extract_outline(file_path))
+
+    if stats['tokens_removed']:
+        print(f"Removed {stats['lines_removed']} boilerplate lines and {stats['sections_removed']} duplicated sections. "
+              f"Tokens saved: {stats['tokens_removed']} of {stats['tokens']} "
+              f"({100 * stats['tokens_removed'] / max(stats['tokens'], 1):.1f}%)")
+
+    if stats['chapters']:
+        print(f"Sections grouped in {stats['chapters']} chapters")
+
+    build_indexes(filename_dir, os.path.basename(parent_dir))
 
     print(
         f'Text splitted and saved in - {os.path.join(os.path.splitext(file_path)[0], os.path.split(os.path.splitext(file_path)[0])[1])} \n')
 
+    stats['lines'] = len(extracted_text_with_font_info)
+    stats['pages'] = int(extracted_text_with_font_info.pages.max()) + 1 if len(extracted_text_with_font_info) else 0
+    return stats
+
+
+def document_paths(file_path):
+    """
+    :return: (filename_dir, parent_dir, complete_dir, xml_file_path, text_files_dir) of the PDF: the name of its folder,
+    the folder of the user, the folder of the document, its XML and the prefix of its sections
+    """
+    # Replace special characters in filename
+    filename_dir = re.sub(r'\W+', '_', os.path.split(os.path.splitext(file_path)[0])[1])
+    parent_dir = os.path.dirname(file_path)
+    complete_dir = os.path.join(parent_dir, filename_dir)
+    return (filename_dir, parent_dir, complete_dir, os.path.join(complete_dir, filename_dir + '.xml'),
+            os.path.join(complete_dir, filename_dir))
+
+
+def build_indexes(pdf_foldername, user_id):
+    if RETRIEVAL_ENGINE in ('sparse', 'hybrid'):
+        # Build the sparse index at ingest so the first question does not pay for it
+        load_sparse_index(pdf_foldername, user_id)
+    if RETRIEVAL_ENGINE == 'hybrid':
+        # The embeddings of the sections are computed in batches at ingest too
+        load_dense_index(pdf_foldername, user_id)
+
+
+def reingest_document(file_path, cancel_check=None):
+    """
+    Updates an ingested document with a new edition of its PDF, saved in the same path. The pages are matched with the
+    pages of the previous edition by their hash: the lines of the known pages are taken from the XML of the previous
+    edition, even if they moved, and only the new or changed pages are extracted. The document is split again, and the
+    sections that did not change keep their tokens and embeddings when the indexes are updated.
+    :return: (stats, changes), stats like extract_and_convert_to_xml plus the pages extracted, changes the
+    {'added': [(name, tokens)], 'updated': [(name, tokens)], 'removed': [name]} sections for PDFSubFiles (see
+    save_subfile_changes). None if the previous edition has no page hashes, then it must be ingested from scratch
+    """
+    filename_dir, parent_dir, complete_dir, xml_file_path, text_files_dir = document_paths(file_path)
+    old_hashes = load_page_hashes(complete_dir)
+    if old_hashes is None or not os.path.exists(xml_file_path):
+        return None
+
+    hashes = page_hashes(file_path)
+    old_pages = {}
+    for page, page_hash in enumerate(old_hashes):
+        old_pages.setdefault(page_hash, page)
+    changed = {page for page, page_hash in enumerate(hashes) if page_hash not in old_pages}
+    print(f'New edition of {file_path}: extracting {len(changed)} of {len(hashes)} pages')
+
+    old_records = LineRecords.from_xml(xml_file_path)
+    extracted = LineRecords()
+    if changed:
+        extracted = extract_text_with_font_info(file_path, cancel_check=cancel_check, pages=changed)
+    old_lines = old_records.lines_by_page()
+    new_lines = extracted.lines_by_page()
+    records = LineRecords()
+    for page, page_hash in enumerate(hashes):
+        if page in changed:
+            records.extend(extracted, new_lines.get(page, []), page)
+        else:
+            records.extend(old_records, old_lines.get(old_pages[page_hash], []), page)
+
+    # Texts of the sections of the previous edition, to know which ones change
+    old_sections = {}
+    for filename in os.listdir(complete_dir):
+        if filename.endswith('.txt'):
+            with open(os.path.join(complete_dir, filename), 'r', encoding='utf-8') as file:
+                old_sections[filename] = file.read()
+
+    with open(xml_file_path, 'w', encoding='utf-8') as file:
+        records.to_xml(file, clean=remove_illegal_chars)
+    save_page_hashes(complete_dir, hashes)
+
+    subfiles = []
+    stats = segment_text(xml_file_path, None, save_to_file=True, file_path=text_files_dir, records=records,
+                         subfiles=subfiles, cancel_check=cancel_check, outline=extract_outline(file_path))
+
+    changes = {'added': [], 'updated': [], 'removed': []}
+    new_sections = {os.path.basename(subfile): (subfile, tokens) for subfile, tokens in subfiles}
+    for filename in old_sections:
+        if filename not in new_sections:
+            # Same name as process_section gives it
+            os.remove(os.path.join(complete_dir, filename))
+            changes['removed'].append(os.path.join(complete_dir, filename).split('\\')[-1])
+    for filename, (subfile, tokens) in new_sections.items():
+        if filename not in old_sections:
+            changes['added'].append((subfile, tokens))
+            continue
+        with open(os.path.join(complete_dir, filename), 'r', encoding='utf-8') as file:
+            if file.read() != old_sections[filename]:
+                changes['updated'].append((subfile, tokens))
+
+    print(f"Sections of {file_path}: {len(changes['added'])} added, {len(changes['updated'])} updated, "
+          f"{len(changes['removed'])} removed")
+    build_indexes(filename_dir, os.path.basename(parent_dir))
+
+    stats['lines'] = len(records)
+    stats['pages'] = len(hashes)
+    stats['pages_extracted'] = len(changed)
+    return stats, changes
+
+
+def save_subfile_changes(cnxn, cursor, pdf_id, changes):
+    """
+    Updates the PDFSubFiles rows of a document with the changes of reingest_document. It's not committed, so the caller
+    commits it with the state of the document.
+    """
+    if changes['removed']:
+        cursor.executemany("""
+        UPDATE PDFSubFiles
+        SET IS_DELETED = 1
+        WHERE PDF_ID = ? AND SUBFILE_NAME = ? AND IS_DELETED = 0
+        """, [(pdf_id, subfile) for subfile in changes['removed']])
+    if changes['updated']:
+        cursor.executemany("""
+        UPDATE PDFSubFiles
+        SET TOKENS = ?
+        WHERE PDF_ID = ? AND SUBFILE_NAME = ? AND IS_DELETED = 0
+        """, [(tokens, pdf_id, subfile) for subfile, tokens in changes['updated']])
+    if changes['added']:
+        cursor.executemany("""
+        INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED, TOKENS)
+        VALUES (?, ?, 0, ?)
+        """, [(pdf_id, subfile, tokens) for subfile, tokens in changes['added']])
+
 
 class UserInputHandler(Thread):
     def __init__(self,
@@ -154,6 +432,7 @@ class UserInputHandler(Thread):
                  chat_id: int,
                  user_id: int = None,
                  inputs: List = None,
+                 history: ChatHistory = None,
                  ):
         Thread.__init__(self)
         self.cnxn = cnxn
@@ -165,6 +444,14 @@ class UserInputHandler(Thread):
         self.input_question = None
         self.pdf_slides = None
         self.user_id = user_id
+        # 'llm' or 'extractive', and the seconds the model has to answer
+        self.mode = 'llm'
+        self.deadline = QUESTION_DEADLINE
+        # Mode that answered the last question ('llm', 'extractive' or 'fallback'), the citations of the extractive
+        # answers and the chapter paths of the sections in the prompt of the model
+        self.answer_mode = None
+        self.citations = None
+        self.chapters = None
 
         # Define the queues
         self.questions = ''
@@ -173,10 +460,13 @@ class UserInputHandler(Thread):
         self.answers_tokens = None
 
         # Define the tokenizer
-        self.tokenizer = tiktoken.encoding_for_model(MODEL)
+        self.tokenizer = get_tokenizer()
 
-        # Create the conversation
+        # Create the conversation, the history of the chat (summary and last turns) is used as memory when it's given
         print("Creating conversation...")
+        self.history = history
+        if history is not None:
+            inputs = history.memory_inputs(self.tokenizer)
         self.input_msgs_entries = inputs if inputs else []
         self.conversation = create_conversation_chain(inputs=self.input_msgs_entries,
                                                       num_msgs=num_msgs_to_include_in_buffer)
@@ -192,10 +482,12 @@ class UserInputHandler(Thread):
         # Restores the attributes from the serialized state
         self.__dict__.update(state)
         # Restores the attributes that are not serializable
-        self.tokenizer = tiktoken.encoding_for_model(MODEL)
+        self.tokenizer = get_tokenizer()
 
-    def add_question(self, question: str):
+    def add_question(self, question: str, mode: str = 'llm', deadline: float = QUESTION_DEADLINE):
         self.questions = question
+        self.mode = mode
+        self.deadline = deadline
 
         if self.selected_pdf_id is not None:
             self.llm_conversation_with_memory()
@@ -229,106 +521,222 @@ class UserInputHandler(Thread):
         self.input_question = self.get_next_question()
         if self.input_question is None:
             return
-        # Read the files from the directory
-        corpus, corpus_tokenized, filenames = read_files(self.pdf_slides[str(self.selected_pdf_id)],
-                                                         self.user_id)
-
-        # Check if the total length of the documents is less than the maximum number of tokens
-        total_length = 0
-        for tokens_in_slice in corpus_tokenized:
-            total_length += len(tokens_in_slice)
-
-        if total_length < MAX_TOKENS:
-            # If it is less, it is not necessary to filter the documents, we use float('Inf') to indicate that all are
-            # relevant and will be added to the prompt, skipping the treshold defined in env.py (BM25_threshold)
-            relevant_info = [(filename, float('Inf')) for filename in filenames]
-        else:
-            # If it is greater, we filter the documents using BM25
-            relevant_info = get_most_relevant_docs(self.input_question, corpus_tokenized, filenames)
-
-        # Add the relevant information to the prompt
-        print(f"Relevant info for question: {self.input_question}")
-        msgs, not_found_info, total_tokens = compose_input_with_relevant_info(self.main_path,
-                                                                              relevant_info,
-                                                                              prefix_info_phrase)
-
-        # if we have relevant information, we add it to the prompt
-        summary = ''
-        if not not_found_info:
-            print(f"Found relevant info for question: {self.input_question}")
-            try:
-                # We can use the variable total tokens to iterate over the total of the messages if they do not
-                # exceed the token limit defined in env.py (MAX_TOKENS).
-                # For now we only take the last message
-                acc_tokens_in_msgs = 0
-                if total_tokens < MAX_TOKENS:
-                    for msg in msgs:
-                        summary = self.conversation.predict(input=msg)
-                        in_out_json = json.dumps({"input": msg, "output": summary})
-                        # We save the intermediate prompt with the content related to the question
-                        self.cursor.execute("""
-                        INSERT INTO MESSAGES (USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID, NUMBER_OF_TOKENS, CHAT_ID)
-                        VALUES (?, GETDATE(), 'F', ?, ?, ?, ?)
-                        """, self.user_id,
-                                       in_out_json,
-                                       self.selected_pdf_id,
-                                       len(self.tokenizer.encode(msg)),
-                                       self.chat_id)
-                        self.cnxn.commit()
-
-                else:
-                    for msg in msgs:
-                        if acc_tokens_in_msgs + len(self.tokenizer.encode(msg)) < MAX_TOKENS:
-                            summary = self.conversation.predict(input=msg) + '. '
-                            acc_tokens_in_msgs += len(self.tokenizer.encode(msg))
-                            # We save the intermediate prompt with the content related to the question
-                            self.cursor.execute("""
-                            INSERT INTO MESSAGES (USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID, NUMBER_OF_TOKENS, CHAT_ID)
-                            VALUES (?, GETDATE(), 'F', ?, ?, ?, ?)
-                            """, self.user_id,
-                                           msgs[-1],
-                                           self.selected_pdf_id,
-                                           len(self.tokenizer.encode(msg)),
-                                           self.chat_id)
-                            self.cnxn.commit()
-
-                print("\nAdded message to the conversation. Tokens: ", len(self.tokenizer.encode(msgs[-1])))
-            except Exception as e:
-                print(f"\nError processing message.\n Tokens: {len(self.tokenizer.encode(msgs[-1]))}.")
-                print(e)
-
-            # Add the user question to the conversation
-            prompt = encabezado + self.input_question
-            response = self.conversation.predict(input=prompt)
-        else:
-            prompt = self.input_question
-            response = self.conversation.predict(input=prompt)
+        if self.mode == 'extractive':
+            return self.extractive_answer('extractive')
+
+        start = time.perf_counter()
+        # The retrieval and the preprocessing of the sections run in a CPU worker, the model calls in this greenlet
+        context = run_cpu(prepare_context, self.pdf_slides[str(self.selected_pdf_id)], self.user_id, self.main_path,
+                          [self.input_question])[0]
+        self.chapters = context[3]
+
+        messages = MessageBatch(self.user_id, self.selected_pdf_id, self.chat_id)
+        deadline = None if self.deadline is None else max(self.deadline - (time.perf_counter() - start), 0)
+        try:
+            prompt, response = run_with_deadline(deadline, answer_question, self.conversation, self.tokenizer,
+                                                 self.input_question, context, messages)
+        except Exception as e:
+            if not isinstance(e, TimeoutError) and not get_llm_client().unavailable(e):
+                raise
+            print(f"The model did not answer in time ({type(e).__name__}: {e}), answering with the document sentences")
+            return self.extractive_answer('fallback')
 
         self.question_tokens = self.tokenizer.encode(prompt)
         self.answers_tokens = self.tokenizer.encode(response)
 
         self.add_answer(response)
+        self.answer_mode = 'llm'
+
+        # All the messages of the question are saved in a single transaction (or queued, see message_store.py)
+        messages.add('P', prompt, len(self.question_tokens), answer_mode='llm')
+        messages.add('L', response, len(self.answers_tokens), answer_mode='llm')
+        save_messages(self.cnxn, self.cursor, messages)
 
-        self.cursor.execute("""
-        INSERT INTO MESSAGES (USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID, NUMBER_OF_TOKENS, CHAT_ID)
-        VALUES (?, GETDATE(), 'P', ?, ?, ?, ?)
-        """, self.user_id,
-                       prompt,
-                       self.selected_pdf_id,
-                       len(self.tokenizer.encode(prompt)),
-                       self.chat_id)
-        self.cnxn.commit()
-
-        self.cursor.execute("""
-        INSERT INTO MESSAGES (USER_ID, DATE, TYPE_OF_MESSAGE, MESSAGE, PDF_ID, NUMBER_OF_TOKENS, CHAT_ID)
-        VALUES (?, GETDATE(), 'L', ?, ?, ?, ?)
-        """, self.user_id,
-                       response,
-                       self.selected_pdf_id,
-                       len(self.tokenizer.encode(response)),
-                       self.chat_id)
-        self.cnxn.commit()
+        # Fold the turns that are out of the buffer into the summary of the chat
+        if self.history is not None:
+            self.history.add_turn(messages.rows[-1].date, prompt, response)
+            self.history.compact_in_background(self.conversation.llm, self.tokenizer)
 
         print(self.conversation.memory.buffer)
 
         return
+
+    def extractive_answer(self, answer_mode):
+        """
+        Answers the question with the sentences of the document, without calling the model
+        :param answer_mode: 'extractive' if the request asked for it, 'fallback' if the model missed the deadline
+        """
+        answer, self.citations = run_cpu(prepare_extractive_answer, self.pdf_slides[str(self.selected_pdf_id)],
+                                         self.user_id, self.main_path, self.input_question)
+        self.chapters = chapter_paths({citation['section']: citation.get('chapter') for citation in self.citations},
+                                      [citation['section'] for citation in self.citations])
+        self.question_tokens = self.tokenizer.encode(self.input_question)
+        self.answers_tokens = self.tokenizer.encode(answer)
+        self.add_answer(answer)
+        self.answer_mode = answer_mode
+
+        messages = MessageBatch(self.user_id, self.selected_pdf_id, self.chat_id)
+        messages.add('P', self.input_question, len(self.question_tokens), answer_mode=answer_mode)
+        messages.add('L', answer, len(self.answers_tokens), answer_mode=answer_mode)
+        save_messages(self.cnxn, self.cursor, messages)
+
+        # The turn is kept in the history, it's summarized with the next question answered by the model
+        if self.history is not None:
+            self.history.add_turn(messages.rows[-1].date, self.input_question, answer)
+
+
+def load_sections(pdf_foldername, user_id):
+    """
+    Loads the sections of a document for the retrieval of RETRIEVAL_ENGINE
+    :return: (index, corpus_tokenized, filenames, total_length), the sparse index is None with the 'bm25' engine and
+    the tokenized sections are None with the 'sparse' one
+    """
+    if RETRIEVAL_ENGINE in ('sparse', 'hybrid'):
+        # The sparse index is stored with the document, so the sections are only read and tokenized once
+        index = load_sparse_index(pdf_foldername, user_id)
+        if len(index.filenames) >= HIERARCHICAL_MIN_SECTIONS:
+            # The large documents with chapters are searched from the chapters to the sections
+            tree, chapters = load_chapter_index(pdf_foldername, user_id)
+            if chapters is not None:
+                index = HierarchicalIndex(index, chapters, tree)
+        if RETRIEVAL_ENGINE == 'hybrid':
+            index = HybridIndex(index, load_dense_index(pdf_foldername, user_id))
+        return index, None, index.filenames, index.total_tokens
+
+    # Read the files from the directory
+    corpus, corpus_tokenized, filenames = read_files(pdf_foldername, user_id)
+
+    # Check if the total length of the documents is less than the maximum number of tokens
+    total_length = 0
+    for tokens_in_slice in corpus_tokenized:
+        total_length += len(tokens_in_slice)
+    return None, corpus_tokenized, filenames, total_length
+
+
+def find_relevant_info(questions, index, corpus_tokenized, filenames, total_length):
+    """
+    Returns the relevant sections, as (filename, score) pairs, of each question. The questions are scored together.
+    """
+    if total_length < MAX_TOKENS:
+        # If it is less, it is not necessary to filter the documents, we use float('Inf') to indicate that all are
+        # relevant and will be added to the prompt, skipping the treshold defined in env.py (BM25_threshold)
+        return [[(filename, float('Inf')) for filename in filenames] for _ in questions]
+    if RETRIEVAL_ENGINE == 'sparse':
+        return get_most_relevant_docs_sparse_many(questions, index)
+    if RETRIEVAL_ENGINE == 'hybrid':
+        return get_most_relevant_docs_hybrid_many(questions, index)
+    # If it is greater, we filter the documents using BM25
+    return get_most_relevant_docs_many(questions, corpus_tokenized, filenames)
+
+
+def prepare_context(pdf_foldername, user_id, main_path, questions):
+    """
+    Retrieves the relevant sections of each question and composes the prompts with them. It's CPU bound (preprocess,
+    BM25, tiktoken) and picklable, so the workers run it with run_cpu.
+    :return: The (msgs, not_found_info, total_tokens) of compose_input_with_relevant_info for each question, and the
+    chapter paths of the sections added to the prompt (empty if the document has no chapters)
+    """
+    index, corpus_tokenized, filenames, total_length = load_sections(pdf_foldername, user_id)
+    tree = load_section_tree(os.path.join(main_path, pdf_foldername))
+    # The hybrid scores are fused by rank, not BM25 scores, and the index already cut them
+    threshold = 0 if RETRIEVAL_ENGINE == 'hybrid' else BM25_threshold
+    contexts = []
+    for question, relevant_info in zip(questions, find_relevant_info(questions, index, corpus_tokenized, filenames,
+                                                                     total_length)):
+        # Add the relevant information to the prompt
+        print(f"Relevant info for question: {question}")
+        msgs, not_found_info, total_tokens = compose_input_with_relevant_info(main_path, relevant_info,
+                                                                              prefix_info_phrase, threshold=threshold)
+        chapters = []
+        if tree is not None:
+            # The same sections that compose_input_with_relevant_info adds to the prompt
+            prompt_sections = [filename for filename, score in sorted(relevant_info, key=lambda x: x[1],
+                                                                      reverse=True)[:PAGE_LIMIT]
+                               if score >= threshold]
+            chapters = chapter_paths(tree['sections'], prompt_sections)
+        contexts.append((msgs, not_found_info, total_tokens, chapters))
+    return contexts
+
+
+def prepare_extractive_answer(pdf_foldername, user_id, main_path, question):
+    """
+    Answers the question with the sentences of its relevant sections, see extractive_answers.extract_answer. Like
+    prepare_context it's run with run_cpu.
+    :return: (answer, citations)
+    """
+    index, corpus_tokenized, filenames, total_length = load_sections(pdf_foldername, user_id)
+    relevant_info = find_relevant_info([question], index, corpus_tokenized, filenames, total_length)[0]
+    if total_length >= MAX_TOKENS:
+        # The same sections that compose_input_with_relevant_info would add to the prompt, all of them in a small one
+        relevant_info = sorted(relevant_info, key=lambda x: x[1], reverse=True)[:PAGE_LIMIT]
+
+    pages = load_section_pages(os.path.join(main_path, pdf_foldername))
+    tree = load_section_tree(os.path.join(main_path, pdf_foldername))
+    sections = []
+    for filename, score in relevant_info:
+        doc_folder = re.sub(r"_\d+\.txt$", "", filename)
+        try:
+            with open(os.path.join(main_path, doc_folder, filename), 'r', encoding="utf-8") as file:
+                sections.append((filename, score, file.read(), pages.get(filename)))
+        except OSError as e:
+            print(f"Error reading file {filename}: {e}")
+    answer, citations = extract_answer(question, sections)
+    if tree is not None:
+        for citation in citations:
+            citation['chapter'] = tree['sections'].get(citation['section'])
+    return answer, citations
+
+
+def answer_question(conversation, tokenizer, question, context, messages, summarize=None):
+    """
+    Adds the relevant sections to the conversation and answers the question. The intermediate prompts ('F') are added
+    to messages.
+    :param context: The (msgs, not_found_info, total_tokens, chapters) of the question, see prepare_context
+    :param summarize: Function called with each prompt of sections that returns its summary, by default the prompt is
+    sent to the conversation
+    :return: The prompt of the question and the answer
+    """
+    if summarize is None:
+        summarize = lambda msg: conversation.predict(input=msg)  # noqa: E731
+    msgs, not_found_info, total_tokens, _ = context
+
+    # if we have relevant information, we add it to the prompt
+    summary = ''
+    if not not_found_info:
+        print(f"Found relevant info for question: {question}")
+        try:
+            # We can use the variable total tokens to iterate over the total of the messages if they do not
+            # exceed the token limit defined in env.py (MAX_TOKENS).
+            # For now we only take the last message
+            # The prompts of sections are routed as summaries and the question as the answer (see model_router.py)
+            acc_tokens_in_msgs = 0
+            if total_tokens < MAX_TOKENS:
+                for msg in msgs:
+                    with llm_call_type('summarize'):
+                        summary = summarize(msg)
+                    in_out_json = json.dumps({"input": msg, "output": summary})
+                    # We save the intermediate prompt with the content related to the question
+                    messages.add('F', in_out_json, len(tokenizer.encode(msg)))
+
+            else:
+                for msg in msgs:
+                    if acc_tokens_in_msgs + len(tokenizer.encode(msg)) < MAX_TOKENS:
+                        with llm_call_type('summarize'):
+                            summary = summarize(msg) + '. '
+                        acc_tokens_in_msgs += len(tokenizer.encode(msg))
+                        # We save the intermediate prompt with the content related to the question
+                        messages.add('F', msgs[-1], len(tokenizer.encode(msg)))
+
+            print("\nAdded message to the conversation. Tokens: ", len(tokenizer.encode(msgs[-1])))
+        except Exception as e:
+            print(f"\nError processing message.\n Tokens: {len(tokenizer.encode(msgs[-1]))}.")
+            print(e)
+
+        # Add the user question to the conversation
+        prompt = encabezado + question
+        response = conversation.predict(input=prompt)
+    else:
+        prompt = question
+        response = conversation.predict(input=prompt)
+
+    return prompt, response
@@ -1,9 +1,7 @@
 import re
 import string
-import nltk
 from env import stopwords_spanish
-from nltk.stem import WordNetLemmatizer
-from nltk.corpus.reader import wordnet as wn
+from nlp_resources import get_lemmatizer, pos_tag
 from collections import defaultdict
 
 # Initialize constants
@@ -12,11 +10,11 @@ PUNCTUATION = set(string.punctuation)
 SPACES_PATTERN = re.compile(' +')
 NUMBERS_LETTERS_PATTERN = re.compile(r'([0-9]+)([a-zA-Z]+)')
 
-LEMMATIZER = WordNetLemmatizer()
-TAG_MAP = defaultdict(lambda: wn.NOUN)
-TAG_MAP['J'] = wn.ADJ
-TAG_MAP['V'] = wn.VERB
-TAG_MAP['R'] = wn.ADV
+# WordNet parts of speech (wordnet.NOUN, ADJ, VERB and ADV), so nltk is not imported until the first text is lemmatized
+TAG_MAP = defaultdict(lambda: 'n')
+TAG_MAP['J'] = 'a'
+TAG_MAP['V'] = 'v'
+TAG_MAP['R'] = 'r'
 
 
 def preprocess(text):
@@ -41,9 +39,10 @@ def preprocess(text):
 
     # Lemmatize words
     final_text = []
-    for word, tag in nltk.pos_tag(text.split()):
+    lemmatizer = get_lemmatizer()
+    for word, tag in pos_tag(text.split()):
         if word.isalpha():
-            word_final = LEMMATIZER.lemmatize(word, TAG_MAP[tag[0]])
+            word_final = lemmatizer.lemmatize(word, TAG_MAP[tag[0]])
             final_text.append(word_final)
 
     return " ".join(final_text)
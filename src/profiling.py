@@ -0,0 +1,198 @@
+"""
+Opt-in profiles of the requests and the ingestions with cProfile, to know where the time of a slow document goes
+(pdfminer, preprocess, BM25, tiktoken, the database or the model). A request is profiled when it has the X-Profile
+header (or the profile query parameter) with the PROFILE_KEY of the .env file, and a PROFILE_SAMPLE_RATE fraction of the
+other requests (PROFILE_INGEST_SAMPLE_RATE of the ingestions) is profiled at random.
+Only one profile runs at a time per process, so the overhead is bounded by the sampling, and the files in PROFILE_DIR
+are bounded by PROFILE_MAX_FILES and PROFILE_MAX_MB. Each profile is a pstats file named with its stage, user, document,
+date and process (<stage>_u<user_id>_p<pdf_id>_<date>_<pid>.pstats), it's read with pstats or snakeviz.
+cProfile profiles the thread that starts it: in the gevent workers this is every greenlet of the worker while the profile
+runs, and the functions sent to the CPU processes with run_cpu are profiled there and merged in the profile. A process
+forked while a profile runs (the ingestion of an upload) doesn't inherit it, so it can start its own.
+"""
+import os
+import hmac
+import time
+import uuid
+import random
+import pstats
+import cProfile
+from threading import Lock, get_ident
+from contextlib import contextmanager
+
+from env import PROFILE_DIR, PROFILE_SAMPLE_RATE, PROFILE_MIN_SECONDS, PROFILE_MAX_FILES, PROFILE_MAX_MB
+from env import PROFILE_PARTS_MAX_AGE
+
+_lock = Lock()
+_active = None
+
+
+def _reset_after_fork():
+    # The child of a fork gets the lock held and the profiler of the profile running in the parent still enabled
+    global _lock, _active
+    if _active is not None:
+        _active.profiler.disable()
+    _active = None
+    _lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def is_profile_key(value):
+    # True if value is the PROFILE_KEY of the .env file, the profiles can't be forced when it's not set
+    key = os.getenv('PROFILE_KEY')
+    return bool(key and value) and hmac.compare_digest(str(value), key)
+
+
+def active_profile():
+    return _active
+
+
+class Profile:
+    def __init__(self, stage, user_id=None, pdf_id=None, forced=False):
+        self.stage = stage
+        self.forced = forced
+        self.name = (f"{stage}_u{user_id}_p{pdf_id}_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+                     f"_{uuid.uuid4().hex[:6]}.pstats")
+        self.path = os.path.join(os.path.abspath(PROFILE_DIR), self.name)
+        # Profiles of the functions run in the CPU processes, merged at the end
+        self.parts = []
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+        self.stopped = False
+        self.thread_id = get_ident()
+
+    def in_current_thread(self):
+        # The functions called from the thread that started the profile are already profiled
+        return get_ident() == self.thread_id
+
+    def part_path(self):
+        path = os.path.join(os.path.abspath(PROFILE_DIR), 'parts', f'{uuid.uuid4().hex}.pstats')
+        self.parts.append(path)
+        return path
+
+    def stop(self):
+        """
+        Stops the profile and saves it, unless it was sampled at random and took less than PROFILE_MIN_SECONDS
+        """
+        global _active
+        if self.stopped:
+            return
+        self.stopped = True
+        self.profiler.disable()
+        seconds = time.perf_counter() - self.start
+        _active = None
+        _lock.release()
+
+        try:
+            if self.forced or seconds >= PROFILE_MIN_SECONDS:
+                self.save()
+                print(f'Profile of {self.stage} saved in {self.path} ({seconds:.2f}s)')
+        except Exception as e:
+            print(f'Error saving the profile of {self.stage}: {e}')
+        finally:
+            for part in self.parts:
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        stats = pstats.Stats(self.profiler)
+        for part in self.parts:
+            if os.path.exists(part):
+                stats.add(part)
+        stats.dump_stats(self.path)
+        prune_profiles()
+
+
+def start_profile(stage, user_id=None, pdf_id=None, force=False, sample_rate=PROFILE_SAMPLE_RATE):
+    """
+    Starts the profile of a request or an ingestion if it's forced or sampled and no other profile is running
+    :return: The Profile, stopped with stop(), or None
+    """
+    global _active
+    if not force and not (sample_rate and random.random() < sample_rate):
+        return None
+    if not _lock.acquire(blocking=False):
+        if force:
+            print(f'Profile of {stage} skipped, another profile is running')
+        return None
+
+    profile = Profile(stage, user_id, pdf_id, forced=force)
+    try:
+        profile.profiler.enable()
+    except ValueError as e:
+        # Another profiler (a debugger, py-spy...) is already running in the thread
+        _lock.release()
+        print(f'Profile of {stage} skipped: {e}')
+        return None
+    _active = profile
+    return profile
+
+
+@contextmanager
+def profiled(stage, user_id=None, pdf_id=None, force=False, sample_rate=PROFILE_SAMPLE_RATE):
+    profile = start_profile(stage, user_id, pdf_id, force=force, sample_rate=sample_rate)
+    try:
+        yield profile
+    finally:
+        if profile is not None:
+            profile.stop()
+
+
+def run_profiled(path, fn, *args, **kwargs):
+    # Runs fn with cProfile and writes its profile to path, used by run_cpu while a profile is running
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return fn(*args, **kwargs)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            profiler.dump_stats(path)
+        except OSError as e:
+            print(f'Error saving the profile of {fn.__name__}: {e}')
+
+
+def prune_profiles(folder=PROFILE_DIR, max_files=PROFILE_MAX_FILES, max_bytes=PROFILE_MAX_MB * 1024 * 1024,
+                   parts_max_age=PROFILE_PARTS_MAX_AGE):
+    """
+    Removes the oldest profiles of the folder until there are at most max_files and max_bytes, and the parts older than
+    parts_max_age seconds, left by the profiles of the processes that stopped before merging them
+    """
+    parts_folder = os.path.join(folder, 'parts')
+    if os.path.isdir(parts_folder):
+        oldest = time.time() - parts_max_age
+        for filename in os.listdir(parts_folder):
+            path = os.path.join(parts_folder, filename)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    profiles = []
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        if filename.endswith('.pstats'):
+            try:
+                profiles.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+    profiles.sort()
+
+    total = sum(size for _, size, _ in profiles)
+    while profiles and (len(profiles) > max_files or total > max_bytes):
+        _, size, path = profiles.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
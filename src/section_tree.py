@@ -0,0 +1,189 @@
+"""
+Section tree of a document: the chapter path (titles of the headings that contain it) of each section, taken from the
+outline of the PDF or, when it has none, from the font sizes of the headings. The sections are grouped in chapters,
+so the retrieval of the large documents scores the chapters first and only searches the sections of the best ones
+(HierarchicalIndex).
+"""
+import os
+import re
+import json
+
+import numpy as np
+
+from env import retrival_threshold, HEADING_LEVELS, HIERARCHY_MIN_CHAPTERS, HIERARCHY_TOP_CHAPTERS
+from sparse_retrieval import SparseBM25Index
+
+LETTERS_PATTERN = re.compile(r'[^\W\d_]{2,}')
+# Lines of a heading at most, a longer run of lines with a large font is text, not a heading
+HEADING_MAX_LINES = 3
+# Maximum characters of the title of a heading
+TITLE_MAX_LENGTH = 150
+
+
+def font_headings(records, kept_lines, max_levels=HEADING_LEVELS):
+    """
+    Finds the headings of a document without outline: the runs of consecutive lines with the same font size, larger
+    than the size of the body text (the size with most characters), are headings. The max_levels largest sizes are the
+    levels of the headings, the largest one is level 1.
+    :param kept_lines: Indexes of the lines of records that are not boilerplate
+    :return: List of (level, title, page) of the headings in the order of the document, the pages are 0 based
+    """
+    if not len(kept_lines):
+        return []
+    sizes = np.round(records.sizes[kept_lines].astype(np.float64) * 2) / 2
+    lengths = np.array([len(records.text(i)) for i in kept_lines], dtype=np.float64)
+    classes, inverse = np.unique(sizes, return_inverse=True)
+    body_size = classes[np.argmax(np.bincount(inverse.reshape(-1), weights=lengths))]
+
+    starts = np.concatenate(([0], np.nonzero(sizes[1:] != sizes[:-1])[0] + 1))
+    ends = np.concatenate((starts[1:], [len(sizes)]))
+    runs = [(start, end) for start, end in zip(starts, ends)
+            if sizes[start] > body_size * 1.1 and end - start <= HEADING_MAX_LINES]
+    levels = sorted({sizes[start] for start, _ in runs}, reverse=True)[:max_levels]
+
+    pages = records.pages[kept_lines]
+    headings = []
+    for start, end in runs:
+        if sizes[start] not in levels:
+            continue
+        title = ' '.join(records.text(i).strip() for i in kept_lines[start:end])
+        if not LETTERS_PATTERN.search(title):
+            continue
+        headings.append((levels.index(sizes[start]) + 1, title[:TITLE_MAX_LENGTH], int(pages[start])))
+    return headings
+
+
+def build_section_tree(headings, section_pages, source, min_chapters=HIERARCHY_MIN_CHAPTERS):
+    """
+    Gives each section the path of the headings that are open at its first page, and groups the consecutive sections
+    with the same path, cut at the shallowest level with at least min_chapters groups, in chapters.
+    :param headings: List of (level, title, page) in the order of the document, the levels start at 1 and the pages
+    are 0 based
+    :param section_pages: {section file: [first page, last page]} of the sections in order, the pages are 1 based
+    :param source: 'outline' or 'fonts'
+    :return: {'source', 'sections': {section file: path}, 'chapters': [{'path', 'sections'}]}, or None if the
+    document has no headings
+    """
+    if not headings or not section_pages:
+        return None
+
+    headings = sorted(enumerate(headings), key=lambda x: (x[1][2], x[0]))
+    paths = {}
+    path = []
+    position = 0
+    for filename, (first_page, _) in section_pages.items():
+        while position < len(headings) and headings[position][1][2] + 1 <= first_page:
+            level, title, _ = headings[position][1]
+            path = path[:max(level - 1, 0)] + [title]
+            position += 1
+        paths[filename] = list(path)
+
+    depth = max(len(path) for path in paths.values())
+    for level in range(1, depth + 1):
+        chapters = group_sections(paths, level)
+        if len(chapters) >= min_chapters:
+            break
+    else:
+        chapters = group_sections(paths, depth)
+    if len(chapters) < 2:
+        return None
+    return {'source': source, 'sections': paths, 'chapters': chapters}
+
+
+def group_sections(paths, level):
+    # Consecutive sections with the same path up to level, the chapters with the same title are kept apart
+    chapters = []
+    for filename, path in paths.items():
+        if not chapters or chapters[-1]['path'] != path[:level]:
+            chapters.append({'path': path[:level], 'sections': []})
+        chapters[-1]['sections'].append(filename)
+    return chapters
+
+
+def section_tree_path(folder_path):
+    # The tree is stored next to the sections of the document: <user_id>/<pdf>/<pdf>_outline.json
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_outline.json')
+
+
+def save_section_tree(tree, folder_path):
+    file_path = section_tree_path(folder_path)
+    if tree is None:
+        # The tree of a previous ingestion of the document is not valid anymore
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(tree, file, ensure_ascii=False)
+
+
+def load_section_tree(folder_path):
+    try:
+        with open(section_tree_path(folder_path), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def build_chapter_index(corpus_tokenized, filenames, tree):
+    """
+    BM25 index of the chapters of the tree, each chapter is the concatenation of the tokens of its sections. The
+    names of the chapters in the index are their positions in tree['chapters'].
+    """
+    tokens = dict(zip(filenames, corpus_tokenized))
+    chapters_tokenized = [[token for filename in chapter['sections'] for token in tokens.get(filename, [])]
+                          for chapter in tree['chapters']]
+    return SparseBM25Index(chapters_tokenized, [str(i) for i in range(len(chapters_tokenized))])
+
+
+class HierarchicalIndex:
+    """
+    Coarse to fine retrieval over the sparse index of the sections: the chapters are scored first and only the
+    sections of the top_chapters best ones are scored, so the cost of a query depends on the size of the chapters and
+    not on the size of the document. The scores of the sections are the ones of the whole index, so the thresholds
+    still apply.
+    """
+
+    def __init__(self, sparse, chapters, tree):
+        self.sparse = sparse
+        self.chapters = chapters
+        self.paths = tree['sections']
+        rows = {filename: i for i, filename in enumerate(sparse.filenames)}
+        self.chapter_rows = [np.array([rows[filename] for filename in chapter['sections'] if filename in rows],
+                                      dtype=np.int64)
+                             for chapter in tree['chapters']]
+
+    @property
+    def filenames(self):
+        return self.sparse.filenames
+
+    @property
+    def total_tokens(self):
+        return self.sparse.total_tokens
+
+    def top_k_many(self, queries_tokens, k=10, top_chapters=HIERARCHY_TOP_CHAPTERS, **kwargs):
+        """
+        :param kwargs: lsa_weight and lsa_candidates of SparseBM25Index.top_k_many
+        """
+        if not queries_tokens:
+            return []
+        rows = []
+        for ranked in self.chapters.top_k_many(queries_tokens, k=top_chapters, lsa_weight=0):
+            chapter_rows = [self.chapter_rows[int(chapter)] for chapter, score in ranked if score > 0]
+            rows.append(np.concatenate(chapter_rows) if chapter_rows else np.array([], dtype=np.int64))
+        return self.sparse.top_k_many(queries_tokens, k=k, rows=rows, **kwargs)
+
+    def most_relevant_many(self, queries_tokens, k=10, threshold=retrival_threshold, **kwargs):
+        return [self._above_threshold(ranked, threshold)
+                for ranked in self.top_k_many(queries_tokens, k=k, **kwargs)]
+
+    _above_threshold = staticmethod(SparseBM25Index._above_threshold)
+
+
+def chapter_paths(paths, filenames):
+    # Paths of the chapters of the sections, without repetitions, in the order of the sections
+    result = []
+    for filename in filenames:
+        path = paths.get(filename)
+        if path and path not in result:
+            result.append(path)
+    return result
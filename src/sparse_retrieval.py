@@ -0,0 +1,251 @@
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+
+from env import retrival_threshold
+
+
+class SparseBM25Index:
+    """
+    BM25 index that keeps the sections of a document as a CSR matrix (sections x terms) of precomputed BM25 weights.
+    The weights follow rank_bm25.BM25Okapi exactly, so the scores of a query are the same, but they are obtained with
+    a single sparse matrix-vector product instead of a python loop over every query term and every section.
+    Optionally a TruncatedSVD (LSA) projection of the matrix is used to re-rank the best candidates, which helps to
+    recover sections that use synonyms of the query terms.
+    """
+
+    def __init__(self, corpus_tokenized, filenames, k1=1.5, b=0.75, epsilon=0.25, lsa_components=0):
+        self.filenames = list(filenames)
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        doc_len = np.array([len(doc) for doc in corpus_tokenized], dtype=np.int64)
+        tokens = np.fromiter((token for doc in corpus_tokenized for token in doc), dtype=np.int64,
+                             count=int(doc_len.sum()))
+        rows = np.repeat(np.arange(len(doc_len)), doc_len)
+
+        # Term ids (tiktoken ids or any hashable integer id) are mapped to consecutive columns
+        self.vocab, cols = np.unique(tokens, return_inverse=True)
+        tf = sp.csr_matrix((np.ones(len(tokens), dtype=np.float64), (rows, cols.reshape(-1))),
+                           shape=(len(doc_len), len(self.vocab)))
+        tf.sum_duplicates()
+
+        self.doc_len = doc_len
+        self.idf = self._okapi_idf(tf, len(doc_len))
+        self.matrix = self._bm25_weights(tf, doc_len)
+        self.lsa = None
+        self.lsa_docs = None
+
+        if lsa_components:
+            self.fit_lsa(lsa_components)
+
+    @property
+    def total_tokens(self):
+        return int(self.doc_len.sum())
+
+    def _okapi_idf(self, tf, corpus_size):
+        # Same formula as BM25Okapi._calc_idf: negative idf values are replaced by epsilon * average idf
+        doc_freq = np.bincount(tf.indices, minlength=tf.shape[1]).astype(np.float64)
+        idf = np.log(corpus_size - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        if len(idf):
+            idf[idf < 0] = self.epsilon * idf.mean()
+        return idf
+
+    def _bm25_weights(self, tf, doc_len):
+        avgdl = doc_len.mean() if len(doc_len) and doc_len.sum() else 1.0
+        norm = self.k1 * (1 - self.b + self.b * doc_len / avgdl)
+        rows = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+        weights = tf.copy()
+        weights.data = self.idf[tf.indices] * tf.data * (self.k1 + 1) / (tf.data + norm[rows])
+        return weights
+
+    def fit_lsa(self, n_components):
+        """
+        Fits the LSA projection used to re-rank the candidates. It's skipped for documents too small to be reduced.
+        """
+        from sklearn.decomposition import TruncatedSVD
+
+        n_components = min(n_components, self.matrix.shape[0] - 1, self.matrix.shape[1] - 1)
+        if n_components < 1:
+            return
+
+        self.lsa = TruncatedSVD(n_components=n_components, random_state=0)
+        self.lsa_docs = self._normalize(self.lsa.fit_transform(self.matrix))
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def query_vector(self, query_tokens):
+        """
+        Returns the dense vector of query term counts over the vocabulary of the index. Repeated query terms count
+        several times, as they do in BM25Okapi.get_scores.
+        """
+        query = np.zeros(len(self.vocab), dtype=np.float64)
+        tokens = np.asarray(query_tokens, dtype=np.int64)
+        if not len(tokens) or not len(self.vocab):
+            return query
+
+        positions = np.searchsorted(self.vocab, tokens)
+        positions[positions == len(self.vocab)] = 0
+        known = self.vocab[positions] == tokens
+        np.add.at(query, positions[known], 1.0)
+        return query
+
+    def get_scores(self, query_tokens):
+        return self.matrix.dot(self.query_vector(query_tokens))
+
+    def top_k(self, query_tokens, k=10, lsa_weight=0.3, lsa_candidates=50):
+        """
+        Returns the k best (filename, score) pairs sorted by score. When the LSA stage is fitted, the best
+        lsa_candidates sections by BM25 are re-ranked with a fused score kept in BM25 units:
+        (1 - lsa_weight) * bm25 + lsa_weight * cosine * best_bm25
+        """
+        query = self.query_vector(query_tokens)
+        return self._rank(query, self.matrix.dot(query), k, lsa_weight, lsa_candidates)
+
+    def top_k_many(self, queries_tokens, k=10, lsa_weight=0.3, lsa_candidates=50, rows=None):
+        """
+        Same as top_k for several queries, the scores of all of them are obtained with a single sparse matrix product
+        :param rows: Array of the sections (rows of the matrix) where each query is searched, all of them by default.
+        Only the rows of each query are scored
+        """
+        if not queries_tokens:
+            return []
+        queries = np.column_stack([self.query_vector(query_tokens) for query_tokens in queries_tokens])
+        if rows is not None:
+            return [self._rank(queries[:, i], self.matrix[query_rows].dot(queries[:, i]), k, lsa_weight,
+                               lsa_candidates, query_rows)
+                    for i, query_rows in enumerate(rows)]
+        scores = self.matrix.dot(queries)
+        return [self._rank(queries[:, i], scores[:, i], k, lsa_weight, lsa_candidates)
+                for i in range(len(queries_tokens))]
+
+    def _rank(self, query, scores, k, lsa_weight, lsa_candidates, rows=None):
+        # rows are the sections of the scores when they are not all of them
+        if not len(scores):
+            return []
+        if rows is None:
+            rows = np.arange(len(scores))
+
+        if self.lsa is not None and lsa_weight > 0:
+            candidates = self._partition(scores, max(k, lsa_candidates))
+            query_latent = self._normalize(self.lsa.transform(sp.csr_matrix(query * self.idf)))[0]
+            cosine = self.lsa_docs[rows[candidates]].dot(query_latent)
+            fused = (1 - lsa_weight) * scores[candidates] + lsa_weight * np.clip(cosine, 0, None) * scores.max()
+            order = np.argsort(-fused, kind='stable')[:k]
+            return [(self.filenames[rows[candidates[i]]], float(fused[i])) for i in order]
+
+        best = self._partition(scores, k)
+        return [(self.filenames[rows[i]], float(scores[i])) for i in best]
+
+    @staticmethod
+    def _partition(scores, k):
+        # Indices of the k best scores, sorted by score, without sorting the whole array
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        return best[np.argsort(-scores[best], kind='stable')]
+
+    def most_relevant(self, query_tokens, k=10, threshold=retrival_threshold, **kwargs):
+        """
+        Same selection as get_most_relevant_docs: the sections whose score is greater than threshold * best score
+        """
+        return self._above_threshold(self.top_k(query_tokens, k=k, **kwargs), threshold)
+
+    def most_relevant_many(self, queries_tokens, k=10, threshold=retrival_threshold, **kwargs):
+        return [self._above_threshold(ranked, threshold)
+                for ranked in self.top_k_many(queries_tokens, k=k, **kwargs)]
+
+    @staticmethod
+    def _above_threshold(ranked, threshold):
+        if not ranked or ranked[0][1] <= 0:
+            return []
+
+        best_score = ranked[0][1]
+        return [(filename, score) for filename, score in ranked if score / best_score > threshold]
+
+    def save(self, file_path):
+        np.savez(file_path,
+                 data=self.matrix.data,
+                 indices=self.matrix.indices,
+                 indptr=self.matrix.indptr,
+                 shape=np.array(self.matrix.shape),
+                 vocab=self.vocab,
+                 idf=self.idf,
+                 doc_len=self.doc_len,
+                 filenames=np.array(self.filenames),
+                 params=np.array([self.k1, self.b, self.epsilon]))
+
+    @classmethod
+    def load(cls, file_path, lsa_components=0):
+        with np.load(file_path) as data:
+            index = cls.__new__(cls)
+            index.k1, index.b, index.epsilon = (float(p) for p in data['params'])
+            index.matrix = sp.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                         shape=tuple(data['shape']))
+            index.vocab = data['vocab']
+            index.idf = data['idf']
+            index.doc_len = data['doc_len']
+            index.filenames = [str(filename) for filename in data['filenames']]
+        index.lsa = None
+        index.lsa_docs = None
+
+        if lsa_components:
+            index.fit_lsa(lsa_components)
+        return index
+
+
+def index_file_path(folder_path):
+    # The index is stored next to the section files of the document: <user_id>/<pdf>/<pdf>_bm25.npz
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_bm25.npz')
+
+
+def sections_manifest_path(folder_path):
+    # <user_id>/<pdf>/<pdf>_sections.stamp, written every time the sections of the document are written
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_sections.stamp')
+
+
+def save_sections_manifest(folder_path):
+    """
+    Marks the sections of the document as changed, so the stored indexes older than the manifest are built again
+    """
+    with open(sections_manifest_path(folder_path), 'w', encoding='utf-8') as file:
+        file.write(str(time.time()))
+
+
+def sections_mtime(folder_path):
+    """
+    :return: Modification time of the manifest of the sections. Documents ingested before the manifest existed get one
+    with the time of their newest section file, so their folder is listed only once
+    """
+    manifest = sections_manifest_path(folder_path)
+    try:
+        return os.path.getmtime(manifest)
+    except OSError:
+        pass
+
+    mtime = max((os.path.getmtime(os.path.join(folder_path, filename)) for filename in os.listdir(folder_path)
+                 if filename.endswith('.txt')), default=0)
+    try:
+        save_sections_manifest(folder_path)
+        os.utime(manifest, (mtime, mtime))
+    except OSError as e:
+        print(f"Error saving the manifest of the sections of {folder_path}: {e}")
+    return mtime
+
+
+def is_index_outdated(folder_path, file_path=None):
+    """
+    The stored index is outdated when the sections of the folder have been written after it
+    :param file_path: Stored index, the sparse index by default
+    """
+    file_path = file_path or index_file_path(folder_path)
+    try:
+        index_mtime = os.path.getmtime(file_path)
+    except OSError:
+        return True
+    return sections_mtime(folder_path) > index_mtime
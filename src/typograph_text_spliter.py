@@ -1,10 +1,19 @@
 import os
 import re
+import json
 from dotenv import load_dotenv
 
-import xml.etree.ElementTree as ET
+import numpy as np
 import pyodbc
 
+from boilerplate_filter import find_repeated_lines, count_tokens, NearDuplicateDetector
+from line_records import LineRecords
+from nlp_resources import get_tokenizer
+from env import REMOVE_BOILERPLATE, BOILERPLATE_MIN_PAGE_RATIO, BOILERPLATE_MIN_PAGES, NEAR_DUPLICATE_THRESHOLD
+from env import CHUNKING_MODE, CHUNK_TOKENS, CHUNK_OVERLAP, CHUNK_MIN_TOKENS
+from section_tree import font_headings, build_section_tree, save_section_tree
+from sparse_retrieval import save_sections_manifest
+
 
 # Load environment variables
 load_dotenv()
@@ -16,55 +25,134 @@ def is_unwanted_section(text):
     return not bool(pattern.search(text))
 
 
-def segment_text(xml_file_path, pdf_id, save_to_file=False, file_path=None):
-    # Load the XML file
-    tree = ET.parse(xml_file_path)
-    root = tree.getroot()
+def segment_text(xml_file_path, pdf_id, save_to_file=False, file_path=None, records=None, subfiles=None,
+                 cancel_check=None, mode=CHUNKING_MODE, chunk_tokens=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP,
+                 outline=None):
+    """
+    Splits the lines of the document in sections and saves them.
+    :param records: LineRecords of the extraction, if they are not given they are loaded from the XML file
+    :param subfiles: If a list is given, the (name, tokens) of the sections are appended to it instead of being
+    inserted in the database, so the caller can insert them in bulk
+    :param cancel_check: Function called before each section, it raises an exception to stop the segmentation
+    :param mode: 'font' or 'tokens', see CHUNKING_MODE
+    :param chunk_tokens: Target tokens of the sections in the tokens mode
+    :param chunk_overlap: Tokens repeated between the parts of a section split in the tokens mode
+    :param outline: (level, title, page) of the entries of the outline of the PDF, the section tree is built with them
+    or, if there are none, with the font sizes of the headings
+    :return: Dictionary with the tokens of the document, the tokens removed as boilerplate or duplicated sections, the
+    number of sections saved, their pages and the number of chapters. The pages and the section tree are also saved
+    next to the sections, see section_pages_path and section_tree.section_tree_path
+    """
+    if records is None:
+        records = LineRecords.from_xml(xml_file_path)
 
     # Initialize variables for tracking
-    temp_size = 0.000000001
     current_section = []
     sec_count = 0
 
-    # We read all the text elements in the XML file
-    for doc in root.findall('doc'):
-        text_field = doc.find('field1').text
-        font_field = doc.find('field2').text
-        size_field = doc.find('field3').text
-
-        # If the size varies positively with respect to the previous one, a new section will start.
-        # 1. It is possible that we want to adjust the threshold of 0.9 in the if condition based on the results we observe.
-        # If you find that you are getting too many sections, you could increase this threshold; if you find that you are
-        # not getting enough, you could decrease it.
-        # 2. This strategy assumes that the section titles will always be of a larger font size than the section text.
-        # This may not be true in all documents, especially in documents with a more complex design. In these cases, other
-        # text features, such as font style or bold, may need to be considered.
-        # 3. We could also consider if there are other signs of a new section that can be used, in addition to the font size.
-        # For example, sections may be separated by a blank line, or the section title may be on a line by itself.
-        # the section title may be on a line by itself.
-
-        if current_section and 0.0 < temp_size/float(size_field) < 0.85:
-            current_section.append(text_field)
-            # Process the current section
-            section_text = process_section(current_section,
-                                           pdf_id,
-                                           save_to_file,
-                                           file_path + '_' + str(sec_count) + '.txt')
-
-            # Check if we got a section less than 100 characters
-            if section_text:
-                # If the section is less than 100 characters, start the new section with it
-                current_section = [section_text]
-            else:
-                # If the section is greater than 100 characters, start a new section
-                current_section = [text_field]
-
-            temp_size = float(size_field)
-            sec_count += 1
+    stats = {'tokens': count_tokens(' '.join(records.text(i) for i in range(len(records)))),
+             'lines_removed': 0,
+             'sections_removed': 0,
+             'tokens_removed': 0,
+             'sections': 0,
+             'section_pages': {},
+             'chapters': 0}
+
+    # Find the running headers, footers and page numbers, only the records with the page and position of the lines
+    # can be filtered
+    kept_lines = np.arange(len(records))
+    duplicate_detector = None
+    if REMOVE_BOILERPLATE:
+        duplicate_detector = NearDuplicateDetector(threshold=NEAR_DUPLICATE_THRESHOLD)
+        if len(records) and records.pages.min() >= 0:
+            removed_lines = find_repeated_lines([(record['text'], record['page'], record['y']) for record in records],
+                                                min_page_ratio=BOILERPLATE_MIN_PAGE_RATIO,
+                                                min_pages=BOILERPLATE_MIN_PAGES)
+            kept_lines = np.setdiff1d(kept_lines, np.fromiter(removed_lines, dtype=np.int64), assume_unique=True)
+            stats['lines_removed'] = len(removed_lines)
+            stats['tokens_removed'] = count_tokens(' '.join(records.text(i) for i in sorted(removed_lines)))
+
+    # If the size varies positively with respect to the previous one, a new section will start.
+    # 1. It is possible that we want to adjust the threshold of 0.9 in the if condition based on the results we observe.
+    # If you find that you are getting too many sections, you could increase this threshold; if you find that you are
+    # not getting enough, you could decrease it.
+    # 2. This strategy assumes that the section titles will always be of a larger font size than the section text.
+    # This may not be true in all documents, especially in documents with a more complex design. In these cases, other
+    # text features, such as font style or bold, may need to be considered.
+    # 3. We could also consider if there are other signs of a new section that can be used, in addition to the font size.
+    # For example, sections may be separated by a blank line, or the section title may be on a line by itself.
+    # the section title may be on a line by itself.
+    # The size ratio test is done at once over the size column, so we only iterate over the sections
+    boundaries = records.section_boundaries(kept_lines, threshold=0.85)
+
+    # Pages of the lines (1 based), the records loaded from an XML without pages have -1
+    line_pages = records.pages[kept_lines] + 1 if len(records) and records.pages.min() >= 0 else None
+
+    def pages(start, end):
+        return None if line_pages is None or end <= start else (int(line_pages[start]), int(line_pages[end - 1]))
+
+    if mode == 'tokens':
+        # The font size changes are the preferred cuts, but the sections are packed to about chunk_tokens tokens
+        starts = np.concatenate(([0], boundaries)).astype(np.int64)
+        ends = np.concatenate((boundaries, [len(kept_lines)])).astype(np.int64)
+        sections = [[records.text(i) for i in kept_lines[start:end]] for start, end in zip(starts, ends)]
+        section_pages = None
+        if line_pages is not None:
+            section_pages = [line_pages[start:end].tolist() for start, end in zip(starts, ends)]
+        for sec_count, (chunk, chunk_pages) in enumerate(chunk_sections(sections, chunk_tokens, chunk_overlap,
+                                                                        pages=section_pages)):
+            if cancel_check is not None:
+                cancel_check()
+            process_section(chunk,
+                            pdf_id,
+                            save_to_file,
+                            file_path + '_' + str(sec_count) + '.txt',
+                            is_last_section=True,
+                            duplicate_detector=duplicate_detector,
+                            stats=stats,
+                            subfiles=subfiles,
+                            pages=chunk_pages)
+        save_section_pages(stats, save_to_file, file_path)
+        save_tree(stats, save_to_file, file_path, records, kept_lines, outline)
+        if save_to_file:
+            save_sections_manifest(os.path.dirname(file_path))
+        return stats
+
+    position = 0
+    # First line of the current section, the short sections are joined to the next one
+    first_line = 0
+    for boundary in boundaries:
+        if cancel_check is not None:
+            cancel_check()
+
+        # The line that starts the section also closes the current one
+        current_section.extend(records.text(i) for i in kept_lines[position:boundary])
+        text_field = records.text(kept_lines[boundary])
+        current_section.append(text_field)
+
+        # Process the current section
+        section_text = process_section(current_section,
+                                       pdf_id,
+                                       save_to_file,
+                                       file_path + '_' + str(sec_count) + '.txt',
+                                       duplicate_detector=duplicate_detector,
+                                       stats=stats,
+                                       subfiles=subfiles,
+                                       pages=pages(first_line, boundary + 1))
+
+        # Check if we got a section less than 100 characters
+        if section_text:
+            # If the section is less than 100 characters, start the new section with it
+            current_section = [section_text]
         else:
-            # If the size has not varied much, continue with the current section
-            current_section.append(text_field)
-            temp_size = float(size_field)
+            # If the section is greater than 100 characters, start a new section
+            current_section = [text_field]
+            first_line = boundary
+
+        sec_count += 1
+        position = boundary + 1
+
+    current_section.extend(records.text(i) for i in kept_lines[position:])
 
     # Don't forget to process the last section
     if current_section:
@@ -72,16 +160,140 @@ def segment_text(xml_file_path, pdf_id, save_to_file=False, file_path=None):
                         pdf_id,
                         save_to_file,
                         file_path + '_' + str(sec_count) + '.txt',
-                        is_last_section=True)
+                        is_last_section=True,
+                        duplicate_detector=duplicate_detector,
+                        stats=stats,
+                        subfiles=subfiles,
+                        pages=pages(first_line, len(kept_lines)))
         sec_count += 1
 
+    save_section_pages(stats, save_to_file, file_path)
+    save_tree(stats, save_to_file, file_path, records, kept_lines, outline)
+    if save_to_file:
+        # The stored indexes of the document are built again when they are older than the manifest
+        save_sections_manifest(os.path.dirname(file_path))
+    return stats
+
+
+def section_pages_path(folder_path):
+    # The pages of the sections are stored next to them: <user_id>/<pdf>/<pdf>_pages.json
+    return os.path.join(folder_path, os.path.basename(os.path.normpath(folder_path)) + '_pages.json')
+
+
+def save_section_pages(stats, save_to_file, file_path):
+    # {section file: [first page, last page]}, used to cite the pages of the extractive answers
+    if not save_to_file or not stats['section_pages']:
+        return
+    with open(section_pages_path(os.path.dirname(file_path)), 'w', encoding='utf-8') as file:
+        json.dump(stats['section_pages'], file)
+
 
-def process_section(section, pdf_id, save_to_file=False, file_path=None, is_last_section=False):
+def save_tree(stats, save_to_file, file_path, records, kept_lines, outline):
+    # Chapter path of each section, from the outline of the PDF or the font sizes of the headings
+    if not save_to_file:
+        return
+    if outline:
+        tree = build_section_tree(outline, stats['section_pages'], 'outline')
+    else:
+        tree = build_section_tree(font_headings(records, kept_lines), stats['section_pages'], 'fonts')
+    stats['chapters'] = len(tree['chapters']) if tree else 0
+    save_section_tree(tree, os.path.dirname(file_path))
+
+
+def load_section_pages(folder_path):
+    try:
+        with open(section_pages_path(folder_path), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def chunk_sections(sections, target_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP, pages=None,
+                   min_tokens=CHUNK_MIN_TOKENS):
+    """
+    Packs the sections delimited by the headings in chunks of at most target_tokens tokens. Consecutive small sections
+    are joined, and a section larger than target_tokens is split between its lines in chunks that repeat the last
+    overlap_tokens tokens of the previous one. A line larger than target_tokens is cut by tokens.
+    A chunk is not closed with less than min_tokens tokens (a heading followed by a large section): it's carried into
+    the next section, which can exceed target_tokens by those tokens, and the last one is joined to the previous chunk.
+    :param sections: List of sections, each one a list of lines
+    :param pages: Pages of the lines of each section, with the same shape as sections
+    :return: List of (lines, (first page, last page)) of the chunks, the pages are None if they are not given
+    """
+    tokenizer = get_tokenizer()
+    overlap_tokens = min(overlap_tokens, target_tokens // 2)
+    min_tokens = min(min_tokens, target_tokens // 2)
+    chunks = []
+    current = []
+    current_tokens = 0
+    # Lines at the start of current repeated from the previous chunk
+    carried = 0
+
+    def flush():
+        if current:
+            chunk_pages = (current[0][2], current[-1][2]) if pages is not None else None
+            chunks.append(([line for line, _, _ in current], chunk_pages))
+
+    for position, section in enumerate(sections):
+        # The same lines that process_section keeps
+        lines = []
+        for line, page in zip(section, pages[position] if pages is not None else [None] * len(section)):
+            if len(line) <= 1:
+                continue
+            tokens = tokenizer.encode(line)
+            if len(tokens) <= target_tokens:
+                lines.append((line, len(tokens), page))
+                continue
+            for start in range(0, len(tokens) - overlap_tokens, target_tokens - overlap_tokens):
+                piece = tokens[start:start + target_tokens]
+                lines.append((tokenizer.decode(piece), len(piece), page))
+        if not lines:
+            continue
+        section_tokens = sum(tokens for _, tokens, _ in lines)
+
+        if current_tokens >= min_tokens and current_tokens + section_tokens > target_tokens:
+            flush()
+            current, current_tokens, carried = [], 0, 0
+
+        if section_tokens <= target_tokens:
+            current += lines
+            current_tokens += section_tokens
+            continue
+
+        # Large section, split between its lines. The last chunk stays open so the next small sections can join it
+        for line, tokens, page in lines:
+            if current_tokens >= min_tokens and current_tokens + tokens > target_tokens:
+                flush()
+                overlap = []
+                overlap_size = 0
+                for previous in reversed(current):
+                    if overlap_size + previous[1] > overlap_tokens:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_size += previous[1]
+                current, current_tokens, carried = overlap, overlap_size, len(overlap)
+            current.append((line, tokens, page))
+            current_tokens += tokens
+
+    if chunks and current and current_tokens < min_tokens:
+        # Joined to the previous chunk, without the lines it repeats as overlap
+        previous_lines, previous_pages = chunks.pop()
+        chunks.append((previous_lines + [line for line, _, _ in current[carried:]],
+                       (previous_pages[0], current[-1][2]) if pages is not None else None))
+        return chunks
+    flush()
+    return chunks
+
+
+def process_section(section, pdf_id, save_to_file=False, file_path=None, is_last_section=False,
+                    duplicate_detector=None, stats=None, subfiles=None, pages=None):
     """
     Process the text of the section.
     If the section is too short and it's not the last one, it's returned.
+    If the section is a near duplicate of a previous one, it's discarded.
     The text is saved to a file or printed.
-    The section is then saved to the database.
+    The section is then saved to the database with its tokens, or appended to subfiles if it's given.
+    :param pages: (first page, last page) of the section
     """
     # Extract the text from all the elements in the section
     section_text = ' '.join(elem for elem in section if len(elem) > 1)
@@ -93,6 +305,18 @@ def process_section(section, pdf_id, save_to_file=False, file_path=None, is_last
     if not is_last_section and len(section_text) < 100:
         return section_text
 
+    if duplicate_detector is not None and duplicate_detector.is_duplicate(section_text):
+        if stats is not None:
+            stats['sections_removed'] += 1
+            stats['tokens_removed'] += count_tokens(section_text)
+        return
+
+    tokens = count_tokens(section_text)
+    if stats is not None:
+        stats['sections'] += 1
+        if pages is not None:
+            stats['section_pages'][os.path.basename(file_path)] = list(pages)
+
     # Here you can do whatever you want with the section text
     if save_to_file:
         with open(file_path, 'w', encoding='utf-8') as fp:
@@ -101,11 +325,15 @@ def process_section(section, pdf_id, save_to_file=False, file_path=None, is_last
         print(section_text)
 
     subfile = file_path.split('\\')[-1]
+    if subfiles is not None:
+        subfiles.append((subfile, tokens))
+        return
+
     with pyodbc.connect(os.getenv('cnxn_str')) as cnxn:
         with cnxn.cursor() as cursor:
             # Save subfiles to the database
             cursor.execute("""
-            INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED)
-            VALUES (?, ?, 0)
-            """, pdf_id, subfile)
+            INSERT INTO PDFSubFiles (PDF_ID, SUBFILE_NAME, IS_DELETED, TOKENS)
+            VALUES (?, ?, 0, ?)
+            """, pdf_id, subfile, tokens)
             cnxn.commit()
@@ -0,0 +1,132 @@
+import os
+import uuid
+import hashlib
+
+from flask import Request, abort
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
+
+from env import MAX_UPLOAD_BYTES, MAX_UPLOAD_PAGES, UPLOAD_TMP_DIR, UPLOAD_CHUNK_SIZE
+from utils import file_sha256
+
+PDF_HEADER = b'%PDF-'
+
+
+class UploadWriter:
+    """
+    File where an upload is written while it's received. The content is hashed and counted in the same pass, the upload
+    is aborted as soon as it's bigger than max_bytes or doesn't start as a PDF. It's written in a temporary file of
+    UPLOAD_TMP_DIR, that must be in the same filesystem as the user folders, and moved to its final path with commit()
+    so the ingestion never sees a half-written PDF.
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_UPLOAD_BYTES, keep_partial=False):
+        """
+        :param path: Temporary file, if it already has content the new data is appended (resumable uploads)
+        :param keep_partial: Keep the temporary file when it's closed without commit, to resume the upload later
+        """
+        os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+        self.path = path or os.path.join(UPLOAD_TMP_DIR, f'{uuid.uuid4().hex}.part')
+        self.max_bytes = max_bytes
+        self.keep_partial = keep_partial
+        self.digest = hashlib.sha256()
+        self._file = open(self.path, 'ab+')
+        self.size = self._file.tell()
+        self._resumed = self.size > 0
+        # The header was checked with the first chunk of a resumed upload
+        self._head = PDF_HEADER if self._resumed else b''
+        self._committed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.discard()
+            abort(413, description=f"File bigger than {self.max_bytes} bytes")
+
+        if len(self._head) < len(PDF_HEADER):
+            self._head += data[:len(PDF_HEADER) - len(self._head)]
+            if not PDF_HEADER.startswith(self._head[:len(PDF_HEADER)]):
+                self.discard()
+                abort(400, description="The file is not a PDF")
+
+        self.digest.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read, readline, seek... are the ones of the file, the form parser needs them
+        return getattr(self._file, name)
+
+    @property
+    def content_hash(self):
+        if not self._resumed:
+            return self.digest.hexdigest()
+        # The first chunks of a resumed upload were received by other requests, so the file is read again
+        return file_sha256(self._target if self._committed else self.path)
+
+    def count_pages(self):
+        # Reads the page count of the catalog, without parsing the pages
+        self._file.flush()
+        with open(self.path, 'rb') as fp:
+            document = PDFDocument(PDFParser(fp))
+            return int(resolve1(resolve1(document.catalog['Pages'])['Count']))
+
+    def check_pages(self, max_pages=MAX_UPLOAD_PAGES):
+        try:
+            pages = self.count_pages()
+        except Exception as e:
+            self.discard()
+            abort(400, description=f"The file is not a valid PDF: {e}")
+        if pages > max_pages:
+            self.discard()
+            abort(413, description=f"File with more than {max_pages} pages")
+        return pages
+
+    def commit(self, target_path):
+        # Moves the complete file to its final path in a single step
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.path, target_path)
+        self._committed = True
+        self._target = target_path
+
+    def close(self):
+        # The request closes its files when it ends, an upload that was not committed is removed then
+        if not self._file.closed:
+            self._file.close()
+        if not self._committed and not self.keep_partial and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self._committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def write_stream(stream, writer, chunk_size=UPLOAD_CHUNK_SIZE):
+    # Copies a request body to the writer in chunks
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        writer.write(chunk)
+    return writer
+
+
+def resumable_writer(user_id, pdf_id, max_bytes=MAX_UPLOAD_BYTES):
+    # Writer of a resumable upload: the same temporary file receives all the chunks of the document
+    return UploadWriter(os.path.join(UPLOAD_TMP_DIR, f'{user_id}_{pdf_id}.part'), max_bytes=max_bytes, keep_partial=True)
+
+
+def resumable_offset(user_id, pdf_id):
+    # Bytes of a resumable upload already received
+    path = os.path.join(UPLOAD_TMP_DIR, f'{user_id}_{pdf_id}.part')
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class StreamingRequest(Request):
+    """
+    Request that writes the files of multipart forms directly in an UploadWriter instead of a spooled temporary file
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadWriter()
@@ -1,3 +1,5 @@
+import hashlib
+
 
 def get_new_chat_id(cursor, user_id, pdf_id):
     # It returns the chat_id + 1 of the last message of and specific user and pdf_id if it exists
@@ -15,4 +17,42 @@ def get_new_chat_id(cursor, user_id, pdf_id):
     if row is None:
         return 1
     else:
-        return row.CHAT_ID + 1
\ No newline at end of file
+        return row.CHAT_ID + 1
+
+
+def is_chat_closed(cursor, user_id, pdf_id, chat_id):
+    # True if the chat was closed, its messages are moved to MESSAGES_ARCHIVE and it can't take more questions
+    cursor.execute("""
+    SELECT TOP 1 IS_CHAT_CLOSED
+    FROM CHATS
+    WHERE USER_ID = ?
+    AND PDF_ID = ?
+    AND CHAT_ID = ?
+    """, user_id, pdf_id, chat_id)
+    row = cursor.fetchone()
+    return bool(row and row.IS_CHAT_CLOSED)
+
+
+def reserve_pdf_ids(cursor, count):
+    # Takes count consecutive ids of the sequence PDF_ID_SEQ and returns the first one, they are never given again
+    cursor.execute("""
+    SET NOCOUNT ON;
+    DECLARE @first SQL_VARIANT;
+    EXEC sp_sequence_get_range @sequence_name = N'PDF_ID_SEQ', @range_size = ?, @range_first_value = @first OUTPUT;
+    SELECT CAST(@first AS INT);
+    """, count)
+    return cursor.fetchone()[0]
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    # Returns the sha256 of the content of the file, reading it in chunks
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_sha256(text):
+    # Returns the sha256 of a text, used to know which sections of a document changed
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()